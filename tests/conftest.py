@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# main.py creates its working files relative to the current directory when imported: keep them out of the checkout
+os.chdir(tempfile.mkdtemp(prefix="wm-tests-"))
+os.environ["OWNER_ID"] = "1"
+os.environ["SCRATCH_DIR"] = os.path.abspath("scratch")  # apart from WORK_DIR, as on hosts that put it on tmpfs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "watermark"))
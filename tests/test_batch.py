@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class FakeMessage:
+    def __init__(self, uid):
+        self.from_user = SimpleNamespace(id=uid)
+        self.replies = []
+
+    async def reply(self, text):
+        self.replies.append(text)
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    # Videos that made it out of the batch window
+    out = []
+
+    async def queue_video(m, sess, source=None):
+        out.append(m)
+
+    monkeypatch.setattr(main, "BATCH_WAIT", 0.05)
+    monkeypatch.setattr(main, "queue_video", queue_video)
+    return out
+
+
+def test_cancel_drops_videos_still_collecting(queued):
+    async def run():
+        uid = 41
+        m = FakeMessage(uid)
+        main.pending_batches[uid] = [m, FakeMessage(uid)]
+        flush = asyncio.create_task(main.flush_video_batch(uid))
+        await asyncio.sleep(0.01)
+        await main.cancel_handler(None, m)
+        await flush
+        return m.replies
+
+    replies = asyncio.run(run())
+    assert queued == [] and 41 not in main.pending_batches
+    assert "Cleared 2 item(s)" in replies[0]
+
+
+def test_batch_started_after_cancel_is_kept(queued):
+    async def run():
+        uid = 42
+        main.pending_batches[uid] = [FakeMessage(uid)]
+        old = asyncio.create_task(main.flush_video_batch(uid))
+        await asyncio.sleep(0.01)
+        assert main.drop_pending_batch(uid) == 1
+        fresh = FakeMessage(uid)
+        main.pending_batches[uid] = [fresh]
+        await old
+        assert main.pending_batches.get(uid) == [fresh]  # the old task must not take the new batch with it
+        await main.flush_video_batch(uid)
+        return fresh
+
+    fresh = asyncio.run(run())
+    assert queued == [fresh]
+
+
+def test_reset_drops_videos_still_collecting():
+    main.pending_batches[43] = [FakeMessage(43)]
+    main.UserSession(user_id=43).reset()
+    assert 43 not in main.pending_batches
+
+
+def test_cancel_with_nothing_to_cancel():
+    m = FakeMessage(44)
+    asyncio.run(main.cancel_handler(None, m))
+    assert m.replies == ["❌ **Queue is empty.**"]
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return main.EncodeBroker(str(tmp_path / "broker.db"), lease=60, max_attempts=2)
+
+
+def test_claim_finish(broker):
+    task = broker.put(7, {"in_path": "a"})
+    assert broker.put(7, {"in_path": "a"}) == task  # re-attach, not a second task
+    assert broker.claim("w1") == (task, {"in_path": "a"})
+    assert broker.claim("w2") is None  # leased
+    assert broker.heartbeat(task, "w1", "50%")
+    assert not broker.heartbeat(task, "w2")
+    assert broker.finish(task, "w1", {"duration": 3})
+    assert broker.get(task) == ("done", "50%", '{"duration": 3}', None)
+
+
+def test_fail_without_retry_or_attempts_left(broker):
+    task = broker.put(1, {})
+    broker.claim("w1")
+    broker.fail(task, "w1", "bad input", retry=False)
+    assert broker.get(task)[0] == "failed"
+
+    task = broker.put(2, {})
+    broker.claim("w1")
+    broker.fail(task, "w1", "x", retry=True)
+    broker.claim("w2")
+    broker.fail(task, "w2", "x", retry=True)  # second of max_attempts=2
+    assert broker.get(task)[::3] == ("failed", "x")
+
+
+def test_expired_lease_is_reclaimed_then_reaped(broker, monkeypatch):
+    task = broker.put(1, {})
+    broker.claim("w1")
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 61)
+    assert broker.claim("w2") == (task, {})
+    assert not broker.heartbeat(task, "w1")  # w1 lost its lease
+    monkeypatch.setattr(main.time, "time", lambda: now + 200)
+    assert broker.claim("w3") is None  # out of attempts
+    assert broker.get(task)[::3] == ("failed", "worker lost")
+
+
+def test_cancel(broker):
+    task = broker.put(1, {})
+    broker.claim("w1")
+    broker.cancel(task)
+    assert not broker.heartbeat(task, "w1")
+    assert broker.get(task)[0] == "cancelled"
+
+
+def test_retry_goes_to_other_workers_first(broker):
+    task = broker.put(1, {})
+    broker.claim("w1")
+    broker.fail(task, "w1", "source missing", retry=True)
+    assert broker.get(task)[0] == "pending"
+    assert broker.claim("w1") is None  # the worker that gave it back waits BROKER_RETRY_DELAY
+    assert broker.claim("w2") == (task, {})
+
+
+def test_retry_returns_to_same_worker_after_delay(broker, monkeypatch):
+    task = broker.put(1, {})
+    broker.claim("w1")
+    broker.fail(task, "w1", "source missing", retry=True)
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + main.BROKER_RETRY_DELAY + 1)
+    assert broker.claim("w1") == (task, {})
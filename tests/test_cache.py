@@ -0,0 +1,61 @@
+import sqlite3
+import time
+
+import main
+
+
+def cache(ttl=3600, max_entries=100):
+    return main.ResultCache(sqlite3.connect(":memory:", isolation_level=None), ttl, max_entries)
+
+
+def test_key_covers_output_settings_only():
+    a = main.UserSession(user_id=1, watermark_text="hi")
+    assert main.result_key("u1", a) == main.result_key("u1", main.UserSession(user_id=2, watermark_text="hi", step="wait_text"))
+    assert main.result_key("u1", a) != main.result_key("u2", a)
+    for change in ({"crf": 28}, {"resolution": 480}, {"watermark_mode": "dual"}, {"speed": 2.0}):
+        assert main.result_key("u1", a) != main.result_key("u1", main.UserSession(user_id=1, watermark_text="hi", **change))
+
+
+def test_get_counts_hits_and_misses():
+    c = cache()
+    c.put("k", "file-1", 10, 1280, 720)
+    assert c.get("k") == ("file-1", 10, 1280, 720)
+    assert c.get("other") is None
+    assert (c.hits, c.misses) == (1, 1)
+    c.forget("k")
+    assert c.get("k") is None
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    c = cache(ttl=60)
+    c.put("old", "file-1", 10, 1280, 720)
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 61)
+    assert c.get("old") is None
+    c.put("new", "file-2", 10, 1280, 720)  # eviction drops the expired row
+    assert c.db.execute("SELECT key FROM results").fetchall() == [("new",)]
+
+
+def test_size_cap_evicts_least_recently_used(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    c = cache(max_entries=2)
+    for key in ("a", "b"):
+        c.put(key, f"file-{key}", 1, 1, 1)
+        clock[0] += 1
+    c.get("a")  # b is now the least recently used
+    clock[0] += 1
+    c.put("c", "file-c", 1, 1, 1)
+    assert sorted(k for k, in c.db.execute("SELECT key FROM results")) == ["a", "c"]
+
+
+def test_key_includes_the_preset():
+    a = main.UserSession(user_id=1, preset="medium")
+    assert main.result_key("u1", a) != main.result_key("u1", main.UserSession(user_id=1, preset="ultrafast"))
+
+
+def test_stats_report_preview_cache(monkeypatch):
+    monkeypatch.setattr(main.preview_cache, "hits", 3)
+    monkeypatch.setattr(main.preview_cache, "misses", 2)
+    assert "Preview cache: `3` reused, `2` downloaded" in main.metrics.summary()
+    assert "wm_preview_cache_misses_total 2" in main.metrics.prometheus()
@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+import main
+
+# Stands in for ffmpeg: writes its pid, then prints -progress blocks as the mode says
+FAKE_FFMPEG = """\
+import os, sys, time
+mode, pid_file = sys.argv[-2:]
+with open(pid_file, "w") as f: f.write(str(os.getpid()))
+t = 0
+while True:
+    t += 1
+    print(f"out_time_us={t * 1000000}\\nspeed=1x\\nprogress={'end' if mode == 'ok' and t == 2 else 'continue'}", flush=True)
+    if mode == "ok" and t == 2: break
+    time.sleep(0.05 if mode == "busy" else 60 if mode == "stall" else 0)
+"""
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    script = tmp_path / "ffmpeg"
+    script.write_text(f"#!{sys.executable}\n{FAKE_FFMPEG}")
+    script.chmod(0o755)
+    monkeypatch.setattr(main, "STALL_TIMEOUT", 0.3)
+    return lambda mode: [str(script), mode, str(tmp_path / "pid")]
+
+
+def alive(pid: int) -> bool:
+    try: os.kill(pid, 0)
+    except ProcessLookupError: return False
+    return True
+
+
+def test_progress_is_reported(fake_ffmpeg):
+    result, seen = main.EncodeResult(), []
+
+    async def on_progress(p):
+        seen.append(p.time)
+
+    assert asyncio.run(main.run_ffmpeg(fake_ffmpeg("ok"), result, on_progress)) == 0
+    assert seen == [1.0, 2.0] and result.duration == 2.0 and not result.error
+
+
+def test_stalled_ffmpeg_is_killed(fake_ffmpeg):
+    result, start = main.EncodeResult(), time.monotonic()
+    assert asyncio.run(main.run_ffmpeg(fake_ffmpeg("stall"), result)) != 0
+    assert result.error == "stalled"
+    assert time.monotonic() - start < 5
+
+
+def test_slow_ffmpeg_is_killed_at_the_timeout(fake_ffmpeg):
+    # Output keeps advancing, so only the overall timeout stops it
+    result = main.EncodeResult()
+    assert asyncio.run(main.run_ffmpeg(fake_ffmpeg("busy"), result, timeout=1.0)) != 0
+    assert result.error == "timed out" and result.duration > 1
+
+
+def test_cancelling_the_job_kills_ffmpeg(fake_ffmpeg, tmp_path):
+    async def run():
+        task = asyncio.create_task(main.run_ffmpeg(fake_ffmpeg("stall"), main.EncodeResult()))
+        while not (tmp_path / "pid").exists() or not (tmp_path / "pid").read_text(): await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError): await task
+
+    asyncio.run(run())
+    assert not alive(int((tmp_path / "pid").read_text()))
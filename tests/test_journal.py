@@ -0,0 +1,77 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.jobs = []
+
+    def enqueue(self, job):
+        self.jobs.append(job)
+        return job
+
+    def position(self, job):
+        return self.jobs.index(job) + 1
+
+
+@pytest.fixture
+def recovery(monkeypatch):
+    journal = main.JobJournal(":memory:")
+    scheduler = FakeScheduler()
+    messages = {}
+
+    async def get_messages(chat_id, message_id):
+        if message_id not in messages: raise ValueError("message deleted")
+        return messages[message_id]
+
+    async def send_message(*args, **kw):
+        pass
+
+    monkeypatch.setattr(main, "journal", journal)
+    monkeypatch.setattr(main, "scheduler", scheduler)
+    monkeypatch.setattr(main.app, "get_messages", get_messages)
+    monkeypatch.setattr(main.app, "send_message", send_message)
+    yield SimpleNamespace(journal=journal, scheduler=scheduler, messages=messages)
+    for path in journal.live_paths():
+        if os.path.exists(path): os.remove(path)
+
+
+def add_job(recovery, mid, stage, in_size=None, out_size=None, result=None):
+    message = SimpleNamespace(chat=SimpleNamespace(id=5), id=mid, video=SimpleNamespace(file_size=2000), document=None)
+    recovery.messages[mid] = message
+    job_id = recovery.journal.add(5, message, main.UserSession(user_id=5))
+    in_path = os.path.join(main.WORK_DIR, f"in_5_{job_id}.mp4")
+    out_path = os.path.join(main.WORK_DIR, f"out_5_{job_id}.mp4")
+    for path, size in ((in_path, in_size), (out_path, out_size)):
+        if size is not None:
+            with open(path, "wb") as f: f.write(b"\0" * size)
+    recovery.journal.set_paths(job_id, in_path, out_path)
+    recovery.journal.advance(job_id, stage, result)
+    return job_id
+
+
+def stages(journal):
+    return dict(journal.db.execute("SELECT id, stage FROM jobs").fetchall())
+
+
+def test_recovery_resumes_from_the_last_stage_whose_files_survived(recovery):
+    encoded = add_job(recovery, 1, "encoded", in_size=2000, out_size=4096, result={"duration": 3})
+    no_output = add_job(recovery, 2, "encoded", in_size=2000, result={"duration": 3})
+    nothing = add_job(recovery, 3, "encoded", result={"duration": 3})
+    partial = add_job(recovery, 4, "downloaded", in_size=1000)
+    lost = add_job(recovery, 5, "queued")
+    del recovery.messages[5]
+
+    asyncio.run(main.recover_jobs())
+
+    assert stages(recovery.journal) == {encoded: "encoded", no_output: "downloaded", nothing: "queued", partial: "queued", lost: "failed"}
+    resumed = {job.id: job for job in recovery.scheduler.jobs}
+    assert sorted(resumed) == [encoded, no_output, nothing, partial]
+    assert resumed[encoded].result == {"duration": 3}
+    assert resumed[no_output].stage == "downloaded"
+    assert os.path.exists(resumed[encoded].out_path)  # files of live jobs survive the startup sweep
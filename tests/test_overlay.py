@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+
+import main
+
+
+def test_overlays_are_rendered_once_and_shared():
+    cache = main.OverlayCache(max_overlays=4, max_fonts=2)
+    path, w, h = cache.acquire("shared", "static", 40)
+    assert os.path.exists(path) and h == 40 and w > 0
+    assert cache.acquire("shared", "static", 40) == (path, w, h)
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.release(path)
+    cache.release(path)
+    assert os.path.exists(path)  # unreferenced but still cached
+
+
+def test_font_cache_is_bounded():
+    cache = main.OverlayCache(max_overlays=4, max_fonts=2)
+    for size in (10, 20, 30):
+        cache.font("static", size)
+    assert list(cache.fonts) == [("static", 20), ("static", 30)]
+
+
+def test_evicted_overlay_survives_until_released():
+    cache = main.OverlayCache(max_overlays=1, max_fonts=2)
+    a, _, _ = cache.acquire("evict-a", "moving", 30)
+    b, _, _ = cache.acquire("evict-b", "moving", 30)  # pushes `a` out while a job still uses it
+    assert os.path.exists(a)
+    cache.release(a)
+    assert not os.path.exists(a)
+    cache.release(b)
+    c, _, _ = cache.acquire("evict-c", "moving", 30)  # `b` is unreferenced: deleted right away
+    assert not os.path.exists(b)
+    cache.release(c)
+
+
+def test_leftover_overlays_are_adopted_under_the_cap(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "SCRATCH_DIR", str(tmp_path))
+    old = main.OverlayCache(max_overlays=4, max_fonts=2)
+    kept, _, _ = old.acquire("kept", "static", 20)
+    for i, text in enumerate(("stale-a", "stale-b", "stale-c")):
+        path, _, _ = old.acquire(text, "static", 20)
+        os.utime(path, (i, i))  # older than `kept`
+    cache = main.OverlayCache(max_overlays=2, max_fonts=2)
+    cache.adopt()
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in (old._path_for(("stale-c", "static", 20, 1.0)), kept))
+    assert cache.acquire("kept", "static", 20)[0] == kept  # reused from disk, no longer spare
+    cache.acquire("fresh", "static", 20)  # the remaining spare goes first
+    assert len(os.listdir(tmp_path)) == 2 and os.path.exists(kept)
+
+
+def test_alpha_blend_mixes_and_clips():
+    base = np.full((4, 4, 3), 100, np.uint8)
+    overlay = np.zeros((2, 2, 4), np.uint8)
+    overlay[..., :3] = 200
+    overlay[0, 0, 3] = 255   # opaque
+    overlay[0, 1, 3] = 0     # transparent
+    overlay[1, :, 3] = 128   # about half
+    main.alpha_blend(base, overlay, 3, 3)  # only overlay[0, 0] lands inside the frame
+    assert base[3, 3].tolist() == [200] * 3
+    assert int(base[:3].sum() + base[3, :3].sum()) == 100 * 3 * 15
+
+    base = np.full((4, 4, 3), 100, np.uint8)
+    main.alpha_blend(base, overlay, 0, 0)
+    assert base[0, 0].tolist() == [200] * 3
+    assert base[0, 1].tolist() == [100] * 3
+    assert base[1, 0].tolist() == [150] * 3
+    main.alpha_blend(base, overlay, 10, 10)  # fully outside: untouched
+    assert base[2:].tolist() == [[[100] * 3] * 4] * 2
@@ -0,0 +1,89 @@
+import main
+
+
+def session(**kw):
+    return main.UserSession(user_id=1, **kw)
+
+
+def test_plan_segments_cuts_at_nearest_keyframes():
+    assert main.plan_segments([0.0, 9.5, 20.5, 29.0], 40.0, 4) == [(0.0, 9.5), (9.5, 20.5), (20.5, 29.0), (29.0, 40.0)]
+
+
+def test_plan_segments_skips_cuts_too_close_together():
+    # No keyframes -> one segment; keyframes near the ends are never used as cuts
+    assert main.plan_segments([], 30.0, 3) == [(0.0, 30.0)]
+    assert main.plan_segments([0.5, 29.5], 30.0, 2) == [(0.0, 30.0)]
+
+
+def test_plan_keeps_even_frame_at_or_below_target():
+    info = main.MediaInfo(width=1280, height=720, vcodec="h264", acodec="aac", fps="30/1", cfr=True)
+    plan = main.plan_encode(info, session(resolution=1080))
+    assert (plan.height, plan.scale) == (720, False)
+    assert plan.audio_args == ["-c:a", "copy"]
+    assert plan.fps_args == ["-r", "30/1"]
+
+
+def test_plan_never_upscales_and_evens_odd_heights():
+    plan = main.plan_encode(main.MediaInfo(width=853, height=481, vcodec="h264"), session(resolution=720))
+    assert (plan.height, plan.scale) == (480, True)
+    plan = main.plan_encode(main.MediaInfo(width=1920, height=1080, vcodec="h264"), session(resolution=720))
+    assert (plan.height, plan.scale) == (720, True)
+
+
+def test_plan_drops_missing_audio():
+    plan = main.plan_encode(main.MediaInfo(width=640, height=360, vcodec="h264"), session())
+    assert plan.audio_args == []
+    assert plan.fps_args == []
+
+
+def test_plan_unprobed_scales_to_session():
+    plan = main.plan_encode(main.MediaInfo(), session(resolution=480))
+    assert (plan.height, plan.scale) == (480, True)
+
+
+def test_plan_copies_audio_only_when_every_track_is_aac():
+    info = main.MediaInfo(width=640, height=360, vcodec="h264", acodec="aac", acodecs=["aac", "opus"])
+    assert main.plan_encode(info, session()).audio_args == ["-c:a", "aac", "-b:a", "128k"]
+    info.acodecs = ["aac", "aac"]
+    assert main.plan_encode(info, session()).audio_args == ["-c:a", "copy"]
+
+
+def test_plan_from_telegram_size_reencodes_audio():
+    # Size from Telegram's metadata only: the streams are unknown
+    plan = main.plan_encode(main.MediaInfo(width=640, height=360), session())
+    assert (plan.height, plan.scale) == (360, False)
+    assert plan.audio_args == ["-c:a", "aac", "-b:a", "128k"]
+
+
+def test_rendition_targets():
+    targets = main.rendition_targets("/w/out_1_2.mp4", [480, 1080, 720, 480])
+    assert targets == {"/w/out_1_2.mp4": 1080, "/w/out_1_2_720p.mp4": 720, "/w/out_1_2_480p.mp4": 480}
+
+
+def test_adapt_encode_picks_slowest_preset_that_fits(monkeypatch):
+    model = main.EncodeModel("")
+    monkeypatch.setattr(main, "encode_model", model)
+    sess = session(codec="libx264", preset="medium", crf=23)
+    info = main.MediaInfo(width=1280, height=720, duration=60.0)
+    same, predicted = main.adapt_encode(sess, info, [720], 4, None)
+    assert same is sess and predicted > 0
+
+    # Between two presets' predictions: the faster one is chosen
+    pixels = main.encode_pixels(info, [720])
+    fast = model.predict("libx264", "veryfast", 23, pixels, 4)
+    faster = model.predict("libx264", "superfast", 23, pixels, 4)
+    choice, _ = main.adapt_encode(sess, info, [720], 4, (fast + faster) / 2)
+    assert (choice.preset, choice.crf) == ("superfast", 23)
+
+    # Nothing fits: ultrafast with CRF raised, capped at ADAPTIVE_MAX_CRF
+    choice, _ = main.adapt_encode(sess, info, [720], 4, 0.001)
+    assert (choice.preset, choice.crf) == ("ultrafast", 23 + main.ADAPTIVE_MAX_CRF)
+
+
+def test_encode_model_learns_from_observed_encodes():
+    model = main.EncodeModel("")
+    before = model.predict("libx264", "fast", 23, 1e9, 2)
+    model.observe("libx264", "fast", 23, 1e9, 2, seconds=before * 2, predicted=before)
+    assert abs(model.predict("libx264", "fast", 23, 1e9, 2) - before * 2) < 1e-6
+    # Unmeasured presets scale from the measured one
+    assert model.predict("libx264", "ultrafast", 23, 1e9, 2) < before * 2
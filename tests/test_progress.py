@@ -0,0 +1,62 @@
+import asyncio
+from types import SimpleNamespace
+
+import main
+
+
+def test_progress_parser_emits_one_update_per_block():
+    p = main.ProgressParser()
+    lines = ["frame=120", "fps=59.9", "out_time_us=4000000", "speed=2.01x", "progress=continue"]
+    updates = [p.feed(line) for line in lines]
+    assert updates[:-1] == [None] * 4
+    u = updates[-1]
+    assert (u.frame, u.fps, u.time, u.speed, u.done) == (120, 59.9, 4.0, 2.01, False)
+    for line in ["out_time_us=N/A", "speed=N/A", "progress=end"]:
+        u = p.feed(line)
+    assert (u.time, u.speed, u.done) == (0.0, 0.0, True)
+    assert p.feed("not a key value line") is None
+
+
+class FakeMessage:
+    def __init__(self, mid):
+        self.chat, self.id = SimpleNamespace(id=1), mid
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append(text)
+
+
+def test_status_dispatcher_keeps_only_newest_text():
+    async def run():
+        disp = main.StatusDispatcher(per_message=0.2, global_interval=0)
+        msg = FakeMessage(1)
+        disp.post(msg, "a")
+        await asyncio.sleep(0.05)
+        for text in ("b", "c", "d"):
+            disp.post(msg, text)
+        await asyncio.sleep(0.05)
+        held = list(msg.edits)
+        await asyncio.sleep(0.3)
+        disp.post(msg, "d")  # same as the last edit: nothing to send
+        await asyncio.sleep(0.3)
+        disp.task.cancel()
+        return held, msg.edits
+
+    held, edits = asyncio.run(run())
+    assert held == ["a"]
+    assert edits == ["a", "d"]
+
+
+def test_status_dispatcher_urgent_skips_the_per_message_wait():
+    async def run():
+        disp = main.StatusDispatcher(per_message=10, global_interval=0)
+        msg = FakeMessage(1)
+        disp.post(msg, "progress")
+        await asyncio.sleep(0.05)
+        disp.post(msg, "more progress")
+        disp.post(msg, "done", urgent=True)
+        await asyncio.sleep(0.05)
+        disp.task.cancel()
+        return msg.edits
+
+    assert asyncio.run(run()) == ["progress", "done"]
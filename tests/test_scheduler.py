@@ -0,0 +1,129 @@
+import asyncio
+from collections import deque
+
+import main
+
+
+def queue(sched, *uids):
+    # Jobs straight into the pending queues, in arrival order (nothing is dispatched)
+    jobs = []
+    for uid in uids:
+        job = main.Job(uid, message=None)
+        sched.pending.setdefault(uid, deque()).append(job)
+        jobs.append(job)
+    return jobs
+
+
+def test_order_is_owner_first_then_round_robin():
+    sched = main.EncodeScheduler(2)
+    a1, a2, a3, b1, o1, c1, b2 = queue(sched, 10, 10, 10, 20, main.OWNER_ID, 30, 20)
+    assert sched._order() == [o1, a1, b1, c1, a2, b2, a3]
+    assert sched.position(a2) == 5
+    assert sched.position(main.Job(10, message=None)) == 0  # not queued = running
+
+
+def test_take_moves_user_to_back_of_the_turn():
+    sched = main.EncodeScheduler(2)
+    a1, a2, b1 = queue(sched, 10, 10, 20)
+    assert sched._peek() is a1
+    sched._take(a1)
+    assert sched._peek() is b1
+    assert sched._order() == [b1, a2]
+
+
+def test_estimated_wait_counts_encode_slots():
+    sched = main.EncodeScheduler(4, encode_slots=2)
+    sched.avg_encode_time = 60.0
+    jobs = queue(sched, 10, 20, 30)
+    assert [sched.estimated_wait(j) for j in jobs] == [0.0, 0.0, 60.0]
+    sched.encoding = [main.Job(40, message=None), main.Job(40, message=None)]  # both encoders busy
+    assert [sched.estimated_wait(j) for j in jobs] == [60.0, 60.0, 120.0]
+
+
+def test_running_jobs_still_need_their_encoder():
+    # Admitted jobs that are still downloading are ahead of the queue, and their users see it
+    sched = main.EncodeScheduler(4, encode_slots=1)
+    sched.avg_encode_time = 60.0
+    downloading = main.Job(10, message=None)
+    done = main.Job(10, message=None, encoded=True)
+    sched.active = [downloading, done]
+    sched.encoding = [main.Job(20, message=None)]
+    (queued,) = queue(sched, 30)
+    assert sched._order() == [downloading, queued]
+    assert sched.position(downloading) == 1 and sched.estimated_wait(downloading) == 60.0
+    assert sched.position(queued) == 2 and sched.estimated_wait(queued) == 120.0
+    assert sched.position(done) == 0
+
+
+def test_encode_slot_caps_concurrent_encodes():
+    async def run():
+        sched = main.EncodeScheduler(4, encode_slots=2)
+        peak = 0
+
+        async def encode(job):
+            nonlocal peak
+            async with sched.encode_slot(job):
+                peak = max(peak, sched.encoding_now)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(encode(main.Job(uid, message=None)) for uid in range(5)))
+        return peak, sched.encoding_now
+
+    assert asyncio.run(run()) == (2, 0)
+
+
+def test_encoders_go_owner_first_then_round_robin():
+    async def run():
+        sched = main.EncodeScheduler(8, encode_slots=1)
+        started = []
+        release = asyncio.Event()
+
+        async def encode(job):
+            async with sched.encode_slot(job):
+                started.append(job)
+                await release.wait()
+                release.clear()
+
+        first = main.Job(10, message=None)
+        tasks = [asyncio.create_task(encode(first))]
+        await asyncio.sleep(0)
+        later = [main.Job(uid, message=None) for uid in (10, 10, 10, 20, main.OWNER_ID)]
+        for job in later:
+            tasks.append(asyncio.create_task(encode(job)))
+            await asyncio.sleep(0)
+        order = sched._order()
+        positions = [sched.position(j) for j in later]
+        while len(started) < 6:
+            release.set()
+            await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(*tasks)
+        return started, order, positions, later
+
+    started, order, positions, (a1, a2, a3, b1, owner) = asyncio.run(run())
+    assert started[1:] == [owner, a1, b1, a2, a3]
+    assert order == [owner, a1, b1, a2, a3]
+    assert positions == [2, 4, 5, 3, 1]
+
+
+def test_cancelled_wait_gives_up_its_place():
+    async def run():
+        sched = main.EncodeScheduler(8, encode_slots=1)
+        hold = asyncio.Event()
+
+        async def encode(job):
+            async with sched.encode_slot(job):
+                await hold.wait()
+
+        a, b, c = (main.Job(uid, message=None) for uid in (10, 20, 30))
+        tasks = [asyncio.create_task(encode(j)) for j in (a, b, c)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        await asyncio.sleep(0)
+        assert sched._order() == [c]
+        hold.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return sched
+
+    sched = asyncio.run(run())
+    assert sched.encoding_now == 0 and not sched.waiting
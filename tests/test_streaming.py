@@ -0,0 +1,117 @@
+import asyncio
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+
+def box(kind: bytes, size: int) -> bytes:
+    return size.to_bytes(4, "big") + kind + b"\0" * (size - 8)
+
+
+def test_matroska_and_mpegts_stream():
+    assert main.is_streamable(b"\x1a\x45\xdf\xa3" + b"\0" * 60)
+    ts = bytearray(400)
+    ts[0] = ts[188] = 0x47
+    assert main.is_streamable(bytes(ts))
+
+
+def test_mp4_streams_only_with_moov_first():
+    assert main.is_streamable(box(b"ftyp", 24) + box(b"moov", 16) + box(b"mdat", 16))
+    assert not main.is_streamable(box(b"ftyp", 24) + box(b"mdat", 16) + box(b"moov", 16))
+    assert not main.is_streamable(box(b"ftyp", 24) + box(b"free", 4))  # corrupt box size
+    assert not main.is_streamable(b"\0" * 64)
+
+
+class FakeStdin:
+    def __init__(self):
+        self.data, self.closed = b"", False
+
+    def write(self, chunk):
+        self.data += chunk
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def stream(monkeypatch, tmp_path):
+    # stream_and_process with the download and ffmpeg faked: the piped encode always fails
+    state = SimpleNamespace(chunks=[], stdin=FakeStdin(), calls=[], events=[])
+
+    async def download_chunks(message, *args):
+        for chunk in state.chunks:
+            if isinstance(chunk, Exception): raise chunk
+            state.events.append("chunk")
+            yield chunk
+
+    @contextlib.asynccontextmanager
+    async def slot():
+        state.events.append("slot")
+        yield
+
+    async def probe_media(path, head=None):
+        return main.MediaInfo()
+
+    async def process_video(in_path, text, out_path, sess, status_msg, feed=None, **kw):
+        state.calls.append("piped" if feed else "file")
+        state.events.append(state.calls[-1])
+        if not feed: return main.EncodeResult(ok=True)
+        try: await feed(state.stdin)
+        except ConnectionError: pass
+        return main.EncodeResult(error="stalled")
+
+    monkeypatch.setattr(main, "download_chunks", download_chunks)
+    monkeypatch.setattr(main, "probe_media", probe_media)
+    monkeypatch.setattr(main, "process_video", process_video)
+
+    def run(size):
+        message = SimpleNamespace(video=SimpleNamespace(file_size=size, duration=10, width=640, height=360), document=None)
+        dl_path = str(tmp_path / "in.mkv")
+        return asyncio.run(main.stream_and_process(message, dl_path, str(tmp_path / "out.mp4"), main.UserSession(user_id=1), None, main.JobTimer(record=False), slot))
+
+    state.run = run
+    return state
+
+
+MKV_HEAD = b"\x1a\x45\xdf\xa3" + b"\0" * 60
+
+
+def test_failed_download_is_not_encoded_from_the_partial_file(stream):
+    stream.chunks = [MKV_HEAD, b"x" * 100, ConnectionError("dropped")]
+    in_path, result = stream.run(size=64 + 1000)
+    assert in_path is None and not result
+    assert stream.stdin.closed  # ffmpeg got EOF instead of waiting for the watchdog
+    assert stream.calls == ["piped"]
+
+
+def test_failed_piped_encode_falls_back_to_the_complete_file(stream):
+    stream.chunks = [MKV_HEAD, b"x" * 100]
+    in_path, result = stream.run(size=164)
+    assert in_path and result
+    assert stream.calls == ["piped", "file"]
+    assert stream.stdin.data == MKV_HEAD + b"x" * 100
+
+
+def test_size_mismatch_is_not_a_complete_download(stream):
+    stream.chunks = [MKV_HEAD, b"x" * 100]
+    assert stream.run(size=5000)[0] is None
+    assert stream.calls == ["piped"]
+
+
+def test_unstreamable_source_is_downloaded_before_taking_the_encode_slot(stream):
+    stream.chunks = [b"\0" * 64, b"x" * 100]  # no container we can stream
+    in_path, result = stream.run(size=164)
+    assert in_path and result
+    assert stream.events == ["chunk", "chunk", "slot", "file"]
+
+
+def test_streamed_download_continues_inside_the_encode_slot(stream):
+    stream.chunks = [MKV_HEAD, b"x" * 100]
+    stream.run(size=164)
+    assert stream.events[:3] == ["chunk", "slot", "piped"]
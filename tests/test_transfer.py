@@ -0,0 +1,57 @@
+import asyncio
+import random
+
+import main
+
+
+def make_file(path, size) -> bytes:
+    data = random.Random(size).randbytes(size)
+    path.write_bytes(data)
+    return data
+
+
+async def read_all(transport, path, size, window):
+    return b"".join([chunk async for chunk in main.parallel_stream(transport, path, size, window=window)])
+
+
+def test_parallel_stream_yields_the_file_in_order(tmp_path):
+    data = make_file(tmp_path / "src", 3 * main.DOWNLOAD_PART_SIZE + 12345)
+    transport = main.LocalTransport(latency=0.01)
+    assert asyncio.run(read_all(transport, str(tmp_path / "src"), len(data), 3)) == data
+    assert transport.requests == 4
+    assert transport.peak_in_flight == 3  # never more than the window ahead
+
+
+class DropsEachPartOnce(main.LocalTransport):
+    def __init__(self):
+        super().__init__(latency=0.001)
+        self.dropped = set()
+
+    async def get_part(self, location, offset, limit):
+        if offset not in self.dropped:
+            self.dropped.add(offset)
+            raise ConnectionError("connection reset")
+        return await super().get_part(location, offset, limit)
+
+
+def test_parallel_stream_retries_failed_parts(tmp_path):
+    data = make_file(tmp_path / "src", 2 * main.DOWNLOAD_PART_SIZE)
+    transport = DropsEachPartOnce()
+    assert asyncio.run(read_all(transport, str(tmp_path / "src"), len(data), 2)) == data
+    assert len(transport.dropped) == 2
+
+
+def test_parallel_upload_saves_every_part_once(tmp_path):
+    size = 5 * main.UPLOAD_PART_SIZE + 1
+    make_file(tmp_path / "out", size)
+    transport = main.LocalTransport(latency=0.005)
+    sent = []
+
+    async def progress(done, total):
+        sent.append((done, total))
+
+    file_id, parts = asyncio.run(main.parallel_upload(transport, str(tmp_path / "out"), window=4, progress=progress))
+    assert parts == 6
+    assert transport.saved[file_id] == {**{i: main.UPLOAD_PART_SIZE for i in range(5)}, 5: 1}
+    assert transport.requests == 6 and transport.peak_in_flight == 4
+    assert sent[-1] == (size, size)
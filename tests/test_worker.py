@@ -0,0 +1,29 @@
+import asyncio
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait
+
+import main
+
+
+def test_floodwait_on_the_status_message_still_records_the_job(monkeypatch):
+    journal = main.JobJournal(":memory:")
+    sent = []
+
+    async def send_message(*args):
+        sent.append(args)
+        raise FloodWait(value=0)
+
+    monkeypatch.setattr(main, "journal", journal)
+    monkeypatch.setattr(main.app, "send_message", send_message)
+    video = SimpleNamespace(file_name="clip.mp4", file_size=1000, file_unique_id=None, duration=5)
+    message = SimpleNamespace(chat=SimpleNamespace(id=5), id=9, video=video, document=None, caption=None)
+    sess = main.UserSession(user_id=5)
+    job = main.Job(5, message, sess=sess, journal_id=journal.add(5, message, sess))
+    errors = main.metrics.jobs.get("error", 0)
+
+    asyncio.run(main.worker(job))  # must not raise
+
+    assert len(sent) == 3  # retried before giving up
+    assert journal.db.execute("SELECT stage FROM jobs").fetchone() == ("failed",)
+    assert main.metrics.jobs["error"] == errors + 1
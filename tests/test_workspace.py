@@ -0,0 +1,79 @@
+import os
+import shutil
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def free(monkeypatch):
+    # Pin the free space the workspace sees
+    state = {"free": 10_000}
+    usage = shutil.disk_usage(main.WORK_DIR)
+    monkeypatch.setattr(main.shutil, "disk_usage", lambda root: usage._replace(free=state["free"]))
+    return state
+
+
+def write(path, nbytes):
+    with open(path, "wb") as f: f.write(b"\0" * nbytes)
+    return path
+
+
+def test_reservations_count_until_written(free):
+    ws = main.Workspace(main.WORK_DIR, headroom=1_000, quota=0)
+    a = ws.try_reserve("a", 6_000)
+    assert a is not None
+    assert ws.available() == 3_000
+    assert ws.try_reserve("b", 4_000) is None
+
+    # Bytes on disk come off the reservation and out of `free`, so availability holds steady
+    path = write(os.path.join(main.WORK_DIR, "out_test_a.mp4"), 2_000)
+    a.track(path)
+    free["free"] -= 2_000
+    assert ws.available() == 3_000
+
+    a.close()
+    assert not os.path.exists(path) and "a" not in ws.active
+    free["free"] += 2_000
+    assert ws.try_reserve("b", 4_000) is not None
+
+
+def test_quota_caps_total_reservations(free):
+    ws = main.Workspace(main.WORK_DIR, headroom=0, quota=5_000)
+    assert ws.try_reserve("a", 3_000) is not None
+    assert ws.try_reserve("b", 3_000) is None
+    assert ws.could_ever_fit(3_000)
+    assert not ws.could_ever_fit(6_000)
+
+
+def test_could_ever_fit_counts_space_running_jobs_will_free(free):
+    ws = main.Workspace(main.WORK_DIR, headroom=1_000, quota=0)
+    with ws.try_reserve("a", 8_000) as a:
+        a.track(write(os.path.join(main.WORK_DIR, "in_test_b.mp4"), 4_000))
+        free["free"] -= 4_000
+        # Blocked now, but fits once `a` is done and its 4000 bytes are deleted
+        assert ws.try_reserve("b", 7_000) is None
+        assert ws.could_ever_fit(9_000)
+        assert not ws.could_ever_fit(9_001)
+
+
+def test_sweep_keeps_live_jobs_files_in_both_roots():
+    live_in = os.path.join(main.WORK_DIR, "in_5_7.mp4")
+    live_out = os.path.join(main.WORK_DIR, "out_5_7.mp4")
+    keep = [
+        write(live_in, 1),
+        write(live_out, 1),
+        write(os.path.join(main.WORK_DIR, "out_5_7_480p.mp4"), 1),  # rendition of a live job
+        write(os.path.join(main.SCRATCH_DIR, "out_5_7.mp4.jpg"), 1),  # its thumbnail on scratch
+        write(os.path.join(main.WORK_DIR, "wm_static.png"), 1),       # not a per-job artifact
+    ]
+    gone = [
+        write(os.path.join(main.WORK_DIR, "in_5_6.mp4"), 1),
+        write(os.path.join(main.SCRATCH_DIR, "out_5_6.mp4.jpg"), 1),
+        write(os.path.join(main.WORK_DIR, "partial.tmp"), 1),
+    ]
+    main.Workspace(main.WORK_DIR, 0, 0).sweep({live_in, live_out})
+    assert all(os.path.exists(p) for p in keep)
+    assert not any(os.path.exists(p) for p in gone)
+    for p in keep: os.remove(p)
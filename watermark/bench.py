@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Encode benchmark – runs the real process_video pipeline on synthetic lavfi clips
+#
+#   suite     sweep modes x codecs x CRF x presets x clips, write JSON for commit-to-commit comparison
+#             python watermark/bench.py suite --res 480 720 --durations 10 30 --out bench.json
+#   compare   diff two suite results:  python watermark/bench.py compare old.json new.json
+#   segments  single-pass vs segment-parallel on one long clip
+#             python watermark/bench.py segments --duration 600 --res 720
+#   transfer  parallel part download/upload against a local stand-in with injected latency and failures
+#             python watermark/bench.py transfer --size-mb 256 --windows 1 4 8 16 --latency 0.08
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import hashlib
+import platform
+import itertools
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Keep benchmark encodes out of the bot's job journal and its measured encode speeds
+os.environ.setdefault("JOURNAL_DB", ":memory:")
+os.environ.setdefault("ENCODE_MODEL_FILE", "")
+import main
+
+CLIP_FPS = 30
+
+def make_clip(path, duration, height, fps=CLIP_FPS, faststart=False):
+    # testsrc2 + sine, keyframe every 2s like a typical phone upload (moov at the end, unless faststart)
+    width = (height * 16 // 9) // 2 * 2
+    cmd = [
+        "ffmpeg", "-y", "-f", "lavfi", "-i", f"testsrc2=size={width}x{height}:rate={fps}",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000", "-t", str(duration),
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(fps * 2), "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k", *(["-movflags", "+faststart"] if faststart else []), path
+    ]
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def clip_path(height, duration, faststart=False):
+    path = os.path.join(main.WORK_DIR, f"bench_{height}p_{duration}s{'_fs' if faststart else ''}.mp4")
+    if not os.path.exists(path):
+        print(f"Generating {path} ...", file=sys.stderr)
+        make_clip(path, duration, height, faststart=faststart)
+    return path
+
+def make_session(case):
+    return main.UserSession(
+        0, watermark_text=case.get("text", "benchmark"), watermark_mode=case["mode"],
+        codec=case["codec"], crf=case["crf"], preset=case["preset"], resolution=case["res"],
+    )
+
+# --- one case per child process, so CPU time and peak RSS belong to that case only ---
+async def run_case(case):
+    main.SEGMENT_MODE = case.get("segmented", False)
+    if main.SEGMENT_MODE: main.SEGMENT_MIN_DURATION = 0
+    out_path = os.path.join(main.WORK_DIR, f"bench_out_{os.getpid()}.mp4")
+    start = time.perf_counter()
+    result = await main.process_video(case["clip"], case.get("text", "benchmark"), out_path, make_session(case), None)
+    wall = time.perf_counter() - start
+    size = os.path.getsize(out_path) if os.path.exists(out_path) else 0
+    if os.path.exists(out_path): os.remove(out_path)
+    return {"ok": bool(result), "wall_s": round(wall, 3), "output_bytes": size}
+
+def measure(case):
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "_case", json.dumps(case)], stdout=subprocess.PIPE)
+    out = proc.stdout.read()
+    _, _, usage = os.wait4(proc.pid, 0)
+    try: row = json.loads(out.decode().strip().splitlines()[-1])
+    except (ValueError, IndexError): row = {"ok": False, "wall_s": 0, "output_bytes": 0}
+    frames = case["duration"] * CLIP_FPS
+    row.update({
+        "fps": round(frames / row["wall_s"], 2) if row["wall_s"] else 0,
+        "cpu_s": round(usage.ru_utime + usage.ru_stime, 3),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),  # KiB on Linux; largest of python + ffmpeg
+    })
+    return row
+
+def environment():
+    def cmd_out(cmd):
+        try: return subprocess.run(cmd, capture_output=True, text=True).stdout.splitlines()[0]
+        except Exception: return ""
+    return {
+        "commit": cmd_out(["git", "rev-parse", "--short", "HEAD"]),
+        "ffmpeg": cmd_out(["ffmpeg", "-version"]),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "timestamp": int(time.time()),
+    }
+
+def case_key(r):
+    return f"{r['mode']}/{r['codec']}/crf{r['crf']}/{r['preset']}/{r['res']}p/{r['duration']}s"
+
+def suite(args):
+    results = []
+    grid = list(itertools.product(args.res, args.durations, args.modes, args.codecs, args.crfs, args.presets))
+    for i, (res, dur, mode, codec, crf, preset) in enumerate(grid, 1):
+        case = {"clip": clip_path(res, dur), "res": res, "duration": dur, "mode": mode, "codec": codec, "crf": crf, "preset": preset}
+        row = {k: v for k, v in case.items() if k != "clip"}
+        row.update(measure(case))
+        results.append(row)
+        print(f"[{i}/{len(grid)}] {case_key(row):45s} {row['wall_s']:7.2f}s {row['fps']:7.1f}fps "
+              f"cpu {row['cpu_s']:7.2f}s rss {row['peak_rss_mb']:6.1f}MB {row['output_bytes'] / 1e6:6.2f}MB"
+              f"{'' if row['ok'] else '  FAILED'}")
+    with open(args.out, "w") as f:
+        json.dump({"env": environment(), "results": results}, f, indent=2)
+    print(f"Wrote {args.out}")
+
+def compare(args):
+    with open(args.old) as f: old = {case_key(r): r for r in json.load(f)["results"]}
+    with open(args.new) as f: new = {case_key(r): r for r in json.load(f)["results"]}
+    for key in sorted(old.keys() & new.keys()):
+        a, b = old[key], new[key]
+        delta = (b["wall_s"] - a["wall_s"]) / a["wall_s"] * 100 if a["wall_s"] else 0
+        size = (b["output_bytes"] - a["output_bytes"]) / a["output_bytes"] * 100 if a["output_bytes"] else 0
+        print(f"{key:45s} wall {a['wall_s']:7.2f}s -> {b['wall_s']:7.2f}s ({delta:+6.1f}%)  size {size:+6.1f}%")
+    for key in sorted(old.keys() ^ new.keys()):
+        print(f"{key:45s} only in {'old' if key in old else 'new'}")
+
+def segments(args):
+    clip = clip_path(args.res, args.duration)
+    if args.workers: os.environ["SEGMENT_WORKERS"] = str(args.workers)
+    base = {"clip": clip, "res": args.res, "duration": args.duration, "mode": args.mode, "codec": args.codec, "crf": args.crf, "preset": args.preset}
+    single = measure(base)
+    print(f"single    : {single['wall_s']:8.2f}s  ok={single['ok']}  cpu {single['cpu_s']:.1f}s")
+    multi = measure({**base, "segmented": True})
+    print(f"segmented : {multi['wall_s']:8.2f}s  ok={multi['ok']}  cpu {multi['cpu_s']:.1f}s")
+    if multi["wall_s"]: print(f"speedup   : {single['wall_s'] / multi['wall_s']:.2f}x")
+
+async def transfer_case(src, size, window, args):
+    down = main.LocalTransport(args.latency, fail_rate=args.fail_rate)
+    digest = hashlib.sha1()
+    start = time.perf_counter()
+    async for chunk in main.parallel_stream(down, src, size, window): digest.update(chunk)
+    down_s = time.perf_counter() - start
+    up = main.LocalTransport(args.latency, fail_rate=args.fail_rate)
+    start = time.perf_counter()
+    file_id, parts = await main.parallel_upload(up, src, window)
+    up_s = time.perf_counter() - start
+    ok = len(up.saved[file_id]) == parts and sum(up.saved[file_id].values()) == size
+    return digest.hexdigest(), ok, down_s, up_s, down, up
+
+def transfer(args):
+    size = args.size_mb * 1024 * 1024
+    src = os.path.join(main.WORK_DIR, f"bench_transfer_{args.size_mb}mb.bin")
+    if not os.path.exists(src) or os.path.getsize(src) != size:
+        with open(src, "wb") as f:
+            for _ in range(args.size_mb): f.write(os.urandom(1024 * 1024))
+    with open(src, "rb") as f: expected = hashlib.sha1(f.read()).hexdigest()
+    for window in args.windows:
+        digest, ok, down_s, up_s, down, up = asyncio.run(transfer_case(src, size, window, args))
+        print(f"window {window:3d}: down {size / 1e6 / down_s:8.1f} MB/s (peak {down.peak_in_flight}, {down.failures} retried)"
+              f"  up {size / 1e6 / up_s:8.1f} MB/s (peak {up.peak_in_flight}, {up.failures} retried)"
+              f"{'' if digest == expected and ok else '  MISMATCH'}")
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "_case":
+        print(json.dumps(asyncio.run(run_case(json.loads(sys.argv[2])))))
+        sys.exit(0)
+
+    p = argparse.ArgumentParser(description="Benchmark the watermark encode pipeline")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    s = sub.add_parser("suite", help="sweep settings and write JSON results")
+    s.add_argument("--res", type=int, nargs="+", default=[480, 720])
+    s.add_argument("--durations", type=int, nargs="+", default=[10])
+    s.add_argument("--modes", nargs="+", default=["static", "moving", "dual"], choices=["static", "moving", "dual"])
+    s.add_argument("--codecs", nargs="+", default=["libx264", "libx265"], choices=["libx264", "libx265"])
+    s.add_argument("--crfs", type=int, nargs="+", default=[23])
+    s.add_argument("--presets", nargs="+", default=["fast"])
+    s.add_argument("--out", default="bench_results.json")
+    s.set_defaults(func=suite)
+
+    c = sub.add_parser("compare", help="compare two suite JSON files")
+    c.add_argument("old")
+    c.add_argument("new")
+    c.set_defaults(func=compare)
+
+    g = sub.add_parser("segments", help="single-pass vs segment-parallel encode")
+    g.add_argument("--duration", type=int, default=300)
+    g.add_argument("--res", type=int, default=720)
+    g.add_argument("--codec", default="libx264", choices=["libx264", "libx265"])
+    g.add_argument("--crf", type=int, default=23)
+    g.add_argument("--preset", default="fast")
+    g.add_argument("--mode", default="moving", choices=["static", "moving", "dual"])
+    g.add_argument("--workers", type=int, default=0)
+    g.set_defaults(func=segments)
+
+    t = sub.add_parser("transfer", help="parallel part transfer vs window size on a local stand-in")
+    t.add_argument("--size-mb", type=int, default=128)
+    t.add_argument("--windows", type=int, nargs="+", default=[1, 4, 8, 16])
+    t.add_argument("--latency", type=float, default=0.08, help="seconds per part round trip")
+    t.add_argument("--fail-rate", type=float, default=0.02)
+    t.set_defaults(func=transfer)
+
+    args = p.parse_args()
+    args.func(args)
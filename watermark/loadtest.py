@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+# Load test – drives the bot's handlers and job pipeline with a fake Telegram client
+#
+# Only Telegram is simulated: media_handler, the scheduler, worker and the real ffmpeg pipeline all run.
+#
+#   python watermark/loadtest.py --profile burst --users 50 --videos 3
+#   python watermark/loadtest.py --profile ramp --users 20 --ramp 60 --latency 0.2 --bandwidth 20 --flood-rate 0.02
+#   python watermark/loadtest.py --profile poisson --users 30 --rate 0.5 --save-profile traffic.json   (write, don't run)
+#   python watermark/loadtest.py --replay traffic.json --out report.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+main = bench = FloodWait = None  # imported by load_bot() once the environment points at the scratch dir
+
+def load_bot(workdir):
+    # main reads its config at import time, so the environment has to be set first
+    global main, bench, FloodWait
+    os.environ.update({
+        "WORK_DIR": workdir,
+        "JOURNAL_DB": os.path.join(workdir, "jobs.db"),
+        "JOB_LOG_FILE": os.path.join(workdir, "jobs.jsonl"),
+        "METRICS_FILE": "",
+        "METRICS_PORT": "0",
+        "TRANSFER_WINDOW": "0",  # the parallel path needs a real MTProto session
+    })
+    import main as bot
+    import bench as clips
+    from pyrogram.errors import FloodWait as flood
+    main, bench, FloodWait = bot, clips, flood
+
+# --- fake Telegram ---
+class FakeMessage:
+    def __init__(self, client, chat_id, text="", video=None, caption=None, command=None):
+        self.client = client
+        self.id = next(client.message_ids)
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=chat_id)
+        self.text = text
+        self.command = command
+        self.video = video
+        self.document = self.photo = self.media_group_id = None
+        self.caption = SimpleNamespace(html=caption) if caption else None
+
+    async def reply(self, text, **kw):
+        return await self.client.send_message(self.chat.id, text)
+
+    async def edit_text(self, text, **kw):
+        await self.client.rpc()
+        self.client.edits += 1
+        self.text = text
+
+    async def delete(self):
+        await self.client.rpc(flood=False)
+
+class FakeClient:
+    """Stands in for the pyrogram Client: serves synthetic media, records what the bot sends,
+    and adds request latency, transfer time and random FloodWait to every call."""
+
+    def __init__(self, latency, bandwidth, flood_rate, flood_seconds):
+        self.latency = latency
+        self.bandwidth = bandwidth * 1e6  # MB/s -> B/s
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        self.delivered = {}  # caption -> time the last output for it arrived
+        self.out_bytes = 0
+        self.edits = 0
+        self.floods = 0
+
+    async def rpc(self, nbytes=0, flood=True):
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5) + nbytes / self.bandwidth)
+        # Telegram rate-limits sends and edits, not file parts
+        if flood and random.random() < self.flood_rate:
+            self.floods += 1
+            raise FloodWait(value=self.flood_seconds)
+
+    async def send_message(self, chat_id, text, **kw):
+        await self.rpc()
+        return FakeMessage(self, chat_id, text)
+
+    async def download_media(self, message, file_name=None, progress=None, progress_args=()):
+        src = message.video.path
+        size = os.path.getsize(src)
+        for i in range(1, 5):
+            await self.rpc(size / 4, flood=False)
+            if progress: await progress(size * i // 4, size, *progress_args)
+        shutil.copyfile(src, file_name)
+        return file_name
+
+    async def stream_media(self, message):
+        with open(message.video.path, "rb") as f:
+            while True:
+                chunk = f.read(1024 * 1024)
+                if not chunk: return
+                await self.rpc(len(chunk), flood=False)
+                yield chunk
+
+    async def send_video(self, chat_id, video, caption="", progress=None, progress_args=(), **kw):
+        size = os.path.getsize(video) if os.path.exists(str(video)) else 0  # else a cached file_id
+        await self.rpc(size)
+        if progress: await progress(size, size, *progress_args)
+        self.out_bytes += size
+        self.delivered[caption] = time.perf_counter()
+        sent = FakeMessage(self, chat_id, caption=caption)
+        sent.video = SimpleNamespace(file_id=f"fake-{next(self.file_ids)}")
+        return sent
+
+    async def send_photo(self, chat_id, photo, caption="", **kw):
+        await self.rpc(os.path.getsize(photo))
+        return FakeMessage(self, chat_id, caption=caption)
+
+    async def send_media_group(self, chat_id, media, **kw):
+        await self.rpc(sum(os.path.getsize(m.media) for m in media))
+        return [FakeMessage(self, chat_id) for _ in media]
+
+    async def get_messages(self, chat_id, message_ids):
+        return None
+
+# --- traffic ---
+def make_profile(args):
+    # [{"t": seconds after start, "user": id, "clip": "<height>x<seconds>", "faststart": bool, "source": earlier event (repeats)}]
+    rng = random.Random(args.seed)
+    users = [1000 + i for i in range(args.users)]
+    events = []
+    if args.profile == "poisson":
+        t = 0.0
+        for _ in range(args.users * args.videos):
+            t += rng.expovariate(args.rate)
+            events.append({"t": round(t, 3), "user": rng.choice(users), "clip": rng.choice(args.clips), "faststart": rng.random() < args.faststart})
+    else:
+        for i, uid in enumerate(users):
+            start = 0.0 if args.profile == "burst" else args.ramp * i / max(1, args.users)
+            for j in range(args.videos):
+                events.append({"t": round(start + 0.2 * j, 3), "user": uid, "clip": rng.choice(args.clips), "faststart": rng.random() < args.faststart})
+    # A share of sends repeat an earlier source, as forwards do; they should hit the result cache
+    for n, ev in enumerate(events):
+        if n and rng.random() < args.repeat:
+            ev["source"] = rng.randrange(n)
+            ev["clip"], ev["faststart"] = events[ev["source"]]["clip"], events[ev["source"]]["faststart"]
+    return sorted(events, key=lambda e: e["t"])
+
+def percentiles(values):
+    if not values: return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {"p50": round(pick(0.5), 2), "p90": round(pick(0.9), 2), "p99": round(pick(0.99), 2), "max": round(values[-1], 2)}
+
+async def run(events, args):
+    client = FakeClient(args.latency, args.bandwidth, 0.0, args.flood_seconds)  # setup below must not hit FloodWait
+    main.app = client
+    users = sorted({ev["user"] for ev in events})
+    main.AUTHORIZED_USERS.update(users)
+    for uid in users:
+        await main.set_static(client, FakeMessage(client, uid, "/ws", command=["ws"]))
+        # One shared text: with identical settings, repeated sources can hit the result cache across users
+        await main.text_handler(client, FakeMessage(client, uid, "load test"))
+    client.flood_rate = args.flood_rate
+
+    # Faststart clips (moov first) take the streaming path, the others download first
+    sources = {}
+    for spec, faststart in {(ev["clip"], ev.get("faststart", False)) for ev in events}:
+        height, seconds = (int(x) for x in spec.split("x"))
+        sources[spec, faststart] = bench.clip_path(height, seconds, faststart)
+
+    sent_at, errors = {}, []
+    start = time.perf_counter()
+
+    async def send(n, ev):
+        await asyncio.sleep(max(0.0, start + ev["t"] - time.perf_counter()))
+        path = sources[ev["clip"], ev.get("faststart", False)]
+        same = ev.get("source", n)
+        height, seconds = (int(x) for x in ev["clip"].split("x"))
+        video = SimpleNamespace(
+            file_id=f"src-{same}", file_unique_id=f"uniq-{same}", file_size=os.path.getsize(path), file_name=f"clip{n}.mp4",
+            mime_type="video/mp4", duration=seconds, width=(height * 16 // 9) // 2 * 2, height=height, path=path,
+        )
+        caption = f"lt-{n}"
+        sent_at[caption] = time.perf_counter()
+        try:
+            await main.media_handler(client, FakeMessage(client, ev["user"], video=video, caption=caption))
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+
+    await asyncio.gather(*(send(n, ev) for n, ev in enumerate(events)))
+    # Drain: batches still collecting, queued and running jobs
+    deadline = time.perf_counter() + args.timeout
+    while (main.pending_batches or main.scheduler.in_flight or main.scheduler._order()) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.5)
+    wall = time.perf_counter() - start
+
+    jobs = []
+    if os.path.exists(main.JOB_LOG_FILE):
+        with open(main.JOB_LOG_FILE) as f: jobs = [json.loads(line) for line in f if line.strip()]
+    jobs = [j for j in jobs if j.get("kind") == "video"]
+    latency = [client.delivered[c] - t for c, t in sent_at.items() if c in client.delivered]
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "videos_sent": len(events),
+        "delivered": len(latency),
+        "undelivered": len(events) - len(latency),
+        "timed_out": wall >= args.timeout,
+        "wall_s": round(wall, 2),
+        "throughput_per_min": round(len(latency) / wall * 60, 2) if wall else 0,
+        "output_mb_per_s": round(client.out_bytes / 1e6 / wall, 2) if wall else 0,
+        "e2e_latency_s": percentiles(latency),
+        "queue_wait_s": percentiles([j["queue_wait_s"] for j in jobs if "queue_wait_s" in j]),
+        "job_total_s": percentiles([j["total_s"] for j in jobs]),
+        "job_status": {s: sum(j["status"] == s for j in jobs) for s in sorted({j["status"] for j in jobs})},
+        "status_edits": client.edits,
+        "floodwaits_injected": client.floods,
+        "handler_errors": len(errors),
+        "handler_error_samples": sorted(set(errors))[:5],
+        "peak_rss_mb": round(usage_self.ru_maxrss / 1024, 1),           # KiB on Linux
+        "peak_child_rss_mb": round(usage_children.ru_maxrss / 1024, 1),  # largest single ffmpeg
+        "cpu_s": round(usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime, 1),
+    }
+
+def report(r):
+    print(f"Sent {r['videos_sent']} videos, delivered {r['delivered']} in {r['wall_s']}s"
+          f"{'  (TIMED OUT)' if r['timed_out'] else ''}")
+    print(f"Throughput      : {r['throughput_per_min']} videos/min, {r['output_mb_per_s']} MB/s out")
+    for key in ("e2e_latency_s", "queue_wait_s", "job_total_s"):
+        p = r[key]
+        if p: print(f"{key:16s}: p50 {p['p50']:8.2f}  p90 {p['p90']:8.2f}  p99 {p['p99']:8.2f}  max {p['max']:8.2f}")
+    print(f"Job outcomes    : {r['job_status']}")
+    print(f"Status edits    : {r['status_edits']}, FloodWaits injected: {r['floodwaits_injected']}, handler errors: {r['handler_errors']}")
+    for e in r["handler_error_samples"]: print(f"  {e}")
+    print(f"Peak RSS        : bot {r['peak_rss_mb']} MB, largest ffmpeg {r['peak_child_rss_mb']} MB, CPU {r['cpu_s']}s")
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Load-test the watermark bot against a fake Telegram client")
+    p.add_argument("--profile", default="burst", choices=["burst", "ramp", "poisson"])
+    p.add_argument("--replay", help="events JSON written by --save-profile")
+    p.add_argument("--save-profile", help="write the generated events here and exit")
+    p.add_argument("--users", type=int, default=50)
+    p.add_argument("--videos", type=int, default=3, help="per user (burst/ramp), or users x videos in total (poisson)")
+    p.add_argument("--ramp", type=float, default=60, help="seconds over which users join (ramp)")
+    p.add_argument("--rate", type=float, default=1.0, help="videos per second (poisson)")
+    p.add_argument("--clips", nargs="+", default=["480x10"], help="<height>x<seconds> synthetic sources")
+    p.add_argument("--repeat", type=float, default=0.0, help="share of sends that repeat an earlier source")
+    p.add_argument("--faststart", type=float, default=0.5, help="share of clips with the moov atom first (streamable)")
+    p.add_argument("--latency", type=float, default=0.1, help="seconds per API call")
+    p.add_argument("--bandwidth", type=float, default=50, help="MB/s for transfers")
+    p.add_argument("--flood-rate", type=float, default=0.0, help="chance a send/edit raises FloodWait")
+    p.add_argument("--flood-seconds", type=int, default=3)
+    p.add_argument("--timeout", type=float, default=3600, help="give up draining after this many seconds")
+    p.add_argument("--workdir", help="reuse this WORK_DIR (keeps generated clips); default is a temp dir")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--out", help="also write the report as JSON")
+    args = p.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f: events = json.load(f)
+    else:
+        events = make_profile(args)
+    if args.save_profile:
+        with open(args.save_profile, "w") as f: json.dump(events, f, indent=1)
+        print(f"Wrote {len(events)} events to {args.save_profile}")
+        sys.exit(0)
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="wm_load_")
+    os.makedirs(workdir, exist_ok=True)
+    load_bot(workdir)
+    random.seed(args.seed)
+    result = asyncio.run(run(events, args))
+    report(result)
+    if args.out:
+        with open(args.out, "w") as f: json.dump(result, f, indent=2)
+    if not args.workdir: shutil.rmtree(workdir, ignore_errors=True)
@@ -7,28 +7,129 @@ import time
 import json
 import asyncio
 import logging
+import math
 import random
+import hashlib
+import threading
+import shutil
+import signal
+import sqlite3
+import socket
+import sys
 import urllib.request
-from dataclasses import dataclass, field
-from typing import List, Set, Tuple, Optional
-from PIL import Image, ImageDraw, ImageFont
-from pyrogram import Client, filters, idle
-from pyrogram.types import Message
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from dataclasses import dataclass, field, asdict, replace
+from types import SimpleNamespace
+from typing import Dict, List, Set, Tuple, Optional
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from pyrogram import Client, filters, idle, raw, utils
+from pyrogram.types import Message, InputMediaPhoto
+from pyrogram.file_id import FileId, FileType
+from pyrogram.session import Session, Auth
 from pyrogram.errors import FloodWait, MessageNotModified
+from config import watermark_config
 
 # ==================== CONFIG ====================
 API_ID = int(os.environ.get("API_ID", "0")) 
 API_HASH = os.environ.get("API_HASH", "")
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
 OWNER_ID = int(os.environ.get("OWNER_ID", "0"))
-WORK_DIR = "downloads"
+WORK_DIR = os.path.abspath(os.environ.get("WORK_DIR", "downloads"))
+SCRATCH_DIR = os.path.abspath(os.environ.get("SCRATCH_DIR", "") or WORK_DIR)  # e.g. /dev/shm for small intermediates
 AUTH_FILE = "auth_users.json"
+ENCODE_WORKER = sys.argv[1:] == ["encode-worker"]  # `main.py encode-worker`: no bot, no journal
+
+def cgroup_cpus() -> int:
+    # Usable CPUs: the affinity mask, capped by the cgroup CPU quota (v2 cpu.max, v1 cfs_quota_us)
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max": quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f: limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f: period = int(f.read())
+            if limit > 0: quota = limit / period
+        except (OSError, ValueError): pass
+    return max(1, min(cpus, round(quota))) if quota else cpus
+
+def cgroup_memory() -> int:
+    # Bytes usable: the cgroup v2/v1 memory limit if one is set, else physical RAM
+    phys = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f: value = f.read().strip()
+        except OSError: continue
+        if value.isdigit() and int(value) < phys: return int(value)
+    return phys
+
+CPU_LIMIT = int(os.environ.get("CPU_LIMIT", "0")) or cgroup_cpus()
+MEMORY_LIMIT = int(float(os.environ.get("MEMORY_LIMIT_MB", "0")) * 1024 * 1024) or cgroup_memory()
 
 # === TUNING ===
-UPDATE_INTERVAL = 120 
+UPDATE_INTERVAL = 5  # Min seconds between edits of the same status message
+STATUS_GLOBAL_INTERVAL = 1.0  # Min seconds between any two status edits, across all jobs
+STREAM_MODE = os.environ.get("STREAM_MODE", "1") == "1"  # Encode while downloading when the container allows it
+SEGMENT_MODE = os.environ.get("SEGMENT_MODE", "0") == "1"  # Opt-in: split long inputs at keyframes and encode in parallel
+SEGMENT_MIN_DURATION = float(os.environ.get("SEGMENT_MIN_DURATION", "600"))
+SEGMENT_WORKERS = int(os.environ.get("SEGMENT_WORKERS", "0")) or max(2, CPU_LIMIT // 2)
+MAX_ENCODES = int(os.environ.get("MAX_ENCODES", "0")) or max(1, CPU_LIMIT // 2)  # ffmpeg encodes at once (here, or per encode worker)
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "0")) or min(8, CPU_LIMIT)
+ENCODE_NICE = int(os.environ.get("ENCODE_NICE", "10"))  # ffmpeg runs this much nicer than the bot; 0 = same priority
+ENCODE_IONICE = os.environ.get("ENCODE_IONICE", "1") == "1"  # Lowest best-effort disk priority for ffmpeg (needs `ionice`)
+MEMORY_CAP = 0.85  # Share of MEMORY_LIMIT all encodes together may hold before the largest is killed
+MEDIA_GROUP_WAIT = 1.0  # Seconds to collect the rest of an album before processing it
+BATCH_WAIT = float(os.environ.get("BATCH_WAIT", "2"))  # Quiet seconds that close a batch of videos; 0 = no batching
+VIDEO_PRESET = os.environ.get("VIDEO_PRESET", watermark_config.VIDEO_PRESET)  # x264/x265 preset for new sessions
+ADAPTIVE_ENCODE = os.environ.get("ADAPTIVE_ENCODE", "0") == "1"  # Pick preset/CRF per job to meet LATENCY_TARGET
+LATENCY_TARGET = float(os.environ.get("LATENCY_TARGET", "1800"))  # Seconds from queueing to encoded output
+ADAPTIVE_SLOWEST = os.environ.get("ADAPTIVE_SLOWEST", "medium")  # Slowest preset adaptive mode may pick when there is time
+ADAPTIVE_MAX_CRF = 4  # CRF steps it may add on top of the user's when even ultrafast is too slow
+# Measured encode speeds, per host (hosts differ, and a WAL database must not live on shared storage); "" = in memory only
+ENCODE_MODEL_FILE = os.environ.get("ENCODE_MODEL_FILE", os.path.join(WORK_DIR, f"encode_model_{socket.gethostname()}.json"))
+PREVIEW_SECONDS = 6  # Length of a /preview clip
+PREVIEW_HEIGHT = 360
+PREVIEW_TIMEOUT = 60
+PREVIEW_KEEP = float(os.environ.get("PREVIEW_KEEP", "600"))  # Seconds a previewed source stays on disk for /go
+OVERLAY_CACHE_SIZE = int(os.environ.get("OVERLAY_CACHE_SIZE", "32"))
+FONT_CACHE_SIZE = 8
+METRICS_FILE = os.environ.get("METRICS_FILE", os.path.join(WORK_DIR, "metrics.prom"))  # Prometheus textfile; "" disables
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # >0 also serves /metrics over HTTP
+JOB_LOG_FILE = os.environ.get("JOB_LOG_FILE", os.path.join(WORK_DIR, "jobs.jsonl"))  # One JSON line per finished job; "" disables
+JOB_LOG_MAX = int(float(os.environ.get("JOB_LOG_MAX_MB", "20")) * 1024 * 1024)  # Rotated at this size
+JOB_LOG_BACKUPS = 3
+DISK_HEADROOM = int(float(os.environ.get("DISK_HEADROOM_MB", "512")) * 1024 * 1024)  # Always left free
+WORKSPACE_QUOTA = int(float(os.environ.get("WORKSPACE_QUOTA_GB", "0")) * 1024 ** 3)  # 0 = only free space limits
+DISK_RESERVE_FACTOR = 2.2  # Bytes reserved per source byte: input + output + thumbnails/segments
+DISK_RETRY = 15  # Seconds before re-checking a job held back for space
+JOURNAL_DB = os.environ.get("JOURNAL_DB", os.path.join(WORK_DIR, "jobs.db"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL_DAYS", "30")) * 86400
+RESULT_CACHE_MAX = int(os.environ.get("RESULT_CACHE_MAX", "5000"))  # Entries (LRU beyond this)
+TRANSFER_WINDOW = int(os.environ.get("TRANSFER_WINDOW", "8"))  # Parts in flight per download/upload; 0 = pyrogram's serial helpers
+TRANSFER_MIN_SIZE = int(float(os.environ.get("TRANSFER_MIN_MB", "20")) * 1024 * 1024)  # Smaller files aren't worth a media session
+TRANSFER_RETRIES = 4  # Per part, on top of pyrogram's own reconnects
+STALL_TIMEOUT = float(os.environ.get("STALL_TIMEOUT", "120"))  # Seconds an encode may go without progress before ffmpeg is killed
+ENCODE_TIMEOUT_FACTOR = float(os.environ.get("ENCODE_TIMEOUT_FACTOR", "20"))  # Max encode wall time, as a multiple of the clip duration
+ENCODE_TIMEOUT_MIN = 600
+TRANSFER_MIN_RATE = 256 * 1024  # Bytes/s; a whole download/upload slower than this is treated as stuck
+TRANSFER_TIMEOUT_MIN = 300
+BROKER_DB = os.environ.get("ENCODE_BROKER", "")  # SQLite file shared with `main.py encode-worker` processes; "" = encode in the bot
+BROKER_HEARTBEAT = 5  # Seconds between a worker's lease renewals
+BROKER_LEASE = 30  # A task whose worker missed heartbeats this long goes to another worker
+BROKER_MAX_ATTEMPTS = 3
+BROKER_POLL = 1.0
+BROKER_RETRY_DELAY = 30  # Seconds before the worker that gave a task back may claim it again; others can at once
+FRONTEND_JOBS = int(os.environ.get("FRONTEND_JOBS", "8"))  # Jobs in flight at once; their transfers overlap, encodes wait for MAX_ENCODES
 FILENAME_SUFFIX = " 🦋Vaiᡣ𐭩Su×@pglinsan2"
 
 os.makedirs(WORK_DIR, exist_ok=True)
+os.makedirs(SCRATCH_DIR, exist_ok=True)
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
@@ -36,6 +137,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ==================== GLOBAL CONSTANTS ====================
+IONICE = shutil.which("ionice")
 RESAMPLE_MODE = getattr(Image, "Resampling", Image).LANCZOS if hasattr(Image, "Resampling") else Image.ANTIALIAS
 
 # ==================== AUTH MANAGER ====================
@@ -89,21 +191,21 @@ class UserSession:
     # Video Settings
     crf: int = 23
     resolution: int = 720
+    renditions: List[int] = field(default_factory=list)  # e.g. [1080, 720, 480] from one encode; resolution is the largest
     codec: str = "libx265"
+    preset: str = VIDEO_PRESET
     custom_thumb_path: str = None 
     
     # Animated Watermark Settings (New)
     speed: float = 1.0
     scale: float = 1.0
-
-    # System
-    queue: List[Message] = field(default_factory=list)
-    is_processing: bool = False
+    preview: bool = False  # videos get a short preview first; /go encodes the last one
 
     def reset(self):
         self.step = "waiting_text"
         self.watermark_text = ""
-        self.queue.clear()
+        drop_pending_batch(self.user_id)
+        scheduler.cancel(self.user_id)
 
 session_manager = {}
 
@@ -111,12 +213,6 @@ async def get_session(uid: int) -> UserSession:
     return session_manager.setdefault(uid, UserSession(uid))
 
 # ==================== HELPERS ====================
-def time_to_seconds(time_str):
-    try:
-        h, m, s = time_str.split(':')
-        return int(h) * 3600 + int(m) * 60 + float(s)
-    except: return 0
-
 def render_bar(current, total):
     if total == 0: return "[░░░░░░░░░░]"
     pct = int(current * 100 / total)
@@ -124,22 +220,279 @@ def render_bar(current, total):
     filled = pct // 10
     return f"[{'█' * filled}{'░' * (10 - filled)}] {pct}%"
 
-async def safe_edit(msg, text, timer_ref):
-    # We do nothing here. This disables the progress bar updates.
-    # The bot will still show "Downloading", "Processing", and "Uploading" 
-    # via the main worker function, but it won't flood Telegram with % updates.
-    return
+async def safe_edit(msg, text):
+    # Queued on the shared dispatcher; it coalesces, rate-limits and handles FloodWait
+    status.post(msg, text)
+
+async def download_progress(current, total, status_msg, start_time):
+    elapsed = time.time() - start_time
+    rate = current / elapsed if elapsed > 0 else 0
+    eta = (total - current) / rate if rate else 0
+    text = f"⬇️ **Downloading...**\n{render_bar(current, total)}\n`{rate / 1e6:.1f} MB/s · ETA {format_wait(eta)}`"
+    await safe_edit(status_msg, text)
+
+async def upload_progress(current, total, status_msg, start_time):
+    elapsed = time.time() - start_time
+    rate = current / elapsed if elapsed > 0 else 0
+    await safe_edit(status_msg, f"📤 **Uploading...**\n{render_bar(current, total)}\n`{rate / 1e6:.1f} MB/s`")
+
+
+# ==================== STATUS DISPATCHER ====================
+class StatusDispatcher:
+    """Single queue for every status-message edit in the bot.
+
+    Only the newest text per message is kept, each message is edited at most every
+    UPDATE_INTERVAL seconds (urgent posts skip that wait), and edits are spaced
+    STATUS_GLOBAL_INTERVAL apart globally. FloodWait pauses the whole queue.
+    """
+
+    def __init__(self, per_message: float, global_interval: float):
+        self.per_message = per_message
+        self.global_interval = global_interval
+        self.pending: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (msg, text, urgent)
+        self.last_sent: Dict[tuple, float] = {}
+        self.last_text: Dict[tuple, str] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(msg) -> tuple:
+        return (msg.chat.id, msg.id)
+
+    def post(self, msg, text: str, urgent: bool = False):
+        if msg is None: return
+        if isinstance(msg, BatchLine): return msg.update(text)
+        key = self._key(msg)
+        prev = self.pending.get(key)
+        if prev is None and self.last_text.get(key) == text: return
+        self.pending[key] = (msg, text, urgent or bool(prev and prev[2]))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+        self.wakeup.set()
+
+    def drop(self, msg):
+        # Call before deleting a status message so no stale edit lands after it
+        if msg is None or isinstance(msg, BatchLine): return
+        key = self._key(msg)
+        self.pending.pop(key, None)
+        self.last_sent.pop(key, None)
+        self.last_text.pop(key, None)
+
+    def _ready_at(self, key, urgent: bool) -> float:
+        return 0.0 if urgent else self.last_sent.get(key, 0.0) + self.per_message
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            ready = [(k, v) for k, v in self.pending.items() if self._ready_at(k, v[2]) <= now]
+            if not ready:
+                self.wakeup.clear()
+                timeout = min((self._ready_at(k, v[2]) for k, v in self.pending.items()), default=now + 60) - now
+                try: await asyncio.wait_for(self.wakeup.wait(), max(0.05, timeout))
+                except asyncio.TimeoutError: pass
+                continue
+
+            # Urgent (state changes) first, then oldest
+            key, (msg, text, urgent) = next(((k, v) for k, v in ready if v[2]), ready[0])
+            del self.pending[key]
+            try:
+                await msg.edit_text(text)
+                self.last_text[key] = text
+            except FloodWait as e:
+                logger.warning(f"Status: FloodWait {e.value}s")
+                self.pending.setdefault(key, (msg, text, urgent))  # unless a newer text arrived meanwhile
+                await asyncio.sleep(e.value)
+            except MessageNotModified:
+                self.last_text[key] = text
+            except Exception as e:
+                logger.debug(f"Status edit dropped: {e}")
+            self.last_sent[key] = time.time()
+            if len(self.last_sent) > 1000:
+                for k in list(self.last_sent)[:500]:
+                    if k not in self.pending:
+                        self.last_sent.pop(k, None)
+                        self.last_text.pop(k, None)
+            await asyncio.sleep(self.global_interval)
+
+status = StatusDispatcher(UPDATE_INTERVAL, STATUS_GLOBAL_INTERVAL)
+
+
+# ==================== METRICS ====================
+STAGE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+class StageHistogram:
+    """Cumulative Prometheus buckets plus a rolling window for percentiles."""
 
-async def download_progress(current, total, status_msg, start_time, last_update_ref):
-    if current == total: pass
-    elif (time.time() - last_update_ref[0]) < UPDATE_INTERVAL: return
-    text = f"⬇️ **Downloading...**\n{render_bar(current, total)}"
-    await safe_edit(status_msg, text, last_update_ref)
+    def __init__(self, window: int = 500):
+        self.buckets = [0] * len(STAGE_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+        for i, le in enumerate(STAGE_BUCKETS):
+            if seconds <= le: self.buckets[i] += 1
+
+    def percentile(self, q: float) -> float:
+        if not self.recent: return 0.0
+        data = sorted(self.recent)
+        return data[min(len(data) - 1, int(q * len(data)))]
+
+class Metrics:
+    def __init__(self):
+        self.stages: Dict[str, StageHistogram] = {}
+        self.jobs: Dict[str, int] = {}           # status -> count
+        self.bytes: Dict[str, int] = {}          # direction -> bytes moved
+        self.transfer_time: Dict[str, float] = {}  # direction -> seconds spent moving them
+        self.started = time.time()
+
+    def observe(self, stage: str, seconds: float):
+        self.stages.setdefault(stage, StageHistogram()).observe(seconds)
+
+    def add_transfer(self, direction: str, nbytes: int, seconds: float):
+        self.bytes[direction] = self.bytes.get(direction, 0) + nbytes
+        self.transfer_time[direction] = self.transfer_time.get(direction, 0.0) + seconds
+
+    def rate(self, direction: str) -> float:
+        t = self.transfer_time.get(direction, 0.0)
+        return self.bytes.get(direction, 0) / t if t else 0.0
+
+    def job_done(self, status: str):
+        self.jobs[status] = self.jobs.get(status, 0) + 1
+
+    def prometheus(self) -> str:
+        lines = ["# TYPE wm_stage_seconds histogram"]
+        for stage, h in sorted(self.stages.items()):
+            for le, n in zip(STAGE_BUCKETS, h.buckets):
+                lines.append(f'wm_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'wm_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {h.count}')
+            lines.append(f'wm_stage_seconds_sum{{stage="{stage}"}} {h.sum:.3f}')
+            lines.append(f'wm_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        lines.append("# TYPE wm_jobs_total counter")
+        lines += [f'wm_jobs_total{{status="{k}"}} {v}' for k, v in sorted(self.jobs.items())]
+        lines.append("# TYPE wm_transfer_bytes_total counter")
+        lines += [f'wm_transfer_bytes_total{{direction="{k}"}} {v}' for k, v in sorted(self.bytes.items())]
+        lines.append("# TYPE wm_transfer_seconds_total counter")
+        lines += [f'wm_transfer_seconds_total{{direction="{k}"}} {v:.3f}' for k, v in sorted(self.transfer_time.items())]
+        lines += [
+            "# TYPE wm_queue_depth gauge", f"wm_queue_depth {len(scheduler._order())}",
+            "# TYPE wm_in_flight gauge", f"wm_in_flight {scheduler.in_flight}",
+            "# TYPE wm_job_slots gauge", f"wm_job_slots {scheduler.slots}",
+            "# TYPE wm_encode_slots gauge", f"wm_encode_slots {scheduler.encode_slots}",
+            "# TYPE wm_encoding gauge", f"wm_encoding {scheduler.encoding_now}",
+            "# TYPE wm_overlay_cache_hits_total counter", f"wm_overlay_cache_hits_total {overlay_cache.hits}",
+            "# TYPE wm_overlay_cache_misses_total counter", f"wm_overlay_cache_misses_total {overlay_cache.misses}",
+            "# TYPE wm_result_cache_hits_total counter", f"wm_result_cache_hits_total {result_cache.hits}",
+            "# TYPE wm_preview_cache_hits_total counter", f"wm_preview_cache_hits_total {preview_cache.hits}",
+            "# TYPE wm_preview_cache_misses_total counter", f"wm_preview_cache_misses_total {preview_cache.misses}",
+            "# TYPE wm_disk_available_bytes gauge", f"wm_disk_available_bytes {workspace.available()}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        up = int(time.time() - self.started)
+        out = [
+            f"**📊 Stats** (up {up // 3600}h {up % 3600 // 60}m)",
+            f"Queue: `{len(scheduler._order())}` waiting to encode, `{scheduler.in_flight}/{scheduler.slots}` running, `{scheduler.encoding_now}/{scheduler.encode_slots}` encoding",
+            f"Jobs: " + (", ".join(f"{k} `{v}`" for k, v in sorted(self.jobs.items())) or "none"),
+            f"Overlay cache: `{overlay_cache.hit_rate:.0%}` hit",
+            f"Result cache: `{result_cache.hits}` resends",
+            f"Preview cache: `{preview_cache.hits}` reused, `{preview_cache.misses}` downloaded",
+            f"Disk: `{workspace.available() / 1e9:.1f} GB` free after `{len(workspace.active)}` reservations",
+        ]
+        out.append(governor.summary())
+        out.append(encode_model.summary())
+        if broker: out.append(broker.summary())
+        for d in sorted(self.bytes):
+            out.append(f"{d.title()}: `{self.bytes[d] / 1e9:.2f} GB` at `{self.rate(d) / 1e6:.1f} MB/s`")
+        if self.stages: out.append("**Stage** – p50 / p95 / n")
+        for stage, h in sorted(self.stages.items()):
+            out.append(f"`{stage:9s}` {h.percentile(0.5):7.1f}s / {h.percentile(0.95):7.1f}s / {h.count}")
+        return "\n".join(out)
+
+    def write_file(self):
+        if not METRICS_FILE: return
+        try:
+            tmp = f"{METRICS_FILE}.tmp"
+            with open(tmp, "w") as f: f.write(self.prometheus())
+            os.replace(tmp, METRICS_FILE)
+        except OSError as e:
+            logger.warning(f"Metrics file: {e}")
+
+metrics = Metrics()
+
+# Job log: bare JSON lines in their own rotating file, kept out of the console log format
+job_log = logging.getLogger("jobs")
+job_log.propagate = False
+job_log.setLevel(logging.INFO)
+if JOB_LOG_FILE:
+    try:
+        handler = RotatingFileHandler(JOB_LOG_FILE, maxBytes=JOB_LOG_MAX, backupCount=JOB_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        job_log.addHandler(handler)
+    except OSError as e:
+        logger.warning(f"Job log: {e}")
+
+class JobTimer:
+    """Per-job stage stopwatch; finish() feeds the histograms and appends one JSON line to the job log."""
+
+    def __init__(self, uid: int = 0, kind: str = "video", record: bool = True):
+        self.uid, self.kind, self.record = uid, kind, record
+        self.start = time.time()
+        self.stages: Dict[str, float] = {}
+        self.info: Dict[str, object] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try: yield
+        finally: self.add(name, time.perf_counter() - t0)
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def transfer(self, direction: str, nbytes: int, seconds: float):
+        self.info[f"{direction}_bytes"] = nbytes
+        self.info[f"{direction}_bps"] = round(nbytes / seconds) if seconds else 0
+        if self.record: metrics.add_transfer(direction, nbytes, seconds)
+
+    def finish(self, status: str):
+        if not self.record: return
+        total = time.time() - self.start
+        for name, secs in self.stages.items(): metrics.observe(name, secs)
+        metrics.observe("total", total)
+        metrics.job_done(status)
+        metrics.write_file()
+        entry = {
+            "ts": round(self.start, 3), "uid": self.uid, "kind": self.kind, "status": status,
+            "total_s": round(total, 3), "stages": {k: round(v, 3) for k, v in self.stages.items()}, **self.info,
+        }
+        logger.info(f"Job: {json.dumps(entry)}")
+        job_log.info(json.dumps(entry))
+
+async def metrics_http(reader, writer):
+    # Minimal GET-anything responder for Prometheus scraping
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = metrics.prometheus().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception: pass
+    finally: writer.close()
+
+async def start_metrics_server():
+    if METRICS_PORT:
+        await asyncio.start_server(metrics_http, "0.0.0.0", METRICS_PORT)
+        logger.info(f"Metrics on :{METRICS_PORT}/metrics")
 
 
 # ==================== WATERMARK GENERATION ====================
-def create_watermark(text: str, style: str = "static"):
-    font_size = 80
+def load_font(style: str, font_size: int):
     font = ImageFont.load_default()
     
     # === FONT SELECTION ===
@@ -156,6 +509,11 @@ def create_watermark(text: str, style: str = "static"):
                 font = ImageFont.truetype(p, font_size)
                 break
             except: continue
+    return font
+
+def create_watermark(text: str, style: str = "static"):
+    font_size = 80
+    font = overlay_cache.font(style, font_size)
 
     dummy = Image.new("RGBA", (1, 1))
     d = ImageDraw.Draw(dummy)
@@ -187,174 +545,2361 @@ def create_watermark(text: str, style: str = "static"):
         # It fixes the pixelation without making the text huge.
         draw.text((w / 2, h / 2), text, font=font, fill=(255, 0, 0, 255), anchor="mm", stroke_width=1, stroke_fill=(255, 0, 0, 255))
         return img
-    
-    
+
+
+# ==================== OVERLAY CACHE ====================
+class OverlayCache:
+    """Bounded LRU of loaded fonts and finished overlay PNGs (shared across jobs)."""
+
+    def __init__(self, max_overlays: int, max_fonts: int):
+        self.max_overlays = max(1, max_overlays)
+        self.max_fonts = max(1, max_fonts)
+        self.fonts = OrderedDict()     # (style, size) -> ImageFont
+        self.overlays = OrderedDict()  # (text, style, t_h, scale) -> png path
+        self.refs = {}                 # png path -> jobs currently using it
+        self.doomed = set()            # evicted while in use; deleted on last release
+        self.spare = OrderedDict()     # png path -> None: left by an earlier run, no key yet
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def font(self, style: str, size: int):
+        key = (style, size)
+        with self.lock:
+            if key in self.fonts:
+                self.fonts.move_to_end(key)
+                return self.fonts[key]
+            f = load_font(style, size)
+            self.fonts[key] = f
+            while len(self.fonts) > self.max_fonts:
+                self.fonts.popitem(last=False)
+            return f
+
+    def _path_for(self, key) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(SCRATCH_DIR, f"wm_{digest}.png")
+
+    def acquire(self, text: str, style: str, t_h: int, scale: float = 1.0) -> Tuple[str, int, int]:
+        # Blocking: call through asyncio.to_thread. Caller must release() the path.
+        key = (text, style, t_h, scale)
+        with self.lock:
+            entry = self.overlays.get(key)
+            if entry and os.path.exists(entry[0]):
+                self.overlays.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+                entry = self._render(key)
+                self.overlays[key] = entry
+                self._evict()
+            path = entry[0]
+            self.refs[path] = self.refs.get(path, 0) + 1
+            return entry
+
+    def release(self, path: str):
+        with self.lock:
+            n = self.refs.get(path, 0) - 1
+            if n > 0:
+                self.refs[path] = n
+                return
+            self.refs.pop(path, None)
+            if path in self.doomed:
+                self.doomed.discard(path)
+                self._unlink(path)
+
+    def _render(self, key) -> Tuple[str, int, int]:
+        text, style, t_h, _ = key
+        path = self._path_for(key)
+        # Content-addressed name: a PNG left by an earlier run is still valid
+        self.spare.pop(path, None)
+        if os.path.exists(path):
+            try:
+                with Image.open(path) as im:
+                    return path, im.width, im.height
+            except Exception: pass
+        wm_full = create_watermark(text, style=style)
+        t_h = max(1, t_h)
+        t_w = max(1, int(t_h * (wm_full.width / wm_full.height)))
+        wm = wm_full.resize((t_w, t_h), RESAMPLE_MODE)
+        # Write-then-rename so a concurrent ffmpeg never reads a half-written PNG
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        wm.save(tmp, format="PNG")
+        os.replace(tmp, path)
+        self.doomed.discard(path)
+        return path, t_w, t_h
+
+    def adopt(self):
+        # Startup: keep the newest leftover PNGs under the cap (evicted first), delete the rest
+        found = []
+        for name in os.listdir(SCRATCH_DIR):
+            if not (name.startswith("wm_") and name.endswith(".png")): continue
+            path = os.path.join(SCRATCH_DIR, name)
+            try: found.append((os.path.getmtime(path), path))
+            except OSError: pass
+        with self.lock:
+            known = {entry[0] for entry in self.overlays.values()}
+            for _, path in sorted(found):
+                if path not in known: self.spare[path] = None
+            self._evict()
+
+    def _evict(self):
+        while len(self.overlays) + len(self.spare) > self.max_overlays:
+            if self.spare:
+                path, _ = self.spare.popitem(last=False)
+                self._unlink(path)
+                continue
+            _, (path, _, _) = self.overlays.popitem(last=False)
+            if self.refs.get(path):
+                self.doomed.add(path)
+            else:
+                self._unlink(path)
+
+    def _unlink(self, path: str):
+        try: os.remove(path)
+        except OSError: pass
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "overlays": len(self.overlays), "fonts": len(self.fonts),
+                "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 3),
+            }
+
+overlay_cache = OverlayCache(OVERLAY_CACHE_SIZE, FONT_CACHE_SIZE)
+
 
 # ==================== PROCESSOR ====================
-async def get_video_info(path):
-    # We ask ffprobe for both stream info AND format (container) info
+@dataclass
+class MediaInfo:
+    width: int = 0
+    height: int = 0
+    duration: float = 0
+    vcodec: str = ""
+    pix_fmt: str = ""
+    fps: str = ""          # r_frame_rate, e.g. "30000/1001"
+    cfr: bool = False      # r_frame_rate == avg_frame_rate
+    bitrate: int = 0       # container bit rate (bits/s)
+    acodec: str = ""       # first audio track; "" = no audio
+    acodecs: List[str] = field(default_factory=list)  # every audio track (all of them are mapped)
+
+async def probe_media(path, head: Optional[bytes] = None) -> MediaInfo:
+    # We ask ffprobe for all stream info AND format (container) info in one call
+    # head: probe these first bytes of a file still downloading instead of `path`
     cmd = [
-        "ffprobe", "-v", "error", "-select_streams", "v:0", 
-        "-show_entries", "stream=width,height,duration:format=duration", 
-        "-of", "json", path
+        "ffprobe", "-v", "error",
+        "-show_entries", "stream=codec_type,codec_name,width,height,duration,pix_fmt,r_frame_rate,avg_frame_rate:format=duration,bit_rate",
+        "-of", "json", "pipe:0" if head is not None else path
     ]
+    info = MediaInfo()
     try:
         process = await asyncio.create_subprocess_exec(
-            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+            *cmd, stdin=asyncio.subprocess.PIPE if head is not None else None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
         )
-        stdout, stderr = await process.communicate()
+        stdout, stderr = await process.communicate(head)
         
         if process.returncode != 0:
-            return 0, 0, 0
+            return info
             
         meta = json.loads(stdout)
-        stream = meta["streams"][0]
+        streams = meta.get("streams", [])
+        video = next((st for st in streams if st.get("codec_type") == "video"), {})
+        fmt = meta.get("format", {})
+
+        info.width, info.height = int(video.get("width", 0)), int(video.get("height", 0))
+        info.vcodec, info.pix_fmt = video.get("codec_name", ""), video.get("pix_fmt", "")
+        info.fps = video.get("r_frame_rate", "")
+        info.cfr = bool(info.fps) and info.fps == video.get("avg_frame_rate") and info.fps != "0/0"
+        info.bitrate = int(fmt.get("bit_rate", 0) or 0)
+        info.acodecs = [st.get("codec_name", "") for st in streams if st.get("codec_type") == "audio"]
+        info.acodec = info.acodecs[0] if info.acodecs else ""
         
         # 1. Try to get duration from the VIDEO STREAM
-        dur = float(stream.get("duration", 0))
+        info.duration = float(video.get("duration", 0))
         
         # 2. If Stream fails (is 0), get it from the CONTAINER (Format)
-        if dur == 0:
-            dur = float(meta["format"].get("duration", 0))
+        if info.duration == 0:
+            info.duration = float(fmt.get("duration", 0))
+    except Exception as e:
+        logger.warning(f"Probe Error: {e}")
+    return info
 
-        return int(stream.get("width", 0)), int(stream.get("height", 0)), dur
-    except: 
-        return 0, 0, 0
+async def get_video_info(path):
+    info = await probe_media(path)
+    return info.width, info.height, info.duration
 
 
-async def process_video(in_path, text, out_path, sess, status_msg):
-    wm_path = f"{WORK_DIR}/wm_{int(time.time())}_{os.getpid()}.png"
-    
+# ==================== RESOURCE GOVERNOR ====================
+def proc_rss(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+    except (OSError, ValueError): pass
+    return 0
+
+def format_cpus(cpus: List[int]) -> str:
+    return f"{cpus[0]}-{cpus[-1]}" if len(cpus) > 1 else str(cpus[0]) if cpus else "-"
+
+@dataclass
+class EncodeProc:
+    pid: int
+    threads: int
+    label: str
+    cpus: List[int] = field(default_factory=list)
+    peak_rss: int = 0
+    killed: str = ""
+
+class ResourceGovernor:
+    """Splits the container's CPUs and memory between running ffmpeg encodes.
+
+    New encodes get an equal share of CPU_LIMIT as their thread count (-threads / x265 pools).
+    Running ones are re-pinned to disjoint CPU sets whenever an encode starts or finishes,
+    and if together they pass MEMORY_CAP of MEMORY_LIMIT the largest one is killed.
+    """
+
+    def __init__(self, cpus: int, memory: int):
+        self.cpus, self.memory = cpus, memory
+        self.cpu_set = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self.procs: Dict[int, EncodeProc] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def plan_threads(self, parts: int = 1) -> int:
+        # Threads for each of `parts` encodes about to start, counting them in the split
+        return max(1, self.cpus // (len(self.procs) + parts))
+
+    def attach(self, pid: int, threads: int, label: str):
+        self.procs[pid] = EncodeProc(pid, threads, label)
+        if ENCODE_NICE:
+            try: os.setpriority(os.PRIO_PROCESS, pid, ENCODE_NICE)
+            except OSError: pass
+        self.rebalance(f"+{label}")
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._watch())
+
+    def detach(self, pid: int) -> str:
+        # Returns why the governor killed it, if it did
+        proc = self.procs.pop(pid, None)
+        if not proc: return ""
+        logger.info(f"Governor: {proc.label} (pid {pid}) done, peak RSS {proc.peak_rss / 1e6:.0f} MB")
+        self.rebalance(f"-{proc.label}")
+        return proc.killed
+
+    def rebalance(self, reason: str):
+        if not self.procs: return
+        procs = sorted(self.procs.values(), key=lambda p: p.pid)
+        # Pinning only makes sense if the quota covers the whole mask; otherwise the cgroup throttles anyway
+        if self.cpu_set and self.cpus >= len(self.cpu_set):
+            per = len(self.cpu_set) // len(procs)
+            for i, p in enumerate(procs):
+                p.cpus = self.cpu_set if per == 0 else self.cpu_set[i * per:None if i == len(procs) - 1 else (i + 1) * per]
+                self.pin(p)
+        share = self.memory * MEMORY_CAP / len(procs)
+        logger.info(f"Governor ({reason}): {len(procs)} encode(s) on {self.cpus} CPUs, {share / 1e9:.2f} GB each: "
+                    + ", ".join(f"{p.label} cpus {format_cpus(p.cpus)} x{p.threads}" for p in procs))
+
+    @staticmethod
+    def pin(p: EncodeProc):
+        # Every thread: a pid's affinity only covers its main thread, and ffmpeg's pools already exist
+        try:
+            for tid in os.listdir(f"/proc/{p.pid}/task"):
+                os.sched_setaffinity(int(tid), p.cpus)
+        except OSError: pass
+
+    async def _watch(self):
+        while self.procs:
+            await asyncio.sleep(5)
+            rss = {}
+            for p in list(self.procs.values()):
+                rss[p.pid] = proc_rss(p.pid)
+                p.peak_rss = max(p.peak_rss, rss[p.pid])
+                if p.cpus: self.pin(p)  # threads ffmpeg started since the last pass
+            total = sum(rss.values())
+            if not rss or total <= self.memory * MEMORY_CAP: continue
+            pid = max(rss, key=rss.get)
+            p = self.procs.get(pid)
+            if not p: continue
+            logger.warning(f"Governor: encodes hold {total / 1e9:.2f} GB of {self.memory / 1e9:.2f} GB, killing {p.label} (pid {pid}, {rss[pid] / 1e9:.2f} GB)")
+            p.killed = "out of memory"
+            try: os.kill(pid, signal.SIGKILL)
+            except OSError: pass
+
+    def summary(self) -> str:
+        return f"Governor: `{len(self.procs)}` encode(s) on `{self.cpus}` CPUs / `{self.memory / 1e9:.1f} GB`"
+
+governor = ResourceGovernor(CPU_LIMIT, MEMORY_LIMIT)
+
+
+# ==================== ENCODE PLANNER ====================
+COPY_AUDIO_CODECS = {"aac"}  # Can go into MP4 untouched
+
+@dataclass
+class EncodePlan:
+    height: int                                 # output height; overlays are sized for this
+    scale: bool = True                          # False = frame size passes through
+    audio_args: List[str] = field(default_factory=lambda: ["-c:a", "aac", "-b:a", "128k"])
+    fps_args: List[str] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    def describe(self) -> str:
+        return "; ".join(self.notes)
+
+def plan_encode(info: MediaInfo, sess) -> EncodePlan:
+    plan = EncodePlan(height=sess.resolution)
+    if not info.height:
+        # No probe (streamed input): keep the conservative defaults
+        plan.notes.append(f"unprobed: scale to {sess.resolution}p, audio aac 128k")
+        return plan
+
+    # Never upscale; skip the scaler entirely when the frame is already the right (even) size
+    out_h = min(info.height, sess.resolution)
+    if out_h == info.height and info.width % 2 == 0 and info.height % 2 == 0:
+        plan.height, plan.scale = out_h, False
+        plan.notes.append(f"video {info.width}x{info.height} kept (target {sess.resolution}p)")
+    else:
+        plan.height = out_h - out_h % 2
+        plan.notes.append(f"video {info.width}x{info.height} -> {plan.height}p")
+
+    if not info.vcodec:
+        # Size came from Telegram's metadata, the streams are unknown
+        plan.notes.append("audio unprobed -> aac 128k")
+    elif not info.acodec:
+        plan.audio_args = []
+        plan.notes.append("no audio")
+    elif all(c in COPY_AUDIO_CODECS for c in info.acodecs or [info.acodec]):
+        plan.audio_args = ["-c:a", "copy"]
+        plan.notes.append(f"audio {'/'.join(info.acodecs or [info.acodec])} copied")
+    else:
+        plan.notes.append(f"audio {'/'.join(info.acodecs or [info.acodec])} -> aac 128k")
+
+    if info.cfr:
+        plan.fps_args = ["-r", info.fps]
+        plan.notes.append(f"fps {info.fps}")
+    else:
+        plan.notes.append("fps vfr passthrough")
+    return plan
+
+
+@dataclass
+class EncodeResult:
+    ok: bool = False
+    duration: float = 0
+    width: int = 0
+    height: int = 0
+    thumb: Optional[str] = None
+    path: Optional[str] = None                                          # set on extra renditions
+    renditions: List["EncodeResult"] = field(default_factory=list)     # smaller outputs of the same encode
+    error: str = ""                                                     # "stalled" / "timed out" when the watchdog killed ffmpeg
+    preset: str = ""                                                    # settings actually encoded with (adaptive mode may
+    crf: int = 0                                                        # pick faster / lower quality than the session's)
+    heights: List[int] = field(default_factory=list)                   # requested heights this output stands for (renditions)
+
+    def __bool__(self):
+        return self.ok
+
+def result_dict(r: EncodeResult) -> dict:
+    # JSON form for the journal and the broker
+    extra = [{"path": x.path, "duration": x.duration, "width": x.width, "height": x.height, "heights": x.heights} for x in r.renditions]
+    return {"duration": r.duration, "width": r.width, "height": r.height, "thumb": r.thumb, "renditions": extra,
+            "preset": r.preset, "crf": r.crf, "heights": r.heights}
+
+def result_from_dict(d: dict) -> EncodeResult:
+    d = dict(d)
+    extra = [EncodeResult(ok=True, **x) for x in d.pop("renditions", None) or []]
+    return EncodeResult(ok=True, renditions=extra, **d)
+
+def encode_timeout(duration: float) -> float:
+    return max(ENCODE_TIMEOUT_MIN, duration * ENCODE_TIMEOUT_FACTOR)
+
+def transfer_timeout(size: int) -> float:
+    return max(TRANSFER_TIMEOUT_MIN, size / TRANSFER_MIN_RATE)
+
+def rendition_targets(out_path: str, heights: List[int]) -> Dict[str, int]:
+    # Output path -> requested height; the largest goes to out_path, the rest next to it as *_<h>p.mp4
+    heights = sorted(set(heights), reverse=True)
+    root, ext = os.path.splitext(out_path)
+    return {out_path if i == 0 else f"{root}_{h}p{ext}": h for i, h in enumerate(heights)}
+
+OUTPUT_DIMS_RE = re.compile(r"Output #0.*?Stream #0:\d+.*?Video:.*?(\d{2,5})x(\d{2,5})", re.S)
+
+@dataclass
+class FFmpegProgress:
+    time: float = 0.0   # output timestamp reached (seconds)
+    fps: float = 0.0
+    speed: float = 0.0  # x realtime
+    frame: int = 0
+    done: bool = False
+
+class ProgressParser:
+    # Incremental parser for `-progress pipe:1`: key=value lines, each block closed by progress=continue|end
+    def __init__(self):
+        self.block: Dict[str, str] = {}
+
+    def feed(self, line: str) -> Optional[FFmpegProgress]:
+        key, sep, val = line.strip().partition("=")
+        if not sep: return None
+        if key != "progress":
+            self.block[key] = val.strip()
+            return None
+        b, self.block = self.block, {}
+        def num(k, cast=float):
+            try: return cast(b.get(k, "0").rstrip("x"))
+            except ValueError: return cast(0)
+        us = num("out_time_us", int) or num("out_time_ms", int)  # both are microseconds
+        return FFmpegProgress(time=max(0, us) / 1e6, fps=num("fps"), speed=num("speed"), frame=num("frame", int), done=val.strip() == "end")
+
+def progress_text(title: str, p: FFmpegProgress, duration: float) -> str:
+    eta = (duration - p.time) / p.speed if p.speed > 0 else 0
+    return f"{title}\n{render_bar(p.time, duration)}\n`{p.fps:.0f} fps · {p.speed:.2f}x · ETA {format_wait(eta)}`"
+
+def overlay_layers(sess, height: int = 0) -> List[Tuple[str, int, float]]:
+    # (style, target height, scale) for every overlay the mode needs, bottom layer first
+    # height: actual output height (defaults to the session resolution)
+    height = height or sess.resolution
+    # --- WATERMARK SIZING LOGIC ---
+    # Static (Box + White), Logic: Resolution / 18 (Original)
+    static = ("static", int(height / 18), 1.0)
+    # Moving (Red Text Only), Logic: (Resolution / 25) * Scale Factor
+    # Base size is slightly smaller than static, then multiplied by user scale
+    base_h = int(height / 25) 
+    moving = ("moving", int(base_h * sess.scale), sess.scale)
+    if sess.watermark_mode == "static": return [static]
+    if sess.watermark_mode == "dual": return [static, moving]
+    return [moving]
+
+async def prepare_overlays(text, sess, height: int = 0) -> List[str]:
+    paths = []
+    try:
+        for style, t_h, scale in overlay_layers(sess, height):
+            path, _, _ = await asyncio.to_thread(overlay_cache.acquire, text, style, t_h, scale)
+            paths.append(path)
+    except Exception:
+        release_overlays(paths)
+        raise
+    logger.info(f"Overlay cache: {overlay_cache.stats()}")
+    return paths
+
+def release_overlays(paths):
+    for p in paths: overlay_cache.release(p)
+
+def overlay_position(style, sess, t_offset: float = 0.0) -> str:
+    if style == "static":
+        # Static Position: Bottom Right
+        return "x=W-w-20:y=H-h-20"
+    # Moving Position: Lissajous Animation
+    # x = Center + WidthAmp * sin(t * speed)
+    # y = Center + HeightAmp * cos(t * speed * 2.2)
+    # t_offset shifts the curve for segments that start mid-video, so the path stays continuous
+    sp = sess.speed
+    t = f"(t+{t_offset:.6f})" if t_offset else "t"
+    return f"x='(W-w)/2 + (W-w)/3*sin({t}*{sp})':y='(H-h)/2 + (H-h)/3*cos({t}*{sp}*2.2)'"
+
+def build_filter(sess, plan: EncodePlan, t_offset: float = 0.0, thumb_at: Optional[float] = None,
+                 src: str = "[0:v]", first_input: int = 1, tag: str = "") -> str:
+    # Scale at most once, then chain every overlay layer (inputs first_input..) in a single graph -> [v] (+ [th] thumbnail)
+    # src/tag let several chains share one graph: labels become [<tag>v], [<tag>th], ...
+    graph = f"{src}scale=-2:{plan.height}[{tag}l0];" if plan.scale else ""
+    layers = overlay_layers(sess, plan.height)
+    for i, (style, _, _) in enumerate(layers, start=1):
+        prev = src if i == 1 and not plan.scale else f"[{tag}l{i - 1}]"
+        out = "" if i == len(layers) else f"[{tag}l{i}]"
+        graph += f"{';' if i > 1 else ''}{prev}[{first_input + i - 1}:v]overlay={overlay_position(style, sess, t_offset)}{out}"
+    if thumb_at is not None:
+        # One frame is tapped off the watermarked stream
+        return graph + f",split=2[{tag}v][{tag}tv];[{tag}tv]select='isnan(prev_selected_t)*gte(t,{thumb_at:.3f})',scale=320:-2[{tag}th]"
+    return graph + f"[{tag}v]"
+
+def overlay_inputs(wm_paths) -> List[str]:
+    return [arg for p in wm_paths for arg in ("-i", p)]
+
+def video_codec_args(sess, threads: int = 0) -> List[str]:
+    # threads: the governor's share for this encode (0 = encoder default, sized to the whole machine)
+    args = ["-c:v", sess.codec, "-preset", sess.preset]
+    if sess.codec == "libx265":
+        hevc_crf = int(sess.crf) + 4
+        args.extend(["-crf", str(hevc_crf)])
+        # x265 ignores -threads and sizes its own pools
+        if threads: args.extend(["-x265-params", f"pools={threads}:frame-threads={max(1, min(4, threads // 2))}"])
+    else:
+        args.extend(["-crf", str(sess.crf), "-pix_fmt", "yuv420p"])
+        if threads: args.extend(["-threads", str(threads)])
+    return args
+
+def mp4_tag_args(sess) -> List[str]:
+    return ["-tag:v", "hvc1"] if sess.codec == "libx265" else []
+
+async def run_ffmpeg(cmd_args, result: EncodeResult, on_progress=None, feed=None, timeout: Optional[float] = None, threads: int = 0, label: str = "ffmpeg") -> int:
+    # Runs ffmpeg with -progress on stdout; result.duration tracks it, width/height come from the stderr header.
+    # on_progress(FFmpegProgress) is awaited once per progress block (~every 0.5s).
+    # ffmpeg is killed if its output time stops advancing for STALL_TIMEOUT, or after `timeout` seconds in total;
+    # result.error says which. Cancelling the caller kills it too.
+    # threads > 0 marks an encode: the governor pins it, renices it and may kill it for memory.
+    cmd = [cmd_args[0], "-progress", "pipe:1", "-nostats", *cmd_args[1:]]
+    if threads and ENCODE_IONICE and IONICE: cmd = [IONICE, "-c", "2", "-n", "7", *cmd]
+    feeder = None
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdin=asyncio.subprocess.PIPE if feed else None,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    if threads: governor.attach(process.pid, threads, label)
+
+    async def read_stderr():
+        header, tail = "", deque(maxlen=15)
+        async for data in process.stderr:
+            line = data.decode('utf-8', errors='ignore')
+            if not result.height and len(header) < 65536:
+                header += line
+                dims = OUTPUT_DIMS_RE.search(header)
+                if dims: result.width, result.height = int(dims.group(1)), int(dims.group(2))
+            tail.append(line)
+        return "".join(tail)
+
+    started = last_advance = time.monotonic()
+
+    async def watchdog():
+        while process.returncode is None:
+            await asyncio.sleep(min(5.0, STALL_TIMEOUT))
+            now = time.monotonic()
+            if now - last_advance > STALL_TIMEOUT: result.error = "stalled"
+            elif timeout and now - started > timeout: result.error = "timed out"
+            else: continue
+            logger.warning(f"ffmpeg {result.error} at {result.duration:.1f}s of output, killing it")
+            process.kill()
+            return
+
+    err_reader = asyncio.create_task(read_stderr())
+    guard = asyncio.create_task(watchdog())
     try:
-        in_w, in_h, duration = await get_video_info(in_path)
-        if duration == 0: duration = 1 
+        if feed: feeder = asyncio.create_task(feed(process.stdin))
+        parser = ProgressParser()
+        async for line in process.stdout:
+            p = parser.feed(line.decode('utf-8', errors='ignore'))
+            if not p: continue
+            if p.time > result.duration: last_advance = time.monotonic()
+            result.duration = p.time
+            if on_progress: await on_progress(p)
         
-        # --- WATERMARK SIZING LOGIC ---
+        await process.wait()
+        err_tail = await err_reader
+        if process.returncode != 0: logger.warning(f"ffmpeg exited {process.returncode}: {err_tail[-800:]}")
+        if feeder: await feeder
+        return process.returncode
+    finally:
+        guard.cancel()
+        if threads: result.error = governor.detach(process.pid) or result.error
+        if feeder and not feeder.done(): feeder.cancel()
+        if not err_reader.done(): err_reader.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()  # reap it, so a cancelled job leaves no zombie behind
+
+async def process_video(in_path, text, out_path, sess, status_msg, feed=None, duration=0, thumb_path=None, timer=None, renditions=None, budget=None, info=None):
+    # feed: optional coroutine fn(stdin) that streams the input into ffmpeg while it downloads
+    # info: probe of a streamed input (from its first chunk); without it a streamed input is planned from duration only
+    # thumb_path: if set, a 320px JPEG is grabbed from the same filter graph (no second decode)
+    # timer: the job's JobTimer; probe / overlay / encode stages are added to it
+    # renditions: target heights; more than one means one output per height, see process_renditions
+    # budget: seconds the encode should fit in; the preset/CRF are adapted to it (None = session settings)
+    timer = timer or JobTimer(record=False)
+    result = EncodeResult()
+    wm_paths = []
+    
+    try:
+        with timer.stage("probe"):
+            if feed is None: info = await probe_media(in_path)
+            elif info is None: info = MediaInfo(duration=duration)
+        duration = info.duration or 1
+        if renditions and len(set(renditions)) > 1:
+            return await process_renditions(in_path, text, out_path, sess, status_msg, info, renditions, feed, thumb_path, timer, budget)
+        plan = plan_encode(info, sess)
+        logger.info(f"Plan: {plan.describe()}")
+        threads = governor.plan_threads()
+        sess, predicted = adapt_encode(sess, info, [plan.height], threads, budget)
+        timer.info.update(preset=sess.preset, crf=sess.crf, encode_predicted_s=round(predicted, 1))
+        result.preset, result.crf = sess.preset, sess.crf
         
-        if sess.watermark_mode == "static":
-            # 1. Generate Static (Box + White)
-            wm_full = await asyncio.to_thread(create_watermark, text, style="static")
-            # 2. Logic: Resolution / 18 (Original)
-            t_h = int(sess.resolution / 18)
-            t_w = int(t_h * (wm_full.width / wm_full.height))
-            # 3. Static Position: Bottom Right
-            overlay_cmd = "x=W-w-20:y=H-h-20"
-            
-        else:
-            # 1. Generate Moving (Red Text Only)
-            wm_full = await asyncio.to_thread(create_watermark, text, style="moving")
-            
-            # 2. Logic: (Resolution / 25) * Scale Factor
-            # Base size is slightly smaller than static, then multiplied by user scale
-            base_h = int(sess.resolution / 25) 
-            t_h = int(base_h * sess.scale)
-            t_w = int(t_h * (wm_full.width / wm_full.height))
-            
-            # 3. Moving Position: Lissajous Animation
-            # x = Center + WidthAmp * sin(t * speed)
-            # y = Center + HeightAmp * cos(t * speed * 2.2)
-            sp = sess.speed
-            overlay_cmd = f"x='(W-w)/2 + (W-w)/3*sin(t*{sp})':y='(H-h)/2 + (H-h)/3*cos(t*{sp}*2.2)'"
-
-        # Resize Image
-        wm = await asyncio.to_thread(wm_full.resize, (t_w, t_h), RESAMPLE_MODE)
-        await asyncio.to_thread(wm.save, wm_path)
+        with timer.stage("overlay"):
+            wm_paths = await prepare_overlays(text, sess, plan.height)
+
+        if SEGMENT_MODE and feed is None and duration >= SEGMENT_MIN_DURATION:
+            with timer.stage("encode"):
+                seg_result = await process_video_segmented(in_path, wm_paths, out_path, sess, status_msg, duration, plan, thumb_path)
+            if seg_result:
+                seg_result.preset, seg_result.crf = sess.preset, sess.crf
+                return seg_result
+            logger.warning("Segments: parallel encode failed, falling back to a single pass")
         
-        filter_complex = f"[0:v]scale=-2:{sess.resolution}[bg];[bg][1:v]overlay={overlay_cmd}"
+        # Thumbnail at 2s (or mid-clip for short videos)
+        filter_complex = build_filter(sess, plan, thumb_at=min(2.0, duration / 2) if thumb_path else None)
         
         cmd_args = [
-            "ffmpeg", "-y", "-i", in_path, "-i", wm_path, "-filter_complex", filter_complex,
-            "-map", "0:a?", "-c:v", sess.codec, "-preset", "fast",
-            "-c:a", "aac", "-b:a", "128k", "-movflags", "+faststart"
+            "ffmpeg", "-y", "-i", "pipe:0" if feed else in_path, *overlay_inputs(wm_paths), "-filter_complex", filter_complex,
+            "-map", "[v]", "-map", "0:a?", *video_codec_args(sess, threads), *plan.fps_args, *mp4_tag_args(sess),
+            *plan.audio_args, "-movflags", "+faststart", out_path
         ]
+        if thumb_path:
+            cmd_args.extend(["-map", "[th]", "-frames:v", "1", "-q:v", "3", thumb_path])
 
-        if sess.codec == "libx265":
-            hevc_crf = int(sess.crf) + 4
-            cmd_args.extend(["-crf", str(hevc_crf), "-tag:v", "hvc1"]) 
-        else:
-            cmd_args.extend(["-crf", str(sess.crf), "-pix_fmt", "yuv420p"]) 
-
-        cmd_args.append(out_path)
+        codec_name = "HEVC" if sess.codec == "libx265" else "AVC"
+        async def on_progress(p):
+            await safe_edit(status_msg, progress_text(f"⚙️ **Processing ({codec_name})...**", p, duration))
 
-        process = await asyncio.create_subprocess_exec(*cmd_args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        last_update_time = [0]
-        
-        while True:
-            chunk = await process.stderr.read(4096)
-            if not chunk: break
-            chunk_str = chunk.decode('utf-8', errors='ignore')
-            if "time=" in chunk_str:
-                time_match = re.search(r"time=(\d{2}:\d{2}:\d{2}\.\d+)", chunk_str)
-                if time_match:
-                    codec_name = "HEVC" if sess.codec == "libx265" else "AVC"
-                    text = f"⚙️ **Processing ({codec_name})...**\n{render_bar(time_to_seconds(time_match.group(1)), duration)}"
-                    await safe_edit(status_msg, text, last_update_time)
-        
-        await process.wait()
-        return os.path.exists(out_path) and os.path.getsize(out_path) > 1024
+        start = time.perf_counter()
+        with timer.stage("encode"):
+            returncode = await run_ffmpeg(cmd_args, result, on_progress, feed, encode_timeout(duration), threads, os.path.basename(out_path))
+        result.ok = returncode == 0 and os.path.exists(out_path) and os.path.getsize(out_path) > 1024
+        # A streamed encode runs at download speed, so it says nothing about the encoder
+        if result and feed is None:
+            encode_model.observe(sess.codec, sess.preset, sess.crf, encode_pixels(info, [plan.height]), threads, time.perf_counter() - start, predicted)
+        if thumb_path and os.path.exists(thumb_path): result.thumb = thumb_path
+        return result
     except Exception as e:
         logger.error(f"FFmpeg Error: {e}")
-        return False
+        return result
+    finally:
+        release_overlays(wm_paths)
+
+async def process_renditions(in_path, text, out_path, sess, status_msg, info, heights, feed=None, thumb_path=None, timer=None, budget=None):
+    # One decode `split` into a scale + overlay chain per height, every output written by the same ffmpeg.
+    # Returns the largest output's result; the others are in .renditions with their paths.
+    timer = timer or JobTimer(record=False)
+    duration = info.duration or 1
+    outputs = []  # (path, plan), largest first
+    served: Dict[str, List[int]] = {}  # output path -> requested heights it stands for
+    for path, h in rendition_targets(out_path, heights).items():
+        plan = plan_encode(info, replace(sess, resolution=h))
+        # Never upscaled, so e.g. 1080 and 720 of a 720p source are the same output
+        same = next((q for q, p in outputs if p.height == plan.height), None)
+        if same: served[same].append(h)
+        else:
+            outputs.append((path, plan))
+            served[path] = [h]
+    logger.info("Plan: " + " | ".join(f"{p.height}p: {p.describe()}" for _, p in outputs))
+
+    result = EncodeResult()
+    wm_paths = []
+    try:
+        graph, first = [f"[0:v]split={len(outputs)}" + "".join(f"[s{i}]" for i in range(len(outputs)))], 1
+        with timer.stage("overlay"):
+            for i, (_, plan) in enumerate(outputs):
+                wm_paths += await prepare_overlays(text, sess, plan.height)
+                # The thumbnail comes from the smallest chain
+                thumb_at = min(2.0, duration / 2) if thumb_path and i == len(outputs) - 1 else None
+                graph.append(build_filter(sess, plan, thumb_at=thumb_at, src=f"[s{i}]", first_input=first, tag=f"r{i}"))
+                first += len(overlay_layers(sess, plan.height))
+
+        # One process, one CPU share: the renditions split it
+        threads = governor.plan_threads()
+        out_heights = [p.height for _, p in outputs]
+        sess, predicted = adapt_encode(sess, info, out_heights, threads, budget)
+        timer.info.update(preset=sess.preset, crf=sess.crf, encode_predicted_s=round(predicted, 1))
+        cmd_args = ["ffmpeg", "-y", "-i", "pipe:0" if feed else in_path, *overlay_inputs(wm_paths), "-filter_complex", ";".join(graph)]
+        for i, (path, plan) in enumerate(outputs):
+            cmd_args += ["-map", f"[r{i}v]", "-map", "0:a?", *video_codec_args(sess, max(1, threads // len(outputs))), *plan.fps_args, *mp4_tag_args(sess),
+                         *plan.audio_args, "-movflags", "+faststart", path]
+        if thumb_path:
+            cmd_args += ["-map", f"[r{len(outputs) - 1}th]", "-frames:v", "1", "-q:v", "3", thumb_path]
+
+        sizes = "/".join(f"{p.height}p" for _, p in outputs)
+        async def on_progress(p):
+            await safe_edit(status_msg, progress_text(f"⚙️ **Processing {sizes}...**", p, duration))
+
+        start = time.perf_counter()
+        with timer.stage("encode"):
+            returncode = await run_ffmpeg(cmd_args, result, on_progress, feed, encode_timeout(duration), threads, os.path.basename(out_path))
+        if returncode != 0: return result
+        if feed is None: encode_model.observe(sess.codec, sess.preset, sess.crf, encode_pixels(info, out_heights), threads, time.perf_counter() - start, predicted)
+
+        done = []
+        for path, _ in outputs:
+            if not (os.path.exists(path) and os.path.getsize(path) > 1024): return result
+            out = await probe_media(path)
+            done.append(EncodeResult(ok=True, duration=out.duration or result.duration, width=out.width, height=out.height, path=path, heights=served[path]))
+        primary = done[0]
+        primary.renditions = done[1:]
+        primary.preset, primary.crf = sess.preset, sess.crf
+        if thumb_path and os.path.exists(thumb_path): primary.thumb = thumb_path
+        return primary
     finally:
-        if os.path.exists(wm_path): os.remove(wm_path)
+        release_overlays(wm_paths)
 
 async def generate_thumbnail(video_path):
     thumb_path = f"{video_path}.jpg"
-    cmd = ["ffmpeg", "-y", "-i", video_path, "-ss", "00:00:02", "-vframes", "1", "-vf", "scale=320:-1", thumb_path]
+    cmd = ["ffmpeg", "-y", "-ss", "00:00:02", "-i", video_path, "-vframes", "1", "-vf", "scale=320:-1", thumb_path]
     proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
     await proc.wait()
     return thumb_path if os.path.exists(thumb_path) else None
 
-async def worker(uid):
-    sess = await get_session(uid)
-    if sess.is_processing: return
-    sess.is_processing = True
+
+# ==================== SEGMENT-PARALLEL ENCODE ====================
+async def keyframe_times(path) -> List[float]:
+    # Reads packet flags only (no decode), so this is cheap even on long files
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await proc.communicate()
+    times = []
+    for line in stdout.decode(errors="ignore").splitlines():
+        parts = line.split(",")
+        if len(parts) >= 2 and "K" in parts[1]:
+            try: times.append(float(parts[0]))
+            except ValueError: pass
+    return sorted(times)
+
+def plan_segments(keyframes: List[float], duration: float, n: int) -> List[Tuple[float, float]]:
+    # Cut at the keyframe nearest to each ideal boundary; returns [(start, end)], end of the last is duration
+    cuts = [0.0]
+    for i in range(1, n):
+        ideal = duration * i / n
+        k = min(keyframes, key=lambda x: abs(x - ideal), default=None)
+        if k is not None and k > cuts[-1] + 1.0 and k < duration - 1.0:
+            cuts.append(k)
+    cuts.append(duration)
+    return list(zip(cuts[:-1], cuts[1:]))
+
+async def process_video_segmented(in_path, wm_paths, out_path, sess, status_msg, duration, plan, thumb_path=None):
+    result = EncodeResult()
+    segments = plan_segments(await keyframe_times(in_path), duration, SEGMENT_WORKERS)
+    if len(segments) < 2: return result
+
+    base = os.path.splitext(out_path)[0]
+    seg_paths = [f"{base}.seg{i:03d}.mkv" for i in range(len(segments))]
+    list_path = f"{base}.segments.txt"
+    threads = governor.plan_threads(len(segments))
+    done = [FFmpegProgress() for _ in segments]
+    logger.info(f"Segments: {len(segments)} x {threads} threads, cuts={[round(a, 2) for a, _ in segments]}")
+
+    async def encode(i, start, end):
+        # Input seek lands on the keyframe exactly; t restarts at 0, so the overlay curve is offset by start
+        want_thumb = thumb_path and i == 0
+        fc = build_filter(sess, plan, start, min(2.0, (end - start) / 2) if want_thumb else None)
+        cmd = [
+            "ffmpeg", "-y", "-ss", f"{start:.6f}", "-t", f"{end - start:.6f}", "-i", in_path, *overlay_inputs(wm_paths),
+            "-filter_complex", fc, "-map", "[v]", "-an", *video_codec_args(sess, threads), *plan.fps_args, seg_paths[i]
+        ]
+        if want_thumb:
+            cmd.extend(["-map", "[th]", "-frames:v", "1", "-q:v", "3", thumb_path])
+
+        async def on_progress(p):
+            done[i] = p
+            # Parts run side by side, so their rates add up
+            total = FFmpegProgress(time=sum(d.time for d in done), fps=sum(d.fps for d in done), speed=sum(d.speed for d in done))
+            await safe_edit(status_msg, progress_text(f"⚙️ **Processing ({len(segments)} parts)...**", total, duration))
+
+        seg = EncodeResult()
+        code = await run_ffmpeg(cmd, seg, on_progress, timeout=encode_timeout(end - start), threads=threads, label=os.path.basename(seg_paths[i]))
+        if i == 0: result.width, result.height = seg.width, seg.height
+        if seg.error: result.error = seg.error
+        return code == 0 and os.path.exists(seg_paths[i])
+
     try:
-        while sess.queue:
-            message_to_process = sess.queue.pop(0)
-            file = message_to_process.video or message_to_process.document
-            original_caption = message_to_process.caption.html if message_to_process.caption else ""
-            original_name = file.file_name if file.file_name else "video.mp4"
-            
-            status_msg = await app.send_message(uid, f"⬇️ **Downloading...**")
-            dl_path = os.path.join(WORK_DIR, f"in_{uid}_{int(time.time())}.mp4")
-            
+        oks = await asyncio.gather(*(encode(i, a, b) for i, (a, b) in enumerate(segments)))
+        if not all(oks): return result
+
+        with open(list_path, "w") as f:
+            for p in seg_paths: f.write(f"file '{os.path.abspath(p)}'\n")
+        # Video is stream-copied; audio is taken from the source in one piece so there are no gaps at the cuts
+        concat = [
+            "ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-i", in_path,
+            "-map", "0:v", "-map", "1:a?", "-c:v", "copy", *mp4_tag_args(sess),
+            *plan.audio_args, "-movflags", "+faststart", out_path
+        ]
+        mux = EncodeResult()
+        code = await run_ffmpeg(concat, mux)
+        result.duration = mux.duration
+        result.ok = code == 0 and os.path.exists(out_path) and os.path.getsize(out_path) > 1024
+        if thumb_path and os.path.exists(thumb_path): result.thumb = thumb_path
+        return result
+    finally:
+        for p in seg_paths + [list_path]:
+            if os.path.exists(p): os.remove(p)
+
+
+# ==================== WORKSPACE ====================
+ARTIFACT_PREFIXES = ("in_", "out_", "img_in_", "img_out_")  # per-job files; thumb_<uid>.jpg is kept, wm_*.png are bounded by overlay_cache.adopt
+RENDITION_SUFFIX_RE = re.compile(r"_\d+p(?=\.\w+$)")  # out_<uid>_<job>_480p.mp4 belongs to out_<uid>_<job>.mp4
+
+class JobWorkspace:
+    """Disk reservation for one job plus every file it creates; leaving the `with` block deletes them."""
+
+    def __init__(self, owner, key: str, nbytes: int):
+        self.owner, self.key, self.nbytes = owner, key, nbytes
+        self.paths: List[str] = []
+
+    def track(self, *paths):
+        for p in paths:
+            if p and p not in self.paths: self.paths.append(p)
+
+    def scratch(self, name: str) -> str:
+        # Small intermediates (thumbnails, photos) go to SCRATCH_DIR, which may be tmpfs
+        path = os.path.join(SCRATCH_DIR, name)
+        self.track(path)
+        return path
+
+    def written(self) -> int:
+        return sum(os.path.getsize(p) for p in self.paths if p.startswith(WORK_DIR) and os.path.exists(p))
+
+    def close(self):
+        for p in self.paths:
             try:
-                last_update_time = [0]
-                in_path = await app.download_media(message_to_process, file_name=dl_path, progress=download_progress, progress_args=(status_msg, time.time(), last_update_time))
-                
+                if os.path.exists(p): os.remove(p)
+            except OSError as e:
+                logger.warning(f"Workspace: could not remove {p}: {e}")
+        self.paths.clear()
+        self.owner.active.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class Workspace:
+    """Admission control for WORK_DIR: jobs reserve their worst-case bytes before they may start."""
+
+    def __init__(self, root: str, headroom: int, quota: int):
+        self.root, self.headroom, self.quota = root, headroom, quota
+        self.active: Dict[str, JobWorkspace] = {}
+
+    def available(self) -> int:
+        # Free space minus what running jobs have reserved but not written yet
+        outstanding = sum(max(0, r.nbytes - r.written()) for r in self.active.values())
+        return shutil.disk_usage(self.root).free - outstanding - self.headroom
+
+    def try_reserve(self, key: str, nbytes: int) -> Optional[JobWorkspace]:
+        if nbytes > self.available(): return None
+        if self.quota and sum(r.nbytes for r in self.active.values()) + nbytes > self.quota: return None
+        ws = JobWorkspace(self, key, nbytes)
+        self.active[key] = ws
+        return ws
+
+    def could_ever_fit(self, nbytes: int) -> bool:
+        # True if the job would fit once every running job has finished and its files are gone
+        if self.quota and nbytes > self.quota: return False
+        held = sum(r.written() for r in self.active.values())
+        return nbytes <= shutil.disk_usage(self.root).free + held - self.headroom
+
+    def sweep(self, live: Set[str]):
+        # Startup: per-job artifacts no unfinished job points to are leftovers from a crash
+        # A job's files sit in either root (thumbnails go to SCRATCH_DIR), so its names count in both
+        live = live | {os.path.join(root, os.path.basename(p)) for p in live for root in (WORK_DIR, SCRATCH_DIR)}
+        for root in {WORK_DIR, SCRATCH_DIR}:
+            for name in os.listdir(root):
+                path = os.path.abspath(os.path.join(root, name))
+                if not (name.startswith(ARTIFACT_PREFIXES) or name.endswith(".tmp")): continue
+                if path in live or path.removesuffix(".jpg") in live or RENDITION_SUFFIX_RE.sub("", path) in live: continue
+                try:
+                    os.remove(path)
+                    logger.info(f"Workspace: removed orphan {name}")
+                except OSError: pass
+
+workspace = Workspace(WORK_DIR, DISK_HEADROOM, WORKSPACE_QUOTA)
+
+def job_disk_need(job) -> int:
+    # Worst case on WORK_DIR: source + output (outputs are never upscaled, so ~ the source) + margin
+    # Each extra rendition is smaller than the largest; half the source is a safe bound
+    file = job.message.video or job.message.document
+    size = getattr(file, "file_size", 0) or 0
+    factor = DISK_RESERVE_FACTOR + 0.5 * max(0, len(job.sess.renditions if job.sess else ()) - 1)
+    if job.stage == "encoded": return 0
+    if job.stage == "downloaded": return int(size * (factor - 1))
+    return int(size * factor)
+
+
+# ==================== JOB JOURNAL ====================
+JOB_STAGES = ("queued", "downloaded", "encoded")  # unfinished; "uploaded", "failed", "cancelled" are final
+
+class JobJournal:
+    """SQLite record of every video job, so a restart can resume from the last finished stage."""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                uid INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                settings TEXT NOT NULL,
+                stage TEXT NOT NULL DEFAULT 'queued',
+                in_path TEXT,
+                out_path TEXT,
+                result TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs(stage)")
+
+    def add(self, uid: int, message: Message, sess) -> int:
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT INTO jobs (uid, chat_id, message_id, settings, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (uid, message.chat.id, message.id, json.dumps(asdict(sess)), now, now),
+        )
+        return cur.lastrowid
+
+    def set_paths(self, job_id: int, in_path: str, out_path: str):
+        self.db.execute("UPDATE jobs SET in_path = ?, out_path = ?, updated = ? WHERE id = ?", (in_path, out_path, time.time(), job_id))
+
+    def advance(self, job_id: int, stage: str, result: Optional[dict] = None):
+        if result is None:
+            self.db.execute("UPDATE jobs SET stage = ?, updated = ? WHERE id = ?", (stage, time.time(), job_id))
+        else:
+            self.db.execute("UPDATE jobs SET stage = ?, result = ?, updated = ? WHERE id = ?", (stage, json.dumps(result), time.time(), job_id))
+
+    def unfinished(self) -> List[sqlite3.Row]:
+        self.db.row_factory = sqlite3.Row
+        try:
+            marks = ",".join("?" * len(JOB_STAGES))
+            return self.db.execute(f"SELECT * FROM jobs WHERE stage IN ({marks}) ORDER BY id", JOB_STAGES).fetchall()
+        finally:
+            self.db.row_factory = None
+
+    def live_paths(self) -> Set[str]:
+        marks = ",".join("?" * len(JOB_STAGES))
+        rows = self.db.execute(f"SELECT in_path, out_path FROM jobs WHERE stage IN ({marks})", JOB_STAGES).fetchall()
+        return {os.path.abspath(p) for row in rows for p in row if p}
+
+    def prune(self, max_age: float = 7 * 86400):
+        self.db.execute("DELETE FROM jobs WHERE stage NOT IN ('queued', 'downloaded', 'encoded') AND updated < ?", (time.time() - max_age,))
+
+# An encode worker may run on another host with WORK_DIR on shared storage: the WAL journal stays with the bot
+journal = JobJournal(":memory:" if ENCODE_WORKER else JOURNAL_DB)
+
+def file_ok(path, min_size: int = 1) -> bool:
+    return bool(path) and os.path.exists(path) and os.path.getsize(path) >= min_size
+
+async def recover_jobs():
+    # Re-queue unfinished jobs from the journal, each starting after its last completed stage
+    journal.prune()
+    if broker: broker.prune()
+    rows = journal.unfinished()
+    workspace.sweep(journal.live_paths())
+    await asyncio.to_thread(overlay_cache.adopt)
+    for row in rows:
+        try:
+            message = await app.get_messages(row["chat_id"], row["message_id"])
+        except Exception as e:
+            message = None
+            logger.warning(f"Journal: job {row['id']} message lost: {e}")
+        if not message or not (message.video or message.document):
+            journal.advance(row["id"], "failed")
+            continue
+
+        job = Job(row["uid"], message, sess=UserSession(**json.loads(row["settings"])), journal_id=row["id"],
+                  stage=row["stage"], in_path=row["in_path"], out_path=row["out_path"],
+                  result=json.loads(row["result"]) if row["result"] else None)
+        file = message.video or message.document
+        # Downgrade the stage if its files did not survive
+        extra = [r["path"] for r in (job.result or {}).get("renditions") or []]
+        if job.stage == "encoded" and not (file_ok(job.out_path, 1024) and job.result and all(file_ok(p, 1024) for p in extra)):
+            job.stage = "downloaded"
+        if job.stage == "downloaded" and not file_ok(job.in_path, getattr(file, "file_size", 0) or 1):
+            job.stage = "queued"
+        if job.stage != row["stage"]: journal.advance(job.id, job.stage)
+        logger.info(f"Journal: resuming job {job.id} for {job.uid} at '{job.stage}'")
+        scheduler.enqueue(job)
+        try: await app.send_message(job.uid, f"♻️ **Resumed after restart** (Pos: {scheduler.position(job) or 'now'})")
+        except Exception: pass
+
+
+# ==================== ADAPTIVE ENCODE ====================
+PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+PRESET_SPEED = {"ultrafast": 4.0, "superfast": 3.0, "veryfast": 2.2, "faster": 1.4, "fast": 1.0,
+                "medium": 0.75, "slow": 0.4, "slower": 0.15, "veryslow": 0.07}  # vs fast; only until a preset is measured
+BASE_RATE = {"libx264": 15e6, "libx265": 3e6}  # Output pixels/s per thread at -preset fast, CRF 23
+CRF_SPEEDUP = 0.03  # Per CRF step above 23 (fewer bits, slightly less work)
+
+def crf_factor(crf: int) -> float:
+    return max(0.5, 1 + CRF_SPEEDUP * (int(crf) - 23))
+
+def encode_pixels(info: MediaInfo, heights: List[int]) -> float:
+    # Output pixels the encoder has to produce: frames x frame area, summed over renditions
+    num, _, den = info.fps.partition("/")
+    try: fps = float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError): fps = 0
+    aspect = info.width / info.height if info.height else 16 / 9
+    return (info.duration or 0) * (fps or 30) * sum(h * h * aspect for h in heights)
+
+class EncodeModel:
+    """Encode throughput per (codec, preset) in output pixels/s per thread.
+
+    Starts from rough preset ratios and is recalibrated from every finished encode (EWMA, saved to a per-host JSON file),
+    so predictions track this host's CPUs and the governor's thread shares."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.rates: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        self.errors: deque = deque(maxlen=100)  # actual / predicted
+        try:
+            with open(path) as f:
+                self.rates = {(c, p): (r, n) for c, p, r, n in json.load(f)}
+        except (OSError, ValueError, TypeError): pass
+
+    def save(self):
+        if not self.path: return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f: json.dump([[c, p, r, n] for (c, p), (r, n) in self.rates.items()], f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f"Encode model: could not save {self.path}: {e}")
+
+    def rate(self, codec: str, preset: str) -> float:
+        if (codec, preset) in self.rates: return self.rates[(codec, preset)][0]
+        # Unmeasured preset: scale from the best-measured preset of the same codec
+        measured = [(n, p, r) for (c, p), (r, n) in self.rates.items() if c == codec and p in PRESET_SPEED]
+        if measured:
+            _, p, r = max(measured)
+            return r / PRESET_SPEED[p] * PRESET_SPEED.get(preset, 1.0)
+        return BASE_RATE.get(codec, BASE_RATE["libx264"]) * PRESET_SPEED.get(preset, 1.0)
+
+    def predict(self, codec: str, preset: str, crf: int, pixels: float, threads: int) -> float:
+        return pixels / (self.rate(codec, preset) * max(1, threads) * crf_factor(crf))
+
+    def observe(self, codec: str, preset: str, crf: int, pixels: float, threads: int, seconds: float, predicted: float):
+        if pixels <= 0 or seconds <= 0: return
+        measured = pixels / seconds / max(1, threads) / crf_factor(crf)
+        old, n = self.rates.get((codec, preset), (measured, 0))
+        rate = measured if n == 0 else 0.7 * old + 0.3 * measured
+        self.rates[(codec, preset)] = (rate, n + 1)
+        self.save()
+        if predicted > 0: self.errors.append(seconds / predicted)
+        if ADAPTIVE_ENCODE: logger.info(f"Adaptive: {codec}/{preset} predicted {predicted:.0f}s, took {seconds:.0f}s; now {rate / 1e6:.2f} Mpx/s per thread")
+
+    def summary(self) -> str:
+        if not self.errors: return "Encode model: no encodes measured yet"
+        ratios = sorted(self.errors)
+        return f"Encode model: actual/predicted p50 `{ratios[len(ratios) // 2]:.2f}` over `{len(ratios)}` encodes"
+
+encode_model = EncodeModel(ENCODE_MODEL_FILE)
+
+def encode_budget(job) -> Optional[float]:
+    # Seconds this job's encode may take, or None when adaptive mode is off.
+    # What is left of LATENCY_TARGET since queueing, shared with the jobs still waiting behind it.
+    if not ADAPTIVE_ENCODE: return None
+    left = LATENCY_TARGET - (time.time() - job.submitted)
+    waiting = len(scheduler._order())
+    return max(1.0, left / (1 + waiting / scheduler.encode_slots))
+
+def adapt_encode(sess, info: MediaInfo, heights: List[int], threads: int, budget: Optional[float]) -> Tuple["UserSession", float]:
+    # Returns (settings to encode with, predicted encode seconds).
+    # With a budget: the slowest preset (down to ADAPTIVE_SLOWEST) predicted to fit; if even ultrafast
+    # does not, CRF goes up by at most ADAPTIVE_MAX_CRF. Without one the session's own preset is kept.
+    pixels = encode_pixels(info, heights)
+    if budget is None or sess.codec not in BASE_RATE:
+        return sess, encode_model.predict(sess.codec, sess.preset, sess.crf, pixels, threads)
+    slowest = PRESETS.index(ADAPTIVE_SLOWEST) if ADAPTIVE_SLOWEST in PRESETS else PRESETS.index("medium")
+    choice = None
+    for preset in reversed(PRESETS[:slowest + 1]):
+        if encode_model.predict(sess.codec, preset, sess.crf, pixels, threads) <= budget:
+            choice = replace(sess, preset=preset)
+            break
+    if choice is None:
+        for crf in range(sess.crf + 1, sess.crf + ADAPTIVE_MAX_CRF + 1):
+            choice = replace(sess, preset=PRESETS[0], crf=crf)
+            if encode_model.predict(sess.codec, PRESETS[0], crf, pixels, threads) <= budget: break
+    predicted = encode_model.predict(choice.codec, choice.preset, choice.crf, pixels, threads)
+    logger.info(f"Adaptive: budget {budget:.0f}s for {pixels / 1e9:.1f} Gpx on {threads} thread(s) -> "
+                f"{choice.codec}/{choice.preset}/crf{choice.crf}, predicted {predicted:.0f}s")
+    return choice, predicted
+
+
+# ==================== ENCODE BROKER ====================
+class EncodeBroker:
+    """SQLite task queue between the bot and `main.py encode-worker` processes.
+
+    Workers lease a task and renew the lease with heartbeats. A task whose lease runs out
+    (worker crashed, host gone) goes to the next worker that polls, up to max_attempts.
+    in_path/out_path must resolve to the same shared storage on every worker host.
+    """
+
+    def __init__(self, path: str, lease: float, max_attempts: int):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # Rollback journal, not WAL: WAL's shared-memory index doesn't work across hosts
+        self.db.execute("PRAGMA journal_mode=DELETE")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                progress TEXT,
+                result TEXT,
+                error TEXT,
+                not_before REAL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS tasks_state ON tasks(state);
+            CREATE TABLE IF NOT EXISTS workers (
+                id TEXT PRIMARY KEY,
+                slots INTEGER NOT NULL,
+                busy INTEGER NOT NULL DEFAULT 0,
+                seen REAL NOT NULL
+            );""")
+        try: self.db.execute("ALTER TABLE tasks ADD COLUMN not_before REAL")  # brokers created before retry backoff
+        except sqlite3.OperationalError: pass
+
+    def put(self, job_id: int, payload: dict) -> int:
+        # A restarted bot re-attaches to its job's unfinished task instead of encoding it twice
+        if job_id:
+            row = self.db.execute("SELECT id FROM tasks WHERE job_id = ? AND state IN ('pending', 'leased') ORDER BY id DESC", (job_id,)).fetchone()
+            if row: return row[0]
+        now = time.time()
+        cur = self.db.execute(
+            "INSERT INTO tasks (job_id, payload, created, updated) VALUES (?, ?, ?, ?)",
+            (job_id or None, json.dumps(payload), now, now),
+        )
+        return cur.lastrowid
+
+    def reap(self):
+        # Expired leases past their last attempt won't be picked up again
+        now = time.time()
+        self.db.execute(
+            "UPDATE tasks SET state = 'failed', error = 'worker lost', updated = ? WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, now, self.max_attempts),
+        )
+
+    def claim(self, worker: str) -> Optional[Tuple[int, dict]]:
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.reap()
+            # A task this worker gave back (e.g. source not visible on this host) goes to the others first
+            row = self.db.execute(
+                "SELECT id, payload, attempts FROM tasks WHERE (state = 'pending' AND (worker IS NULL OR worker != ? OR COALESCE(not_before, 0) <= ?)) "
+                "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (worker, now, now),
+            ).fetchone()
+            if row:
+                self.db.execute(
+                    "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, progress = NULL, updated = ? WHERE id = ?",
+                    (worker, now + self.lease, now, row[0]),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        if not row: return None
+        if row[2]: logger.info(f"Broker: task {row[0]} retried by {worker} (attempt {row[2] + 1})")
+        return row[0], json.loads(row[1])
+
+    def heartbeat(self, task_id: int, worker: str, progress: Optional[str] = None) -> bool:
+        # False once the lease is gone (expired and re-claimed, or cancelled): the worker must stop
+        now = time.time()
+        cur = self.db.execute(
+            "UPDATE tasks SET lease_until = ?, progress = COALESCE(?, progress), updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (now + self.lease, progress, now, task_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def finish(self, task_id: int, worker: str, result: dict) -> bool:
+        cur = self.db.execute(
+            "UPDATE tasks SET state = 'done', result = ?, error = NULL, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+            (json.dumps(result), time.time(), task_id, worker),
+        )
+        return cur.rowcount == 1
+
+    def fail(self, task_id: int, worker: str, error: str, retry: bool):
+        # retry: back to the queue, unless the task is out of attempts. `worker` is kept so this one
+        # waits BROKER_RETRY_DELAY before it may take the task again; any other worker can have it now
+        now = time.time()
+        self.db.execute(
+            "UPDATE tasks SET state = CASE WHEN ? AND attempts < ? THEN 'pending' ELSE 'failed' END, error = ?, not_before = ?, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (int(retry), self.max_attempts, error, now + BROKER_RETRY_DELAY, now, task_id, worker),
+        )
+
+    def cancel(self, task_id: int):
+        self.db.execute("UPDATE tasks SET state = 'cancelled', updated = ? WHERE id = ? AND state IN ('pending', 'leased')", (time.time(), task_id))
+
+    def get(self, task_id: int) -> tuple:
+        return self.db.execute("SELECT state, progress, result, error FROM tasks WHERE id = ?", (task_id,)).fetchone() or ("failed", None, None, "task vanished")
+
+    def register(self, worker: str, slots: int, busy: int):
+        self.db.execute("INSERT OR REPLACE INTO workers (id, slots, busy, seen) VALUES (?, ?, ?, ?)", (worker, slots, busy, time.time()))
+
+    def summary(self) -> str:
+        live = self.db.execute("SELECT COUNT(*), COALESCE(SUM(slots), 0), COALESCE(SUM(busy), 0) FROM workers WHERE seen > ?", (time.time() - self.lease,)).fetchone()
+        counts = dict(self.db.execute("SELECT state, COUNT(*) FROM tasks WHERE state IN ('pending', 'leased') GROUP BY state").fetchall())
+        return (f"Encode workers: `{live[0]}` live, `{live[2]}/{live[1]}` slots busy; "
+                f"`{counts.get('pending', 0)}` tasks pending, `{counts.get('leased', 0)}` running")
+
+    def prune(self, max_age: float = 7 * 86400):
+        cutoff = time.time() - max_age
+        self.db.execute("DELETE FROM tasks WHERE state NOT IN ('pending', 'leased') AND updated < ?", (cutoff,))
+        self.db.execute("DELETE FROM workers WHERE seen < ?", (cutoff,))
+
+broker = EncodeBroker(BROKER_DB, BROKER_LEASE, BROKER_MAX_ATTEMPTS) if BROKER_DB else None
+
+async def encode(in_path, out_path, sess, status_msg, thumb_path=None, timer=None, job_id=0, budget=None):
+    # process_video in this process, or on an encode worker when a broker is configured
+    if not broker:
+        return await process_video(in_path, sess.watermark_text, out_path, sess, status_msg, thumb_path=thumb_path, timer=timer, renditions=sess.renditions, budget=budget)
+    timer = timer or JobTimer(record=False)
+    # The thumbnail goes next to the output: SCRATCH_DIR may be local tmpfs
+    payload = {"in_path": in_path, "out_path": out_path, "thumb_path": f"{out_path}.jpg" if thumb_path else None, "settings": asdict(sess), "budget": budget}
+    task_id = broker.put(job_id, payload)
+    status.post(status_msg, "⏳ **Waiting for an encode worker...**", urgent=True)
+    try:
+        with timer.stage("encode"):
+            while True:
+                await asyncio.sleep(BROKER_POLL)
+                broker.reap()
+                state, progress, result, error = broker.get(task_id)
+                if state == "done": return result_from_dict(json.loads(result))
+                if state in ("failed", "cancelled"):
+                    logger.warning(f"Broker: task {task_id} {state}: {error}")
+                    return EncodeResult()
+                if progress: status.post(status_msg, progress)
+    except asyncio.CancelledError:
+        broker.cancel(task_id)
+        raise
+
+class RemoteStatus:
+    """Stands in for the status Message inside an encode worker; edits land in `text` for the next heartbeat."""
+
+    def __init__(self, task_id: int):
+        self.chat = SimpleNamespace(id=0)
+        self.id = task_id
+        self.text = None
+
+    async def edit_text(self, text):
+        self.text = text
+
+async def run_task(task_id: int, payload: dict, worker_id: str):
+    if not file_ok(payload["in_path"]):
+        # Shared storage not mounted here (or not synced yet): let another host try
+        return broker.fail(task_id, worker_id, f"{payload['in_path']} not visible on {worker_id}", retry=True)
+    sess = UserSession(**payload["settings"])
+    note = RemoteStatus(task_id)
+    encoding = asyncio.create_task(process_video(payload["in_path"], sess.watermark_text, payload["out_path"], sess, note,
+                                                 thumb_path=payload["thumb_path"], renditions=sess.renditions, budget=payload.get("budget")))
+    try:
+        while True:
+            done, _ = await asyncio.wait({encoding}, timeout=BROKER_HEARTBEAT)
+            if done: break
+            if not broker.heartbeat(task_id, worker_id, note.text):
+                logger.warning(f"Broker: lost the lease on task {task_id}, stopping its encode")
+                return
+        result = encoding.result()
+        if result:
+            broker.finish(task_id, worker_id, result_dict(result))
+        else:
+            broker.fail(task_id, worker_id, "encode failed", retry=False)
+    except Exception as e:
+        logger.error(f"Broker: task {task_id} crashed: {e}")
+        broker.fail(task_id, worker_id, str(e), retry=True)
+    finally:
+        if not encoding.done(): encoding.cancel()
+
+async def run_encode_worker():
+    # `python main.py encode-worker`: pulls tasks from ENCODE_BROKER, MAX_ENCODES at a time
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    running: Set[asyncio.Task] = set()
+    logger.info(f"Encode worker {worker_id} started with {MAX_ENCODES} slot(s)")
+    while True:
+        broker.register(worker_id, MAX_ENCODES, len(running))
+        while len(running) < MAX_ENCODES:
+            claimed = broker.claim(worker_id)
+            if not claimed: break
+            task = asyncio.create_task(run_task(*claimed, worker_id))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await asyncio.sleep(BROKER_POLL)
+
+
+# ==================== RESULT CACHE ====================
+RESULT_KEY_FIELDS = ("watermark_text", "watermark_mode", "codec", "crf", "resolution", "speed", "scale", "preset")
+
+def result_key(file_unique_id: str, sess) -> str:
+    # Same source + same effective settings = same output, whoever sends it
+    settings = json.dumps({k: getattr(sess, k) for k in RESULT_KEY_FIELDS}, sort_keys=True)
+    return hashlib.sha256(f"{file_unique_id}|{settings}".encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """Maps (source file_unique_id, settings) to the Telegram file_id of an already uploaded result."""
+
+    def __init__(self, db: sqlite3.Connection, ttl: float, max_entries: int):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.hits = 0
+        self.misses = 0
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                duration INTEGER, width INTEGER, height INTEGER,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 0
+            )""")
+
+    def get(self, key: str) -> Optional[tuple]:
+        row = self.db.execute(
+            "SELECT file_id, duration, width, height FROM results WHERE key = ? AND created > ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        if not row:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE results SET last_used = ?, uses = uses + 1 WHERE key = ?", (time.time(), key))
+        return row
+
+    def put(self, key: str, file_id: str, duration: int, width: int, height: int):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO results (key, file_id, duration, width, height, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, file_id, duration, width, height, now, now),
+        )
+        self.evict()
+
+    def forget(self, key: str):
+        self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+
+    def evict(self):
+        self.db.execute("DELETE FROM results WHERE created <= ?", (time.time() - self.ttl,))
+        # Least recently used beyond the size cap
+        self.db.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+result_cache = ResultCache(journal.db, RESULT_CACHE_TTL, RESULT_CACHE_MAX)
+
+async def send_cached_result(job) -> bool:
+    # Resend a stored output instead of downloading, encoding and uploading again
+    # With renditions it's all or nothing: every size must be cached
+    file = job.message.video or job.message.document
+    if not getattr(file, "file_unique_id", None): return False
+    heights = sorted(set(job.sess.renditions or [job.sess.resolution]))
+    keys = [result_key(file.file_unique_id, replace(job.sess, resolution=h, renditions=[])) for h in heights]
+    hits = [result_cache.get(key) for key in keys]
+    if not all(hits): return False
+    caption = job.message.caption.html if job.message.caption else f"✅ **Done**"
+    sent = set()
+    for key, (file_id, duration, width, height) in zip(keys, hits):
+        # Heights that clamped to the same output share one file
+        if file_id in sent: continue
+        sent.add(file_id)
+        try:
+            await app.send_video(job.uid, file_id, caption=caption, duration=duration or 0, width=width or 0, height=height or 0)
+        except FloodWait:
+            raise
+        except Exception as e:
+            # file_id no longer valid; encode normally
+            logger.warning(f"Result cache: stale entry dropped ({e})")
+            result_cache.forget(key)
+            return False
+    logger.info(f"Result cache: hit for user {job.uid} ({result_cache.hits} hits / {result_cache.misses} misses)")
+    if job.id: journal.advance(job.id, "uploaded")
+    return True
+
+
+# ==================== PARALLEL TRANSFER ====================
+DOWNLOAD_PART_SIZE = 1024 * 1024  # upload.GetFile maximum; offsets must be multiples of it
+UPLOAD_PART_SIZE = 512 * 1024  # upload.SaveBigFilePart maximum
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Telegram only accepts SaveBigFilePart above this
+
+def use_parallel(size: int) -> bool:
+    return TRANSFER_WINDOW > 0 and size > max(TRANSFER_MIN_SIZE, BIG_FILE_SIZE)
+
+class TelegramTransport:
+    """Raw part I/O over one media session, opened the way pyrogram's get_file/save_file do."""
+
+    def __init__(self, client: Client, dc_id: int = 0):
+        self.client = client
+        self.dc_id = dc_id
+        self.session = None
+
+    async def __aenter__(self):
+        storage = self.client.storage
+        home = await storage.dc_id()
+        dc_id = self.dc_id or home
+        test_mode = await storage.test_mode()
+        auth_key = await storage.auth_key() if dc_id == home else await Auth(self.client, dc_id, test_mode).create()
+        self.session = Session(self.client, dc_id, auth_key, test_mode, is_media=True)
+        await self.session.start()
+        try:
+            if dc_id != home:
+                exported = await self.client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+                await self.session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+        except BaseException:
+            await self.session.stop()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.stop()
+
+    async def get_part(self, location, offset: int, limit: int) -> bytes:
+        # retries=1: failed parts are retried by with_retries, not by the session
+        r = await self.session.invoke(raw.functions.upload.GetFile(location=location, offset=offset, limit=limit), retries=1, sleep_threshold=30)
+        if not isinstance(r, raw.types.upload.File):
+            raise RuntimeError("file is served from a CDN")
+        return r.bytes
+
+    async def save_part(self, file_id: int, index: int, total: int, data: bytes):
+        rpc = raw.functions.upload.SaveBigFilePart(file_id=file_id, file_part=index, file_total_parts=total, bytes=data)
+        if not await self.session.invoke(rpc, retries=1, sleep_threshold=30):
+            raise ConnectionError(f"part {index} was not saved")
+
+class LocalTransport:
+    """Stand-in for TelegramTransport: serves parts of a local file with artificial latency and failures."""
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.5, fail_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.saved: Dict[int, Dict[int, int]] = {}  # file_id -> {part: size}
+
+    async def __aenter__(self): return self
+
+    async def __aexit__(self, *exc): pass
+
+    async def _round_trip(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+            if random.random() < self.fail_rate:
+                self.failures += 1
+                raise ConnectionError("injected failure")
+        finally:
+            self.in_flight -= 1
+
+    async def get_part(self, location, offset: int, limit: int) -> bytes:
+        await self._round_trip()
+        with open(location, "rb") as f:
+            f.seek(offset)
+            return f.read(limit)
+
+    async def save_part(self, file_id: int, index: int, total: int, data: bytes):
+        await self._round_trip()
+        self.saved.setdefault(file_id, {})[index] = len(data)
+
+async def with_retries(call, *args):
+    attempt = 0
+    while True:
+        try:
+            return await call(*args)
+        except FloodWait as e:
+            await asyncio.sleep(e.value)
+        except Exception as e:
+            attempt += 1
+            if attempt > TRANSFER_RETRIES: raise
+            logger.warning(f"Transfer: retry {attempt}/{TRANSFER_RETRIES} ({e})")
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+async def parallel_stream(transport, location, size: int, window: int = TRANSFER_WINDOW, progress=None, progress_args=()):
+    # Yields the file in order while the next `window - 1` parts are already being fetched.
+    # Nothing beyond the window is requested, so memory stays at window x 1 MiB however slow the consumer is.
+    parts = max(1, -(-size // DOWNLOAD_PART_SIZE))
+    window = max(1, window)
+    pending = {}
+    done = 0
+    try:
+        for index in range(parts):
+            for ahead in range(index, min(parts, index + window)):
+                if ahead not in pending:
+                    pending[ahead] = asyncio.ensure_future(with_retries(transport.get_part, location, ahead * DOWNLOAD_PART_SIZE, DOWNLOAD_PART_SIZE))
+            chunk = await pending.pop(index)
+            done += len(chunk)
+            if progress: await progress(min(done, size), size, *progress_args)
+            yield chunk
+            if len(chunk) < DOWNLOAD_PART_SIZE: break
+    finally:
+        for task in pending.values(): task.cancel()
+
+async def parallel_upload(transport, path: str, window: int = TRANSFER_WINDOW, progress=None, progress_args=()) -> Tuple[int, int]:
+    # Saves the file as `window` concurrent part streams; returns (file_id, parts) for InputFileBig
+    size = os.path.getsize(path)
+    parts = max(1, -(-size // UPLOAD_PART_SIZE))
+    file_id = random.getrandbits(63)
+    indices = iter(range(parts))  # shared, so each part is taken exactly once
+    sent = 0
+
+    async def pump(fd):
+        nonlocal sent
+        for index in indices:
+            data = os.pread(fd, UPLOAD_PART_SIZE, index * UPLOAD_PART_SIZE)
+            await with_retries(transport.save_part, file_id, index, parts, data)
+            sent += len(data)
+            if progress: await progress(sent, size, *progress_args)
+
+    fd = os.open(path, os.O_RDONLY)
+    pumps = [asyncio.ensure_future(pump(fd)) for _ in range(min(max(1, window), parts))]
+    try:
+        await asyncio.gather(*pumps)
+    finally:
+        for task in pumps: task.cancel()
+        os.close(fd)
+    return file_id, parts
+
+def file_location(media):
+    fid = FileId.decode(media.file_id)
+    if fid.file_type == FileType.PHOTO:
+        location = raw.types.InputPhotoFileLocation(id=fid.media_id, access_hash=fid.access_hash, file_reference=fid.file_reference, thumb_size=fid.thumbnail_size)
+    else:
+        location = raw.types.InputDocumentFileLocation(id=fid.media_id, access_hash=fid.access_hash, file_reference=fid.file_reference, thumb_size=fid.thumbnail_size)
+    return fid.dc_id, location
+
+async def download_chunks(message, progress=None, progress_args=()):
+    # In-order chunks of the message's media; falls back to pyrogram's serial stream if the media session can't be set up
+    media = message.video or message.document
+    size = getattr(media, "file_size", 0) or 0
+    if use_parallel(size):
+        started = False
+        try:
+            dc_id, location = file_location(media)
+            async with TelegramTransport(app, dc_id) as transport:
+                async for chunk in parallel_stream(transport, location, size, progress=progress, progress_args=progress_args):
+                    started = True
+                    yield chunk
+            return
+        except Exception as e:
+            if started: raise
+            logger.warning(f"Transfer: parallel download unavailable ({e}), using pyrogram's")
+    async for chunk in app.stream_media(message): yield chunk
+
+async def download_file(message, path, progress=None, progress_args=()):
+    # Drop-in for app.download_media: returns path, or None on failure
+    media = message.video or message.document
+    if use_parallel(getattr(media, "file_size", 0) or 0):
+        try:
+            with open(path, "wb") as f:
+                async for chunk in download_chunks(message, progress, progress_args): f.write(chunk)
+            return path
+        except Exception as e:
+            logger.warning(f"Transfer: parallel download failed ({e}), retrying serially")
+    return await app.download_media(message, file_name=path, progress=progress, progress_args=progress_args)
+
+async def send_video_file(chat_id, path, caption, thumb, file_name, duration, width, height, progress=None, progress_args=()):
+    # Drop-in for app.send_video with a local file; big files are uploaded in parallel parts
+    if use_parallel(os.path.getsize(path)):
+        try:
+            async with TelegramTransport(app) as transport:
+                file_id, parts = await parallel_upload(transport, path, progress=progress, progress_args=progress_args)
+            media = raw.types.InputMediaUploadedDocument(
+                mime_type="video/mp4",
+                file=raw.types.InputFileBig(id=file_id, parts=parts, name=file_name),
+                thumb=await app.save_file(thumb) if thumb else None,
+                attributes=[
+                    raw.types.DocumentAttributeVideo(supports_streaming=True, duration=duration, w=width, h=height),
+                    raw.types.DocumentAttributeFilename(file_name=file_name),
+                ],
+            )
+            r = await app.invoke(raw.functions.messages.SendMedia(
+                peer=await app.resolve_peer(chat_id), media=media, random_id=app.rnd_id(),
+                **await utils.parse_text_entities(app, caption, None, None),
+            ))
+            for update in r.updates:
+                if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                    return await Message._parse(app, update.message, {u.id: u for u in r.users}, {c.id: c for c in r.chats})
+            return None
+        except FloodWait:
+            raise
+        except Exception as e:
+            logger.warning(f"Transfer: parallel upload failed ({e}), retrying serially")
+    return await app.send_video(chat_id, path, caption=caption, thumb=thumb, file_name=file_name, duration=duration, width=width, height=height, progress=progress, progress_args=progress_args)
+
+
+# ==================== STREAMING ====================
+def is_streamable(head: bytes) -> bool:
+    # Matroska / WebM and MPEG-TS can be decoded front to back
+    if head[:4] == b"\x1a\x45\xdf\xa3": return True
+    if len(head) > 188 and head[0] == 0x47 and head[188] == 0x47: return True
+    # MP4 / MOV: only if the moov atom comes before mdat (faststart)
+    if head[4:8] != b"ftyp": return False
+    pos = 0
+    while pos + 8 <= len(head):
+        size = int.from_bytes(head[pos:pos + 4], "big")
+        kind = head[pos + 4:pos + 8]
+        if kind == b"moov": return True
+        if kind == b"mdat": return False
+        if size == 1:
+            if pos + 16 > len(head): return False
+            size = int.from_bytes(head[pos + 8:pos + 16], "big")
+        if size < 8: return False  # 0 = "runs to EOF", anything else is corrupt
+        pos += size
+    return False
+
+async def stream_and_process(message, dl_path, out_path, sess, status_msg, timer, slot, budget=lambda: None, **kw):
+    # Returns (in_path, EncodeResult). in_path is None if the source was never fully written to disk.
+    # The download is always mirrored to dl_path, so a failed or unstreamable run falls back to the file.
+    # slot(): held for the encode only; the first chunk is sniffed before it, and a source that can't be
+    # streamed is downloaded in full before it too. budget(): encode budget, asked once the slot is held.
+    kw["timer"] = timer
+    file = message.video or message.document
+    size = getattr(file, "file_size", 0) or 0
+    duration = getattr(file, "duration", 0) or 0
+    dl_start = time.perf_counter()
+    chunks = download_chunks(message)
+    try:
+        head = await asyncio.wait_for(chunks.__anext__(), transfer_timeout(size))
+    except StopAsyncIteration:
+        return None, EncodeResult()
+
+    if not is_streamable(head):
+        logger.info("Stream: container not streamable, downloading first")
+        async def download():
+            with open(dl_path, "wb") as f:
+                f.write(head)
+                async for chunk in chunks: f.write(chunk)
+        await asyncio.wait_for(download(), transfer_timeout(size))
+        timer.transfer("download", os.path.getsize(dl_path), time.perf_counter() - dl_start)
+        timer.add("download", time.perf_counter() - dl_start)
+        async with slot():
+            status.post(status_msg, "⏳ **Starting FFmpeg...**", urgent=True)
+            return dl_path, await process_video(dl_path, sess.watermark_text, out_path, sess, status_msg, budget=budget(), **kw)
+
+    downloaded = False
+
+    async def feed(stdin):
+        nonlocal downloaded
+        pipe_open = True
+        try:
+            with open(dl_path, "wb") as f:
+                async def push(chunk):
+                    nonlocal pipe_open
+                    f.write(chunk)
+                    if not pipe_open: return
+                    try:
+                        stdin.write(chunk)
+                        await stdin.drain()
+                    except (BrokenPipeError, ConnectionResetError):
+                        pipe_open = False  # ffmpeg gave up; keep downloading for the fallback
+
+                await push(head)
+                async for chunk in chunks: await push(chunk)
+            downloaded = True
+        finally:
+            # Also when the download fails: ffmpeg would otherwise wait on stdin until the watchdog kills it
+            if pipe_open: stdin.close()
+        # Overlaps with the encode stage
+        timer.transfer("download", os.path.getsize(dl_path), time.perf_counter() - dl_start)
+        timer.add("download", time.perf_counter() - dl_start)
+
+    # Plan from the first chunk (moov / headers are at the front of a streamable file), so the planner
+    # can still skip upscaling and copy audio; fields the head lacks come from Telegram's metadata
+    with timer.stage("probe"):
+        info = await probe_media(dl_path, head=head)
+    info.width, info.height = info.width or getattr(file, "width", 0) or 0, info.height or getattr(file, "height", 0) or 0
+    info.duration = info.duration or duration
+
+    async def encode_stream():
+        kw["budget"] = budget()
+        status.post(status_msg, "⚙️ **Downloading + Processing...**", urgent=True)
+        result = await process_video(dl_path, sess.watermark_text, out_path, sess, status_msg, feed=feed, duration=duration, info=info, **kw)
+        if result: return dl_path, result
+
+        # A cut-off MKV / TS / faststart MP4 still encodes cleanly, just short: only a complete mirror is a fallback
+        if not downloaded or (size and os.path.getsize(dl_path) != size):
+            logger.warning("Stream: download did not complete, no fallback")
+            return None, result
+        logger.warning("Stream: piped encode failed, retrying from the downloaded file")
+        return dl_path, await process_video(dl_path, sess.watermark_text, out_path, sess, status_msg, **kw)
+
+    # The rest of the download feeds ffmpeg, so it happens inside the slot
+    async with slot():
+        return await asyncio.wait_for(encode_stream(), transfer_timeout(size) + encode_timeout(duration))
+
+async def worker(job):
+    uid = job.uid
+    sess = job.sess or await get_session(uid)
+    message_to_process = job.message
+    file = message_to_process.video or message_to_process.document
+    original_caption = message_to_process.caption.html if message_to_process.caption else ""
+    original_name = file.file_name if file.file_name else "video.mp4"
+    file_size = getattr(file, "file_size", 0) or 0
+    
+    timer = JobTimer(uid)
+    timer.info["queue_wait_s"] = round(timer.start - job.submitted, 3)
+    timer.info["resumed_from"] = job.stage
+    outcome = "error"
+    status_msg = job.batch_line
+    dl_path = job.in_path or os.path.join(WORK_DIR, f"in_{uid}_{int(time.time())}.mp4")
+    out_path = job.out_path or os.path.join(WORK_DIR, f"out_{uid}_{int(time.time())}_{random.randint(100,999)}.mp4")
+    in_path = dl_path
+    
+    # Every artifact of this job is deleted when the block exits, whatever the outcome
+    ws = job.workspace or workspace.try_reserve(f"job{job.id or id(job)}", 0) or JobWorkspace(workspace, "adhoc", 0)
+    has_custom_thumb = bool(sess.custom_thumb_path and os.path.exists(sess.custom_thumb_path))
+    thumb_path = None if has_custom_thumb else ws.scratch(f"{os.path.basename(out_path)}.jpg")
+    targets = rendition_targets(out_path, sess.renditions or [sess.resolution])  # output path -> requested height
+    ws.track(dl_path, *targets, f"{out_path}.jpg")
+    with ws:
+        try:
+            # Sent in here, so a FloodWait still ends in a recorded outcome
+            if status_msg is None:
+                status_msg = await retry_flood(app.send_message, uid, "⬇️ **Downloading...**" if job.stage == "queued" else "♻️ **Resuming...**")
+            if job.stage == "queued" and await send_cached_result(job):
+                outcome = "cached"
+                status.drop(status_msg)
+                await status_msg.delete()
+                return
+            if job.stage == "encoded":
+                # Recovered after a crash between encode and upload
+                result = result_from_dict(job.result)
+                if result.thumb and not os.path.exists(result.thumb): result.thumb = None
+            elif job.stage == "downloaded":
+                async with scheduler.encode_slot(job, status_msg, timer):
+                    status.post(status_msg, "⏳ **Starting FFmpeg...**", urgent=True)
+                    result = await encode(in_path, out_path, sess, status_msg, thumb_path, timer, job.id, encode_budget(job))
+            elif STREAM_MODE and not broker:  # a remote worker can only read a finished file
+                in_path, result = await stream_and_process(
+                    message_to_process, dl_path, out_path, sess, status_msg, timer, lambda: scheduler.encode_slot(job, status_msg, timer),
+                    budget=lambda: encode_budget(job), thumb_path=thumb_path, renditions=sess.renditions)
                 if not in_path:
-                    await status_msg.edit("❌ Download Failed.")
+                    outcome = "download_failed"
+                    status.post(status_msg, "❌ Download Failed.", urgent=True)
+                    return
+                journal.advance(job.id, "downloaded")
+            else:
+                dl_start = time.perf_counter()
+                with timer.stage("download"):
+                    in_path = await asyncio.wait_for(
+                        download_file(message_to_process, dl_path, progress=download_progress, progress_args=(status_msg, time.time())),
+                        transfer_timeout(file_size))
+            
+                if not in_path:
+                    outcome = "download_failed"
+                    status.post(status_msg, "❌ Download Failed.", urgent=True)
+                    return
+                timer.transfer("download", os.path.getsize(in_path), time.perf_counter() - dl_start)
+                journal.advance(job.id, "downloaded")
+
+                async with scheduler.encode_slot(job, status_msg, timer):
+                    status.post(status_msg, "⏳ **Starting FFmpeg...**", urgent=True)
+                    result = await encode(in_path, out_path, sess, status_msg, thumb_path, timer, job.id, encode_budget(job))
+        
+            if result:
+                # The encode reports duration/size and grabs the thumbnail itself; probe only if that failed
+                with timer.stage("thumbnail"):
+                    if not result.duration: result.width, result.height, result.duration = await get_video_info(out_path)
+                    thumb = sess.custom_thumb_path if has_custom_thumb else (result.thumb or await generate_thumbnail(out_path))
+                is_custom_thumb = has_custom_thumb
+                if job.stage != "encoded":
+                    journal.advance(job.id, "encoded", {**result_dict(result), "thumb": None if is_custom_thumb else thumb})
+
+                status.post(status_msg, "📤 **Uploading...**", urgent=True)
+                name_root, ext = os.path.splitext(original_name)
+                final_caption = original_caption if original_caption else f"✅ **Done**"
+                source_id = getattr(file, "file_unique_id", None)
+
+                # Smallest rendition first: it is ready to watch soonest
+                outputs = sorted([result, *result.renditions], key=lambda r: r.height)
+                up_start, up_bytes = time.perf_counter(), 0
+                with timer.stage("upload"):
+                    for r in outputs:
+                        path = r.path or out_path
+                        label = f" {r.height}p" if result.renditions else ""
+                        size = os.path.getsize(path)
+                        sent = await asyncio.wait_for(
+                            send_video_file(uid, path, final_caption, thumb, f"{name_root}{FILENAME_SUFFIX}{label}{ext}", int(r.duration), r.width, r.height, progress=upload_progress, progress_args=(status_msg, time.time())),
+                            transfer_timeout(size))
+                        up_bytes += size
+                        if source_id and sent and sent.video:
+                            # Keyed on what was actually encoded: an adapted (faster / higher CRF) output must not answer full-quality requests.
+                            # One entry per requested height the output stands for, so clamped duplicates still match next time.
+                            for h in r.heights or [targets.get(path, sess.resolution)]:
+                                r_sess = replace(sess, resolution=h, renditions=[], preset=result.preset or sess.preset, crf=result.crf or sess.crf)
+                                result_cache.put(result_key(source_id, r_sess), sent.video.file_id, int(r.duration), r.width, r.height)
+                timer.transfer("upload", up_bytes, time.perf_counter() - up_start)
+                journal.advance(job.id, "uploaded")
+                outcome = "ok"
+            else:
+                outcome = "encode_failed"
+                status.post(status_msg, f"❌ Processing {result.error or 'Failed'}.", urgent=True)
+        
+            if outcome == "ok":
+                status.drop(status_msg)
+                await status_msg.delete()
+
+        except asyncio.CancelledError:
+            # /cancel: leaving `with ws` removes the partial files, the scheduler frees the slot
+            outcome = "cancelled"
+            status.post(status_msg, "🛑 **Cancelled.**", urgent=True)
+            raise
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            logger.warning(f"Worker: job {job.id} for {uid} hit its stage timeout")
+            status.post(status_msg, "⏱ **Timed out.** The transfer or encode made no progress in time.", urgent=True)
+        except Exception as e:
+            logger.error(f"Worker Error: {e}")
+            status.post(status_msg, f"❌ Error: {e}", urgent=True)
+        finally:
+            if outcome not in ("ok", "cached") and job.id: journal.advance(job.id, "cancelled" if outcome == "cancelled" else "failed")
+            if job.batch_line: job.batch_line.batch.finish(job.batch_line, outcome)
+            timer.finish(outcome)
+
+
+# ==================== SCHEDULER ====================
+@dataclass
+class Job:
+    uid: int
+    message: Message
+    sess: UserSession = None                   # settings snapshot taken when the job was queued
+    journal_id: int = 0
+    stage: str = "queued"                      # last completed stage, see JOB_STAGES
+    in_path: Optional[str] = None
+    out_path: Optional[str] = None
+    result: Optional[dict] = None              # EncodeResult fields once encoded
+    workspace: Optional["JobWorkspace"] = None # disk reservation, granted when the job is admitted
+    batch_line: Optional["BatchLine"] = None   # set if the job reports into a batch status message
+    task: Optional[asyncio.Task] = None        # the running worker, so /cancel can stop it
+    encoded: bool = False                      # done with its encoder (or never needs one)
+    submitted: float = field(default_factory=time.time)
+
+    @property
+    def id(self) -> int:
+        return self.journal_id
+
+class EncodeScheduler:
+    """Process-wide job queue: at most `slots` jobs run at once, users are served round-robin, owner first.
+
+    Running jobs overlap their downloads and uploads; only `encode_slots` of them encode at a time (0 = no cap).
+    Encoders are handed out in the same order: owner first, then one per user per turn."""
+
+    def __init__(self, slots: int, encode_slots: int = 0):
+        self.slots = max(1, slots)
+        self.encode_slots = encode_slots or self.slots
+        self.encoding: List[Job] = []                            # jobs holding an encode slot
+        self.waiting: "OrderedDict[int, deque]" = OrderedDict()  # uid -> (job, future) waiting for an encoder; key order is the turn
+        self.avg_encode_time = 90.0                              # EWMA of seconds holding an encode slot
+        self.pending: "OrderedDict[int, deque]" = OrderedDict()  # uid -> jobs; key order is the round-robin turn
+        self.running: Dict[int, int] = {}                        # uid -> jobs in flight
+        self.active: List[Job] = []                              # jobs in flight
+        self.avg_job_time = 120.0                                # EWMA of wall time per job (seconds)
+        self.retry_pending = False
+
+    @property
+    def in_flight(self) -> int:
+        return sum(self.running.values())
+
+    @property
+    def encoding_now(self) -> int:
+        return len(self.encoding)
+
+    def submit(self, uid: int, message: Message, sess: UserSession, batch: "VideoBatch" = None, source: Optional[str] = None) -> Job:
+        snapshot = UserSession(**asdict(sess))
+        job = Job(uid, message, sess=snapshot, journal_id=journal.add(uid, message, snapshot))
+        if batch:
+            file = message.video or message.document
+            job.batch_line = batch.add(getattr(file, "file_name", None) or f"video {len(batch.lines) + 1}")
+        stamp = f"{uid}_{job.id}"
+        job.in_path = os.path.join(WORK_DIR, f"in_{stamp}.mp4")
+        job.out_path = os.path.join(WORK_DIR, f"out_{stamp}.mp4")
+        journal.set_paths(job.id, job.in_path, job.out_path)
+        if source:
+            # Already downloaded (a previewed video): the job starts at the encode
+            os.replace(source, job.in_path)
+            job.stage = "downloaded"
+            journal.advance(job.id, "downloaded")
+        return self.enqueue(job)
+
+    def enqueue(self, job: Job) -> Job:
+        self.pending.setdefault(job.uid, deque()).append(job)
+        self._pump()
+        return job
+
+    def cancel(self, uid: int, running: bool = False) -> Tuple[int, int]:
+        # Drops the user's queued jobs; running=True also stops the live ones (ffmpeg killed, transfers aborted).
+        # Returns (queued, running) counts.
+        jobs = self.pending.pop(uid, None) or ()
+        for job in jobs:
+            journal.advance(job.id, "cancelled")
+            if job.batch_line: job.batch_line.batch.finish(job.batch_line, "cancelled")
+        stopped = 0
+        for job in self.active if running else ():
+            if job.uid == uid and job.task and not job.task.done():
+                job.task.cancel()
+                stopped += 1
+        return len(jobs), stopped
+
+    def queued(self, uid: int) -> int:
+        return len(self.pending.get(uid, ()))
+
+    @staticmethod
+    def _turns(queues) -> list:
+        # Owner's entries first, then one entry per user per turn
+        order = list(queues.get(OWNER_ID, ()))
+        rings = [list(q) for u, q in queues.items() if u != OWNER_ID]
+        for i in range(max((len(r) for r in rings), default=0)):
+            order.extend(r[i] for r in rings if i < len(r))
+        return order
+
+    def _order(self) -> List[Job]:
+        # Encode order if nothing else arrived: jobs waiting for an encoder, running jobs still downloading,
+        # then queued ones; the owner's jobs get the next free encoder wherever they are
+        waiting = [job for job, _ in self._turns(self.waiting)]
+        ahead = {id(j) for j in self.encoding + waiting}
+        downloading = [j for j in self.active if id(j) not in ahead and not j.encoded and j.stage != "encoded"]
+        order = waiting + downloading + self._turns(self.pending)
+        return [j for j in order if j.uid == OWNER_ID] + [j for j in order if j.uid != OWNER_ID]
+
+    def position(self, job: Job) -> int:
+        # Place in line for an encoder; 0 means the job is encoding or past it
+        for i, j in enumerate(self._order()):
+            if j is job: return i + 1
+        return 0
+
+    def estimated_wait(self, job: Job) -> float:
+        pos = self.position(job)
+        if pos == 0: return 0.0
+        # Encodes are the bottleneck: everything encoding or ahead of this job encodes first, minus the free encode slots
+        blocking = pos - 1 + self.encoding_now - self.encode_slots + 1
+        return max(0, math.ceil(blocking / self.encode_slots)) * self.avg_encode_time
+
+    @asynccontextmanager
+    async def encode_slot(self, job: Job, status_msg=None, timer=None):
+        # Held for the ffmpeg part of a job; the wait shows up as the job's "encode_wait" stage
+        with (timer or JobTimer(record=False)).stage("encode_wait"):
+            if self.encoding_now < self.encode_slots and not self.waiting:
+                self.encoding.append(job)
+            else:
+                if status_msg is not None: status.post(status_msg, "⏳ **Waiting for a free encoder...**", urgent=True)
+                granted = asyncio.get_running_loop().create_future()
+                self.waiting.setdefault(job.uid, deque()).append((job, granted))
+                try:
+                    await granted
+                except asyncio.CancelledError:
+                    if granted.done() and not granted.cancelled(): self._release(job)  # granted just before the cancel
+                    else: self._unwait(job)
+                    raise
+        start = time.time()
+        try: yield
+        finally:
+            job.encoded = True
+            self._release(job)
+            self.avg_encode_time = 0.7 * self.avg_encode_time + 0.3 * (time.time() - start)
+
+    def _unwait(self, job: Job):
+        q = self.waiting.get(job.uid)
+        if q is None: return
+        kept = [w for w in q if w[0] is not job]
+        q.clear()
+        q.extend(kept)
+        if not q: del self.waiting[job.uid]
+
+    def _release(self, job: Job):
+        # Frees job's encoder and hands free encoders out owner first, then one per user per turn
+        self.encoding = [j for j in self.encoding if j is not job]
+        while self.encoding_now < self.encode_slots and self.waiting:
+            uid = OWNER_ID if OWNER_ID in self.waiting else next(iter(self.waiting))
+            q = self.waiting.pop(uid)
+            nxt, granted = q.popleft()
+            if q: self.waiting[uid] = q  # re-inserted at the back: next user gets the next turn
+            self.encoding.append(nxt)
+            granted.set_result(None)
+
+    def _peek(self) -> Optional[Job]:
+        if self.pending.get(OWNER_ID): return self.pending[OWNER_ID][0]
+        q = next((q for q in self.pending.values() if q), None)
+        return q[0] if q else None
+
+    def _take(self, job: Job):
+        q = self.pending.pop(job.uid)
+        q.popleft()
+        if q: self.pending[job.uid] = q  # re-inserted at the back: next user gets the next turn
+
+    def _pump(self):
+        while self.in_flight < self.slots:
+            job = self._peek()
+            if not job: return
+            need = job_disk_need(job)
+            job.workspace = workspace.try_reserve(f"job{job.id or id(job)}", need)
+            if job.workspace is None:
+                if not workspace.could_ever_fit(need):
+                    self._take(job)
+                    asyncio.create_task(self._reject(job, need))
                     continue
+                # Disk is busy with other jobs: hold the queue until some of them finish
+                if not self.retry_pending:
+                    self.retry_pending = True
+                    logger.info(f"Workspace: holding job {job.id}, needs {need / 1e9:.2f} GB, {workspace.available() / 1e9:.2f} GB available")
+                    asyncio.get_running_loop().call_later(DISK_RETRY, self._retry)
+                return
+            self._take(job)
+            self.running[job.uid] = self.running.get(job.uid, 0) + 1
+            self.active.append(job)
+            job.task = asyncio.create_task(self._run(job))
+
+    def _retry(self):
+        self.retry_pending = False
+        self._pump()
+
+    async def _reject(self, job: Job, need: int):
+        if job.id: journal.advance(job.id, "failed")
+        try: await app.send_message(job.uid, f"❌ **Not enough disk space** for this file (needs ~{need / 1e9:.1f} GB).")
+        except Exception: pass
+
+    async def _run(self, job: Job):
+        start = time.time()
+        try:
+            logger.info(f"Job start: user={job.uid} waited={start - job.submitted:.1f}s in_flight={self.in_flight}/{self.slots}")
+            await worker(job)
+        finally:
+            n = self.running.get(job.uid, 1) - 1
+            if n: self.running[job.uid] = n
+            else: self.running.pop(job.uid, None)
+            self.active = [j for j in self.active if j is not job]
+            if job.workspace: job.workspace.close()
+            self.avg_job_time = 0.7 * self.avg_job_time + 0.3 * (time.time() - start)
+            self._pump()
+
+# Encodes are capped here only when they run here; encode workers enforce their own MAX_ENCODES
+scheduler = EncodeScheduler(FRONTEND_JOBS, 0 if broker else MAX_ENCODES)
+
+def format_wait(seconds: float) -> str:
+    if seconds <= 0: return "now"
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"~{h}h {m}m" if h else (f"~{m}m" if m else f"~{s}s")
+
+
+# ==================== BATCHES ====================
+BATCH_SHOWN = 8  # Active files listed in a batch status message
+
+class BatchLine:
+    """One video of a batch. worker() posts to it like a status Message; the batch renders all lines into one."""
+
+    def __init__(self, batch: "VideoBatch", name: str):
+        self.batch, self.name = batch, name
+        self.state = "queued"  # queued / active / ok / failed / cancelled
+        self.text = ""
+
+    def update(self, text: str):
+        # Title + progress bar of the per-file status, on one line
+        if self.state == "queued": self.state = "active"
+        self.text = " ".join(text.splitlines()[:2])
+        self.batch.refresh()
+
+    async def delete(self):
+        pass  # the batch message stays; finish() records the outcome
+
+class VideoBatch:
+    """Videos a user sent together: queued as separate jobs, reported in one status message."""
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self.lines: List[BatchLine] = []
+        self.msg: Optional[Message] = None
+        self.started = time.time()
+
+    def add(self, name: str) -> BatchLine:
+        line = BatchLine(self, name)
+        self.lines.append(line)
+        return line
+
+    def finish(self, line: BatchLine, outcome: str):
+        line.state = "ok" if outcome in ("ok", "cached") else ("cancelled" if outcome == "cancelled" else "failed")
+        self.refresh(urgent=all(l.state not in ("queued", "active") for l in self.lines))
+
+    def render(self) -> str:
+        counts = {s: sum(l.state == s for l in self.lines) for s in ("queued", "active", "ok", "failed", "cancelled")}
+        head = f"{counts['ok']}/{len(self.lines)} done"
+        if counts["failed"]: head += f", {counts['failed']} failed"
+        if counts["cancelled"]: head += f", {counts['cancelled']} cancelled"
+        if not counts["queued"] and not counts["active"]:
+            took = int(time.time() - self.started)
+            failed = [f"✗ `{l.name[:32]}` {l.text}" for l in self.lines if l.state == "failed"][:BATCH_SHOWN]
+            return "\n".join([f"📦 **Batch finished** – {head} in {took // 60}m {took % 60}s", *failed])
+        out = [f"📦 **Batch** – {head}"]
+        out += [f"▸ `{l.name[:32]}` {l.text}" for l in self.lines if l.state == "active"][:BATCH_SHOWN]
+        if counts["queued"]: out.append(f"🕒 {counts['queued']} waiting")
+        return "\n".join(out)
+
+    def refresh(self, urgent: bool = False):
+        if self.msg: status.post(self.msg, self.render(), urgent)
+
+pending_batches: Dict[int, List[Message]] = {}  # uid -> videos still arriving
+
+def drop_pending_batch(uid: int) -> int:
+    # Forget videos still inside the BATCH_WAIT window; their flush task then finds nothing to queue
+    messages = pending_batches.pop(uid, None) or []
+    n = len(messages)
+    messages.clear()
+    return n
 
-                out_path = os.path.join(WORK_DIR, f"out_{uid}_{int(time.time())}_{random.randint(100,999)}.mp4")
-                await status_msg.edit(f"⏳ **Starting FFmpeg...**")
-                
-                success = await process_video(in_path, sess.watermark_text, out_path, sess, status_msg)
-                
-                if success:
-                    _, _, out_duration = await get_video_info(out_path)
-                    thumb = sess.custom_thumb_path if (sess.custom_thumb_path and os.path.exists(sess.custom_thumb_path)) else await generate_thumbnail(out_path)
-                    is_custom_thumb = (thumb == sess.custom_thumb_path)
-
-                    await status_msg.edit_text(f"📤 **Uploading...**")
-                    name_root, ext = os.path.splitext(original_name)
-                    final_filename = f"{name_root}{FILENAME_SUFFIX}{ext}"
-                    final_caption = original_caption if original_caption else f"✅ **Done**"
-
-                    await app.send_video(uid, out_path, caption=final_caption, thumb=thumb, file_name=final_filename, duration=int(out_duration))
-                    if thumb and not is_custom_thumb: os.remove(thumb)
+async def retry_flood(call, *args, attempts: int = 3):
+    # For messages sent from background tasks: wait out FloodWait instead of losing the message
+    for _ in range(attempts - 1):
+        try: return await call(*args)
+        except FloodWait as e: await asyncio.sleep(e.value + 1)
+    return await call(*args)
+
+async def reply_waiting(m: Message, text: str, attempts: int = 3) -> Message:
+    return await retry_flood(m.reply, text, attempts=attempts)
+
+async def queue_video(m: Message, sess, source: Optional[str] = None):
+    job = scheduler.submit(m.from_user.id, m, sess, source=source)
+    wait = scheduler.estimated_wait(job)
+    if wait == 0: return await reply_waiting(m, "✅ **Added to Queue** (Starting now)")
+    await reply_waiting(m, f"✅ **Added to Queue** (Pos: {scheduler.position(job)}, ETA: {format_wait(wait)})")
+
+async def flush_video_batch(uid: int):
+    # Keep collecting while videos keep arriving, then queue them under one status message.
+    # Runs as a background task, so nothing may escape it.
+    messages = pending_batches[uid]
+    try:
+        seen = 0
+        while messages and seen != len(messages):  # emptied = cancelled
+            seen = len(messages)
+            await asyncio.sleep(BATCH_WAIT)
+    finally:
+        if pending_batches.get(uid) is messages: del pending_batches[uid]  # not a newer batch started after /cancel
+    if not messages: return  # cancelled
+    try:
+        sess = await get_session(uid)
+        if len(messages) == 1: return await queue_video(messages[0], sess)
+
+        batch = VideoBatch(uid)
+        jobs = [scheduler.submit(uid, m, sess, batch=batch) for m in messages]
+        text = batch.render() + f"\nAll done in {format_wait(scheduler.estimated_wait(jobs[-1]) + scheduler.avg_job_time)}"
+        batch.msg = await reply_waiting(messages[0], text)
+    except Exception as e:
+        # The jobs are queued either way; only their status message is missing
+        logger.error(f"Batch Error for {uid}: {e}")
+
+
+# ==================== PREVIEW ====================
+@dataclass
+class PreviewSource:
+    message: Message
+    path: str
+    ws: JobWorkspace
+    expires: float
+
+class PreviewCache:
+    """The last video each user previewed, kept on disk for PREVIEW_KEEP seconds so /go encodes it without a second download."""
+
+    def __init__(self):
+        self.entries: Dict[int, PreviewSource] = {}
+        self.locks: Dict[int, asyncio.Lock] = {}
+        self.hits = self.misses = 0
+
+    async def fetch(self, uid: int, message: Message, status_msg) -> Optional[PreviewSource]:
+        file = message.video or message.document
+        async with self.locks.setdefault(uid, asyncio.Lock()):
+            src = self.entries.get(uid)
+            held = src and (src.message.video or src.message.document)
+            if held and held.file_unique_id == getattr(file, "file_unique_id", None) and file_ok(src.path):
+                self.hits += 1
+                src.message = message
+            else:
+                self.misses += 1
+                self.drop(uid)
+                src = await self._download(uid, message, getattr(file, "file_size", 0) or 0, status_msg)
+                if not src: return None
+                self.entries[uid] = src
+            src.expires = time.time() + PREVIEW_KEEP
+            asyncio.get_running_loop().call_later(PREVIEW_KEEP + 1, self.expire)
+            return src
+
+    async def _download(self, uid, message, size, status_msg) -> Optional[PreviewSource]:
+        ws = workspace.try_reserve(f"preview{uid}", size)
+        if ws is None:
+            status.post(status_msg, "❌ **Not enough disk space** right now, try again shortly.", urgent=True)
+            return None
+        path = os.path.join(WORK_DIR, f"in_preview_{uid}_{int(time.time())}.mp4")
+        ws.track(path)
+        try:
+            ok = await asyncio.wait_for(
+                download_file(message, path, progress=download_progress, progress_args=(status_msg, time.time())),
+                transfer_timeout(size))
+        except BaseException:
+            ws.close()
+            raise
+        if not ok:
+            ws.close()
+            return None
+        return PreviewSource(message, path, ws, 0)
+
+    def take(self, uid: int) -> Optional[PreviewSource]:
+        # Hands the file over to a job: it leaves the cache and its reservation without being deleted
+        src = self.entries.pop(uid, None)
+        if not src: return None
+        src.ws.paths.remove(src.path)
+        src.ws.close()
+        return src if file_ok(src.path) else None
+
+    def drop(self, uid: int):
+        src = self.entries.pop(uid, None)
+        if src: src.ws.close()
+
+    def expire(self):
+        now = time.time()
+        for uid in [u for u, src in self.entries.items() if src.expires <= now]: self.drop(uid)
+
+preview_cache = PreviewCache()
+
+async def render_preview(in_path, out_path, sess) -> Tuple[EncodeResult, float]:
+    # PREVIEW_SECONDS of the source at low resolution through the same planner and overlay graph as process_video.
+    # Returns (result, start second); the clip starts a quarter in, where the moving mark is well under way.
+    info = await probe_media(in_path)
+    start = max(0.0, min((info.duration or 0) / 4, (info.duration or 0) - PREVIEW_SECONDS))
+    plan = plan_encode(info, replace(sess, resolution=min(sess.resolution, PREVIEW_HEIGHT)))
+    fast = replace(sess, codec="libx264", preset="ultrafast", crf=28)
+    result = EncodeResult()
+    wm_paths = await prepare_overlays(sess.watermark_text, sess, plan.height)
+    try:
+        # -ss before -i seeks by keyframe without decoding up to it; t_offset keeps the animation where the full encode has it
+        cmd_args = [
+            "ffmpeg", "-y", "-ss", f"{start:.3f}", "-i", in_path, *overlay_inputs(wm_paths),
+            "-filter_complex", build_filter(sess, plan, t_offset=start), "-map", "[v]", "-map", "0:a?",
+            "-t", str(PREVIEW_SECONDS), *video_codec_args(fast), *plan.fps_args, *plan.audio_args, "-movflags", "+faststart", out_path
+        ]
+        returncode = await run_ffmpeg(cmd_args, result, timeout=PREVIEW_TIMEOUT, label=os.path.basename(out_path))
+        result.ok = returncode == 0 and file_ok(out_path, 1024)
+        return result, start
+    finally:
+        release_overlays(wm_paths)
+
+async def run_preview(uid: int, message: Message):
+    sess = replace(await get_session(uid))  # settings as of the request
+    timer = JobTimer(uid, kind="preview")
+    outcome = "error"
+    status_msg = await message.reply("⬇️ **Downloading for preview...**")
+    try:
+        with timer.stage("download"):
+            src = await preview_cache.fetch(uid, message, status_msg)
+        if not src:
+            outcome = "download_failed"
+            status.post(status_msg, "❌ Download Failed.", urgent=True)
+            return
+        status.post(status_msg, "🎞 **Rendering preview...**", urgent=True)
+        with JobWorkspace(workspace, f"preview_out{uid}", 0) as ws:
+            out_path = ws.scratch(f"out_preview_{uid}_{int(time.time())}.mp4")
+            with timer.stage("encode"):
+                result, start = await render_preview(src.path, out_path, sess)
+            if not result:
+                outcome = "encode_failed"
+                status.post(status_msg, f"❌ Preview {result.error or 'failed'}.", urgent=True)
+                return
+            with timer.stage("upload"):
+                await app.send_video(
+                    uid, out_path, duration=int(result.duration), width=result.width, height=result.height, reply_to_message_id=message.id,
+                    caption=f"👀 **Preview** ({int(start)}s–{int(start + result.duration)}s, {result.height}p)\n"
+                            f"/go encodes the full video. Or change settings and reply `/preview` to the video again "
+                            f"(no re-download for {int(PREVIEW_KEEP // 60)} min).")
+        outcome = "ok"
+        status.drop(status_msg)
+        await status_msg.delete()
+    except Exception as e:
+        logger.error(f"Preview Error: {e}")
+        status.post(status_msg, f"❌ Error: {e}", urgent=True)
+    finally:
+        timer.finish(outcome)
+
+
+# ==================== IMAGE WATERMARK ====================
+image_pool = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="img")
+pending_groups: Dict[str, List[Message]] = {}
+
+def overlay_origin(style, W, H, w, h) -> Tuple[int, int]:
+    # Same placement as overlay_position(); the moving mark sits where the animation starts (t=0)
+    if style == "static": return W - w - 20, H - h - 20
+    return (W - w) // 2, (H - h) // 2 + (H - h) // 3
+
+def alpha_blend(base: np.ndarray, overlay: np.ndarray, x: int, y: int):
+    # In-place "over" blend of an RGBA overlay onto an RGB frame, clipped to the frame
+    H, W = base.shape[:2]
+    h, w = overlay.shape[:2]
+    x0, y0, x1, y1 = max(x, 0), max(y, 0), min(x + w, W), min(y + h, H)
+    if x0 >= x1 or y0 >= y1: return
+    ov = overlay[y0 - y:y1 - y, x0 - x:x1 - x].astype(np.uint16)
+    alpha = ov[..., 3:4]
+    region = base[y0:y1, x0:x1].astype(np.uint16)
+    base[y0:y1, x0:x1] = ((ov[..., :3] * alpha + region * (255 - alpha) + 127) // 255).astype(np.uint8)
+
+def composite_image(src_path, out_path, sess) -> str:
+    # Blocking: runs in image_pool. Returns the written path.
+    start = time.perf_counter()
+    with Image.open(src_path) as im:
+        # Phone photos sent as documents keep their EXIF rotation; bake it in so the mark lands upright
+        frame = np.array(ImageOps.exif_transpose(im).convert("RGB"))
+    H, W = frame.shape[:2]
+    for style, t_h, scale in overlay_layers(sess, H):
+        path, w, h = overlay_cache.acquire(sess.watermark_text, style, t_h, scale)
+        try:
+            with Image.open(path) as wm:
+                overlay = np.asarray(wm.convert("RGBA"))
+        finally:
+            overlay_cache.release(path)
+        alpha_blend(frame, overlay, *overlay_origin(style, W, H, w, h))
+    Image.fromarray(frame).save(out_path, quality=95)
+    logger.info(f"Image: {W}x{H} in {(time.perf_counter() - start) * 1000:.0f}ms")
+    return out_path
+
+async def process_images(uid: int, messages: List[Message]):
+    sess = await get_session(uid)
+    timer = JobTimer(uid, kind="image")
+    timer.info["count"] = len(messages)
+    outcome = "error"
+    stamp = f"{uid}_{int(time.time())}_{random.randint(100,999)}"
+    need = sum(getattr(m.photo or m.document, "file_size", 0) or 0 for m in messages) * 2
+    ws = workspace.try_reserve(f"img{stamp}", need)
+    if ws is None:
+        return await app.send_message(uid, "❌ **Not enough disk space** right now, try again shortly.")
+    with ws:
+        try:
+            with timer.stage("download"):
+                in_paths = await asyncio.gather(*(
+                    app.download_media(m, file_name=ws.scratch(f"img_in_{stamp}_{i}"))
+                    for i, m in enumerate(messages)
+                ))
+            loop = asyncio.get_running_loop()
+            jobs = []
+            for i, p in enumerate(in_paths):
+                if not p: continue
+                jobs.append(loop.run_in_executor(image_pool, composite_image, p, ws.scratch(f"img_out_{stamp}_{i}.jpg"), sess))
+            with timer.stage("composite"):
+                done = [p for p in await asyncio.gather(*jobs, return_exceptions=True) if isinstance(p, str)]
+            if not done:
+                outcome = "encode_failed"
+                return await app.send_message(uid, "❌ Processing Failed.")
+
+            caption = messages[0].caption.html if messages[0].caption else ""
+            with timer.stage("upload"):
+                if len(done) == 1:
+                    await app.send_photo(uid, done[0], caption=caption)
                 else:
-                    await status_msg.edit_text("❌ Processing Failed.")
-                
-                await status_msg.delete()
-                if os.path.exists(in_path): os.remove(in_path)
-                if os.path.exists(out_path): os.remove(out_path)
+                    # Telegram albums hold at most 10 items
+                    for i in range(0, len(done), 10):
+                        media = [InputMediaPhoto(p, caption=caption if i == j == 0 else "") for j, p in enumerate(done[i:i + 10])]
+                        await app.send_media_group(uid, media)
+            outcome = "ok"
+        except Exception as e:
+            logger.error(f"Image Error: {e}")
+            await app.send_message(uid, f"❌ Error: {e}")
+        finally:
+            timer.finish(outcome)
 
-            except Exception as e:
-                logger.error(f"Worker Error: {e}")
-                await status_msg.edit(f"❌ Error: {e}")
-    finally: sess.is_processing = False
+async def flush_media_group(uid: int, group_id: str):
+    # Album items arrive as separate messages; wait for the rest, then run them as one batch
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    messages = pending_groups.pop(group_id, [])
+    if messages: await process_images(uid, messages)
 
 
 # ==================== HANDLERS ====================
@@ -384,6 +2929,10 @@ async def unauth_handler(_, m):
         else: await m.reply("⚠️ User not in list.")
     except: await m.reply("❌ Invalid ID.")
 
+@app.on_message(filters.command("stats") & filters.user(OWNER_ID))
+async def stats_handler(_, m):
+    await m.reply(metrics.summary())
+
 # --- SETTINGS COMMANDS ---
 @app.on_message(filters.command("start"))
 async def start_handler(_, m):
@@ -394,11 +2943,14 @@ async def start_handler(_, m):
         "1. `/ws` - Static Watermark\n"
         "2. `/w` - Animated Watermark (Red, No Box)\n"
         "3. `/dual` - Both (Static + Animated)\n"
+        "Send videos, photos or albums after setting the text.\n"
         "**Settings:**\n"
         "• `/speed 1.5` - Set Animation Speed\n"
         "• `/scale 1.2` - Set Animation Size\n"
         "• `/setthumb` - Save Thumbnail\n"
-        "• `/codec 265` - Video Codec"
+        "• `/codec 265` - Video Codec\n"
+        "• `/preview` - Preview Before Encoding (`/go` to confirm)\n"
+        "• `/queue` - Queue Position"
     )
 
 @app.on_message(filters.command("setthumb") & (filters.photo | filters.reply) & authorized_only)
@@ -482,48 +3034,109 @@ async def set_crf(_, m):
 @app.on_message(filters.command("res") & authorized_only)
 async def set_res(_, m):
     try:
-        val = int(m.command[1])
-        (await get_session(m.from_user.id)).resolution = val
-        await m.reply(f"✅ Res: {val}p")
-    except: await m.reply("Usage: `/res 720`")
+        vals = sorted({int(v) for v in m.command[1:]}, reverse=True)
+        if not vals: raise ValueError
+        sess = await get_session(m.from_user.id)
+        # Several sizes come out of one encode; the largest is the main output
+        sess.resolution = vals[0]
+        sess.renditions = vals if len(vals) > 1 else []
+        await m.reply(f"✅ Res: {' + '.join(f'{v}p' for v in vals)}")
+    except: await m.reply("Usage: `/res 720` or `/res 1080 720 480`")
+
+@app.on_message(filters.command("preview") & authorized_only)
+async def preview_handler(_, m):
+    sess = await get_session(m.from_user.id)
+    target = m.reply_to_message
+    if target and (target.video or (target.document and "video" in (target.document.mime_type or ""))):
+        if sess.step != "waiting_media": return await m.reply("⚠️ Use /ws, /w, or /dual first.")
+        asyncio.create_task(run_preview(m.from_user.id, target))
+        return
+    # Without a reply: toggle previewing every video before it is encoded
+    sess.preview = (m.command[1].lower() in ("on", "1")) if len(m.command) > 1 else not sess.preview
+    await m.reply("👀 **Preview On**: videos get a short preview, /go encodes the last one." if sess.preview else "✅ **Preview Off**")
+
+@app.on_message(filters.command("go") & authorized_only)
+async def go_handler(_, m):
+    sess = await get_session(m.from_user.id)
+    if sess.step != "waiting_media": return await m.reply("⚠️ Use /ws, /w, or /dual first.")
+    src = preview_cache.take(m.from_user.id)
+    if not src: return await m.reply("⚠️ No previewed video waiting (they are kept for a few minutes). Send it again.")
+    # Current settings, so changes made after the preview apply
+    await queue_video(src.message, sess, source=src.path)
 
 @app.on_message(filters.command("settings") & authorized_only)
 async def settings_handler(_, m):
     s = await get_session(m.from_user.id)
-    await m.reply(f"**Settings**\nMode: `{s.watermark_mode}`\nCodec: `{s.codec}`\nSpeed: `{s.speed}`\nScale: `{s.scale}`\nThumb: {'✅' if s.custom_thumb_path else '❌'}")
+    await m.reply(f"**Settings**\nMode: `{s.watermark_mode}`\nCodec: `{s.codec}`\nSpeed: `{s.speed}`\nScale: `{s.scale}`\nThumb: {'✅' if s.custom_thumb_path else '❌'}\nPreview: {'✅' if s.preview else '❌'}")
 
-@app.on_message(filters.text & filters.private & authorized_only)
+@app.on_message(filters.text & ~filters.regex(r"^/") & filters.private & authorized_only)
 async def text_handler(_, m):
     sess = await get_session(m.from_user.id)
     if sess.step == "waiting_text":
         sess.watermark_text = m.text
         sess.step = "waiting_media"
-        await m.reply(f"✅ Text Set: `{sess.watermark_text}`\nNow send video.")
+        await m.reply(f"✅ Text Set: `{sess.watermark_text}`\nNow send a video or photo.")
+
+image_document = filters.create(lambda _, __, m: bool(m.document and (m.document.mime_type or "").startswith("image/")))
+
+@app.on_message((filters.photo | image_document) & filters.private & authorized_only)
+async def photo_handler(c, m):
+    sess = await get_session(m.from_user.id)
+    if sess.step != "waiting_media": return await m.reply("⚠️ Use /ws, /w, or /dual first.")
+    if m.media_group_id:
+        group = pending_groups.setdefault(m.media_group_id, [])
+        group.append(m)
+        if len(group) == 1: asyncio.create_task(flush_media_group(m.from_user.id, m.media_group_id))
+        return
+    asyncio.create_task(process_images(m.from_user.id, [m]))
 
 @app.on_message((filters.video | filters.document) & filters.private & authorized_only)
 async def media_handler(c, m):
     sess = await get_session(m.from_user.id)
     if sess.step != "waiting_media": return await m.reply("⚠️ Use /ws, /w, or /dual first.")
     if m.document and "video" not in m.document.mime_type: return await m.reply("❌ Not a video.")
-    sess.queue.append(m)
-    await m.reply(f"✅ **Added to Queue** (Pos: {len(sess.queue)})")
-    asyncio.create_task(worker(m.from_user.id))
+    # Same source with the same settings was done before: resend it without queueing
+    if await send_cached_result(Job(m.from_user.id, m, sess=sess)): return
+    if sess.preview:
+        asyncio.create_task(run_preview(m.from_user.id, m))
+        return
+    if BATCH_WAIT <= 0: return await queue_video(m, sess)
+    # Several videos in a row (or an album of videos) become one batch
+    batch = pending_batches.setdefault(m.from_user.id, [])
+    batch.append(m)
+    if len(batch) == 1: asyncio.create_task(flush_video_batch(m.from_user.id))
+
+@app.on_message(filters.command("queue") & authorized_only)
+async def queue_handler(_, m):
+    uid = m.from_user.id
+    mine = [j for j in scheduler._order() if j.uid == uid]
+    head = f"**Queue** ({scheduler.in_flight}/{scheduler.slots} running, {len(scheduler._order())} waiting to encode)"
+    if not mine: return await m.reply(f"{head}\nYou have nothing queued.")
+    lines = [f"• Pos {scheduler.position(j)} – ETA {format_wait(scheduler.estimated_wait(j))}" for j in mine]
+    await m.reply(head + "\n" + "\n".join(lines))
 
 # --- NEW CANCEL COMMAND ---
 @app.on_message(filters.command("cancel") & authorized_only)
 async def cancel_handler(_, m):
-    sess = await get_session(m.from_user.id)
-    if not sess.queue:
+    uid = m.from_user.id
+    if not scheduler.queued(uid) and not scheduler.running.get(uid) and not pending_batches.get(uid):
         return await m.reply("❌ **Queue is empty.**")
     
-    count = len(sess.queue)
-    sess.queue.clear()
-    await m.reply(f"🛑 **Cancelled!**\nCleared {count} item(s) from the queue.\nCurrent task will finish shortly.")
+    collecting = drop_pending_batch(uid)
+    queued, stopped = scheduler.cancel(uid, running=True)
+    await m.reply(f"🛑 **Cancelled!**\nCleared {queued + collecting} item(s) from the queue.\nStopped {stopped} running job(s).")
 
 if __name__ == "__main__":
+    if ENCODE_WORKER:
+        if not broker: sys.exit("ENCODE_BROKER is not set")
+        check_resources()
+        asyncio.run(run_encode_worker())
+        sys.exit(0)
     check_resources()
     print("Bot is starting...")
     app.start()
+    app.loop.run_until_complete(start_metrics_server())
+    app.loop.run_until_complete(recover_jobs())
     try: app.send_message(OWNER_ID, "Hey Vaisu welcome back")
     except: pass
     print("Bot is now running.")